@@ -4,28 +4,46 @@ import s3fs
 import bcrypt
 import asyncio
 import logging
-from fastapi import status
-from fastapi.responses import StreamingResponse
-from concurrent.futures import ProcessPoolExecutor
+from contextlib import aclosing
+from fastapi import status, Request, Response
+from fastapi.responses import StreamingResponse, HTMLResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 
 
 # MODULE IMPORTS
+from common.startup import startup_timings
 from common.config import start_wandb_run
-from common.models import CodeRequest, CodeResponse
-from common.inference import claude_inference,claude_inference_streaming
-from api.utils import check_and_trim_code_length, prepare_response, load_users_from_yaml
-from caching.redis_cache import generate_cache_key, get_cached_result, set_cache_result
+from common.models import CodeRequest, CodeResponse, MergeKGRequest
+from common.kg_registry import UnknownKG
+from common.inference import claude_inference_async, claude_inference_streaming, federated_inference_async, get_kg_registry, query_runner, current_cache_namespace, load_engines, engines_loaded, load_kg_layout, ensure_settings, reload_engines, watch_kg, serving_kg_info, ReloadInProgress, KG_RELOAD_POLL_INTERVAL
+from api.utils import check_and_trim_code_length, prepare_response, load_users_from_yaml, format_sse, server_timing
+from common.metrics import metrics
+from common.utils import load_config
+from caching.redis_cache import completion_cache_key, AsyncRedisCache, TieredCache
+from caching.single_flight import SingleFlight
+from caching.revalidate import Revalidator
+from caching.continuation_cache import ContinuationCache
+from caching.semantic_cache import SemanticCache, create_embedder
+from caching.subgraph_cache import SubgraphCache, SUBGRAPH_FORMATS, SUBGRAPH_TTL
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
 PERSIST_DIR = '/home/ubuntu/dApp/knowledge_graph_data/'
 
+config = load_config()
+
+# "background": load the KG and engines after the server starts accepting connections,
+# "lazy": on the first request that needs them, "eager": before accepting connections
+STARTUP_MODE = config.get('STARTUP_MODE', 'background')
+
+# Upper bounds of the slices a client can request from /v1/kg/layout
+KG_LAYOUT_MAX_NODES = config.get('KG_LAYOUT_MAX_NODES', 10000)
+KG_LAYOUT_MAX_EDGES = config.get('KG_LAYOUT_MAX_EDGES', 50000)
+
 app = FastAPI()
-start_wandb_run()
 
 # Configure CORS middleware
 app.add_middleware(
@@ -45,6 +63,28 @@ users = load_users_from_yaml('users.yaml')
 # Initialize S3 filesystem
 s3 = s3fs.S3FileSystem(anon=False)
 
+# Shared async Redis client, one connection pool per worker
+redis_cache = AsyncRedisCache()
+
+# In-process LRU tier in front of Redis, kept coherent through pub/sub
+cache = TieredCache(redis_cache)
+
+# Coalesces identical in-flight completions within and across workers
+single_flight = SingleFlight(redis_cache)
+
+# Refreshes stale and soon-to-be-stale completions in the background while they are served
+revalidator = Revalidator(redis_cache)
+
+# Answers keystroke-extended prefixes from the user's previous completions
+continuation_cache = ContinuationCache()
+
+# Serves near-duplicate prefixes (whitespace, comments, small edits) from earlier completions. A
+# Bedrock embedder is resolved on first use, once the models are configured
+semantic_cache = SemanticCache(create_embedder(configure=ensure_settings))
+
+# Edge sets of completions, rendered by /v1/subgraph only when a client asks for them
+subgraph_cache = SubgraphCache(redis_cache)
+
 def authenticate(credentials: HTTPBasicCredentials = Depends(security)):
     hashed_password = users.get(credentials.username)
     if not hashed_password or not bcrypt.checkpw(credentials.password.encode('utf-8'), hashed_password):
@@ -55,29 +95,60 @@ def authenticate(credentials: HTTPBasicCredentials = Depends(security)):
         )
     return credentials.username
 
-async def async_generate_cache_key(prefix_code: str) -> str:
-    loop = asyncio.get_event_loop()
-    with ProcessPoolExecutor() as pool:
-        return await loop.run_in_executor(pool, generate_cache_key, prefix_code)
+# Blocking startup steps running on worker threads after the server has started
+startup_tasks = []
+
+async def run_startup_step(name, func):
+    """Runs a blocking startup step on a worker thread and records its duration as phase `name`."""
+    try:
+        with startup_timings.phase(name):
+            await asyncio.to_thread(func)
+    except Exception:
+        logging.exception(f"Startup step '{name}' failed")
+
+def clear_kg_caches(engines):
+    """
+    Called by reload_engines once a new KG is served. Completion cache keys carry the KG's
+    namespace, but the continuation and semantic caches of this worker do not.
+    """
+    continuation_cache.clear()
+    semantic_cache.clear()
 
-async def async_get_cached_result(cache_key: str):
-    loop = asyncio.get_event_loop()
-    with ProcessPoolExecutor() as pool:
-        return await loop.run_in_executor(pool, get_cached_result, cache_key)
+@app.on_event("startup")
+async def start_services():
+    await cache.start()
+    # The wandb login is a network call that nothing on the request path depends on
+    startup_tasks.append(asyncio.ensure_future(run_startup_step("start_wandb_run", start_wandb_run)))
+    if STARTUP_MODE == "eager":
+        await run_startup_step("load_engines", load_engines)
+    elif STARTUP_MODE == "background":
+        startup_tasks.append(asyncio.ensure_future(run_startup_step("load_engines", load_engines)))
+    if KG_RELOAD_POLL_INTERVAL:
+        # Every worker watches the KG on disk and reloads its own engines
+        startup_tasks.append(asyncio.ensure_future(watch_kg(KG_RELOAD_POLL_INTERVAL, on_swap=clear_kg_caches)))
+    startup_timings.mark("accepting_connections")
 
-async def async_set_cache_result(cache_key: str, result: dict):
-    loop = asyncio.get_event_loop()
-    with ProcessPoolExecutor() as pool:
-        await loop.run_in_executor(pool, set_cache_result, cache_key, result)
+@app.on_event("shutdown")
+async def close_cache():
+    await single_flight.close()
+    await revalidator.close()
+    await cache.close()
+    for task in startup_tasks:
+        task.cancel()
+    query_runner.shutdown()
 
 
 @app.post("/v1/generate_stream_code")
-async def generate_code(request: CodeRequest, username: str = Depends(authenticate)):
+async def generate_code(request: CodeRequest, http_request: Request, username: str = Depends(authenticate)):
     """
     Generates code based on a defined prefix and streams the generated code as it is created.
+    Only the decoded `fill_in_middle` code is streamed, not the model's JSON wrapper. Each chunk
+    is sent as an SSE `data:` frame and the stream ends with an `event: done` frame.
+    Generation is aborted as soon as the client disconnects.
 
     Args:
         request (CodeRequest): Request containing the prefix code for code generation.
+        http_request (Request): The raw HTTP request, used to detect client disconnects.
         username (str): Authenticated username, provided by the dependency injection.
 
     Returns:
@@ -107,22 +178,41 @@ async def generate_code(request: CodeRequest, username: str = Depends(authentica
         }
         ```
     """
+    async def event_stream():
+        metrics.incr("stream.started")
+        try:
+            async with aclosing(claude_inference_streaming(request.prefix_code)) as tokens:
+                async for token in tokens:
+                    if await http_request.is_disconnected():
+                        metrics.incr("stream.client_disconnected")
+                        return
+                    yield format_sse(token)
+            yield format_sse("[DONE]", event="done")
+        except asyncio.CancelledError:
+            metrics.incr("stream.client_disconnected")
+            raise
+        except Exception as e:
+            logging.exception("Streaming generation failed")
+            yield format_sse(str(e), event="error")
+
     return StreamingResponse(
-        claude_inference_streaming(request.prefix_code),
-        media_type="text/event-stream")
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.post("/v1/generate_code", response_model=CodeResponse)
 async def generate_code(request: CodeRequest, username: str = Depends(authenticate)):
     """
     Generate code based on the provided prefix code. This endpoint receives a prefix code and returns the generated code completion,
-    knowledge graph edges, and optionally a subgraph plot.
+    the knowledge graph edges it was generated from as (subject, relation, object) lists, and the ID of that subgraph.
+    The subgraph is not rendered here; fetch it from `/v1/subgraph/{subgraph_id}` when it is displayed.
 
         Args:
-            request (CodeRequest): A request containing the prefix code and a subgraph plot.
+            request (CodeRequest): A request containing the prefix code.
 
         Returns:
-            CodeResponse: A response containing the generated code, knowledge graph edges, and subgraph plot.
+            CodeResponse: A response containing the generated code, knowledge graph edges and subgraph ID.
 
         Raises:
             HTTPException: If an error occurs during code generation.
@@ -139,32 +229,284 @@ async def generate_code(request: CodeRequest, username: str = Depends(authentica
             ```
             {
                 "generated_code": "{ pub extrinsics: Vec<Extrinsic>}",
-                "kg_context": [
-                    "('Parachain-template-1001.rs', 'Written in', 'Rust programming language')",
-                    "('Ink!', 'Enable', 'Write webassembly-based smart contracts using rust')",
-                    "['Substrate', 'Allows building', 'Application-specific blockchains']",
-                    "('Ink!', 'Is', 'Rust smart contract language for substrate chains')",
-                    "['Rust', 'Required for', 'Compiling node']",
-                    "['Rust', 'Logging api', 'Debug macros']"
+                "kg_edges": [
+                    ["Parachain-template-1001.rs", "Written in", "Rust programming language"],
+                    ["Ink!", "Enable", "Write webassembly-based smart contracts using rust"],
+                    ["Substrate", "Allows building", "Application-specific blockchains"],
+                    ["Rust", "Required for", "Compiling node"]
                 ],
-                "subgraph_plot": "<iframe>< /iframe>"
+                "subgraph_plot": "",
+                "subgraph_id": "9f2c4e1a7b3d5c6e8f0a1b2c"
             }
             ```
     """
+    continuation = continuation_cache.lookup(username, request.prefix_code)
+    if continuation:
+        return CodeResponse(**continuation)
+
+    prefix_code = check_and_trim_code_length(request.prefix_code)
+
+    # Taken once, so a KG reload during the request cannot split its lookup and store
+    namespace = current_cache_namespace()
+    cache_key = completion_cache_key(prefix_code, namespace)
+
+    async def generate():
+        generated_code, sub_edges, subplot = await claude_inference_async(prefix_code)
+        graph_id = await subgraph_cache.put(sub_edges)
+        return prepare_response(generated_code, sub_edges, subplot, graph_id).dict()
+
+    async def compute():
+        result = await generate()
+        await cache.set(cache_key, result, namespace=namespace)
+        await asyncio.to_thread(semantic_cache.add, prefix_code, result)
+        return result
+
+    cached = await cache.get_entry(cache_key)
+    if cached:
+        # Stale entries are served as is while one worker refreshes them
+        if revalidator.should_refresh(cached):
+            revalidator.schedule(cache_key, compute)
+        continuation_cache.add(username, request.prefix_code, cached.result)
+        return CodeResponse(**cached.result)
+
+    semantic_hit = await asyncio.to_thread(semantic_cache.lookup, prefix_code)
+    if semantic_hit:
+        if semantic_cache.should_verify():
+            asyncio.create_task(verify_semantic_hit(semantic_hit, generate))
+        continuation_cache.add(username, request.prefix_code, semantic_hit.result)
+        return CodeResponse(**semantic_hit.result)
+
+    result = await single_flight.do(cache_key, compute)
+    continuation_cache.add(username, request.prefix_code, result)
+
+    return CodeResponse(**result)
+
+async def verify_semantic_hit(semantic_hit, generate):
+    """Re-generates a sampled semantic cache hit in the background to measure false hits."""
+    try:
+        semantic_cache.verify(semantic_hit, await generate())
+    except Exception:
+        logging.exception("Semantic cache verification failed")
+
+@app.post("/v1/merge_kg", response_model=CodeResponse)
+async def merge_kg(request: MergeKGRequest, response: Response, username: str = Depends(authenticate)):
+    """
+    Generate code from several named knowledge graphs at once, e.g. `["Astar", "polkadot-sdk"]`. The
+    KGs are loaded on first use and kept in memory within a budget; each is queried concurrently and
+    their triplets and text chunks are fused into one context, answered with one query. The load and
+    retrieval time of each KG is returned in the Server-Timing header and observed in `/metrics`
+    as `kg_registry.retrieve.<name>`. Completions are not cached.
+
+        Args:
+            request (MergeKGRequest): The names of the KGs to query and the prefix code.
+
+        Returns:
+            CodeResponse: A response containing the generated code, the fused knowledge graph edges and their subgraph ID.
+
+        Raises:
+            HTTPException: 400 if no KG is named, 404 if a KG does not exist.
+    """
+    if not request.kg_names:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="kg_names must name at least one KG")
     prefix_code = check_and_trim_code_length(request.prefix_code)
-               
-    cache_key = await async_generate_cache_key(prefix_code)
-    cached_result = await async_get_cached_result(cache_key)
-    
-    if cached_result:
-        return CodeResponse(**cached_result)
-
-    generated_code, sub_edges, subplot = claude_inference(prefix_code)    
-    response = prepare_response(generated_code, sub_edges, subplot)
-    
-    await async_set_cache_result(cache_key, response.dict())
-    
-    return response
+    try:
+        generated_code, sub_edges, timings = await federated_inference_async(request.kg_names, prefix_code)
+    except UnknownKG as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Unknown KG {e.args[0]!r}")
+    graph_id = await subgraph_cache.put(sub_edges)
+    response.headers["Server-Timing"] = server_timing(timings)
+    return prepare_response(generated_code, sub_edges, "", graph_id)
+
+@app.get("/v1/subgraph/{subgraph_id}")
+async def get_subgraph(subgraph_id: str, format: str = "html", username: str = Depends(authenticate)):
+    """
+    Renders the knowledge graph subgraph of a completion, identified by the `subgraph_id` that
+    `/v1/generate_code` returned. The HTML page is rendered on first request and cached by the
+    hash of the edge set; `format=json` returns the nodes and edges for rendering on the client
+    (e.g. with vis-network) instead. The response never changes for a given ID.
+
+    Args:
+        subgraph_id (str): ID from a CodeResponse.
+        format (str): "html" (default) or "json".
+
+    Returns:
+        HTMLResponse | dict: The pyvis page, or `{"nodes": [{"id", "label"}], "edges": [{"from", "to", "label"}]}`.
+
+    Raises:
+        HTTPException: 400 for an unknown format, 404 if the subgraph is unknown or expired.
+    """
+    if format not in SUBGRAPH_FORMATS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"format must be one of {', '.join(SUBGRAPH_FORMATS)}")
+    rendered = await subgraph_cache.render(subgraph_id, format)
+    if rendered is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown or expired subgraph")
+    headers = {"Cache-Control": f"private, max-age={int(SUBGRAPH_TTL)}, immutable"}
+    if format == "html":
+        return HTMLResponse(rendered, headers=headers)
+    return JSONResponse(rendered, headers=headers)
+
+async def current_kg_layout():
+    """The precomputed layout of the current KG; answers 503 if it has not been built."""
+    layout = await asyncio.to_thread(load_kg_layout)
+    if layout is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="No layout of the current KG, run code_generation/kg_construction/build_kg_layout.py",
+        )
+    return layout
+
+@app.get("/v1/kg/layout")
+async def get_kg_layout(username: str = Depends(authenticate)):
+    """
+    Describes the precomputed layout of the full knowledge graph: node, edge and community
+    counts, the highest degree and the bounds of the node positions, for a client to set up
+    its canvas before requesting slices.
+
+    Returns:
+        dict: The layout's manifest.
+    """
+    return (await current_kg_layout()).manifest
+
+@app.get("/v1/kg/layout/nodes")
+async def get_kg_layout_nodes(offset: int = 0, limit: int = 1000, min_degree: int = 0, edge_limit: int = 5000,
+                              username: str = Depends(authenticate)):
+    """
+    Pages through the nodes of the full knowledge graph in descending degree order, hubs first,
+    at their precomputed positions. Each page includes the edges between its nodes and the
+    nodes of earlier pages, so loading pages in order yields every edge once.
+
+    Args:
+        offset (int): First node of the page, `next_offset` of the previous page.
+        limit (int): Nodes per page, at most KG_LAYOUT_MAX_NODES.
+        min_degree (int): Level of detail: leave out nodes with fewer edges.
+        edge_limit (int): Edges per page, at most KG_LAYOUT_MAX_EDGES.
+
+    Returns:
+        dict: vis-network `nodes` and `edges`, `next_offset` (None after the last page),
+        `total_nodes` and the number of `truncated_edges`.
+    """
+    layout = await current_kg_layout()
+    return await asyncio.to_thread(layout.page, offset, min(limit, KG_LAYOUT_MAX_NODES), min_degree=min_degree,
+                                   edge_limit=min(edge_limit, KG_LAYOUT_MAX_EDGES))
+
+@app.get("/v1/kg/layout/viewport")
+async def get_kg_layout_viewport(x0: float, y0: float, x1: float, y1: float, limit: int = 1000, min_degree: int = 0,
+                                 edge_limit: int = 5000, username: str = Depends(authenticate)):
+    """
+    Returns the part of the full knowledge graph inside a viewport: the `limit` nodes with the
+    highest degree whose precomputed positions fall inside the box, and the edges between them.
+    Zoomed out, only hubs fit the limit; zooming in reveals the minor nodes of the area.
+
+    Args:
+        x0, y0, x1, y1 (float): The box, in the coordinates of the layout's bounds.
+        limit (int): Nodes, at most KG_LAYOUT_MAX_NODES.
+        min_degree (int): Level of detail: leave out nodes with fewer edges.
+        edge_limit (int): Edges, at most KG_LAYOUT_MAX_EDGES.
+
+    Returns:
+        dict: vis-network `nodes` and `edges`, the number of `visible_nodes` in the box and of `truncated_edges`.
+    """
+    layout = await current_kg_layout()
+    return await asyncio.to_thread(layout.viewport, min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1),
+                                   limit=min(limit, KG_LAYOUT_MAX_NODES), min_degree=min_degree,
+                                   edge_limit=min(edge_limit, KG_LAYOUT_MAX_EDGES))
+
+@app.get("/v1/kg/layout/communities")
+async def get_kg_layout_communities(limit: int = 100, min_size: int = 1, username: str = Depends(authenticate)):
+    """
+    Returns the largest communities of the full knowledge graph, one disc each with its
+    center, radius, size and hub entity, to draw when zoomed out too far for single nodes.
+
+    Returns:
+        dict: The `communities` and the `total_communities`.
+    """
+    layout = await current_kg_layout()
+    return await asyncio.to_thread(layout.communities, min(limit, KG_LAYOUT_MAX_NODES), min_size=min_size)
+
+@app.post("/v1/cache/purge")
+async def purge_cache(namespace: str = None, username: str = Depends(authenticate)):
+    """
+    Deletes the cached completions of one namespace (the current one by default) from Redis
+    and from every worker's in-process tier. Other namespaces and unrelated keys are kept.
+
+    Returns:
+        dict: The purged namespace and the number of Redis keys deleted.
+    """
+    namespace = namespace or current_cache_namespace()
+    deleted = await cache.purge_namespace(namespace)
+    return {"namespace": namespace, "deleted": deleted}
+
+@app.post("/v1/kg/reload")
+async def reload_kg(force: bool = False, username: str = Depends(authenticate)):
+    """
+    Reloads the knowledge graph of this worker from disk without a restart, if it changed since
+    it was loaded or `force` is set. The new index and engines are built and warmed with canary
+    queries in the background while the old ones keep serving, then swapped in together with a
+    new completion cache namespace. Requests already running finish on the old KG, whose memory
+    is released once they are done. The worker holds both KGs in memory meanwhile. Each worker
+    reloads separately: with several workers, set KG_RELOAD_POLL_INTERVAL instead.
+
+    Returns:
+        dict: The status ("unchanged" or "reloaded"), the KG version and cache namespace served,
+        and for a reload the previous version, the requests still draining and the build and warm-up times.
+    """
+    try:
+        return await asyncio.to_thread(reload_engines, force, clear_kg_caches)
+    except ReloadInProgress as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except Exception as e:
+        logging.exception("KG reload failed")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            detail=f"KG reload failed, still serving the previous KG: {e!r}")
+
+@app.get("/metrics")
+async def get_metrics(username: str = Depends(authenticate)):
+    """
+    Returns this worker's counters and latency summaries, e.g. how many requests were coalesced.
+
+    Returns:
+        dict: Counters and timings collected since the worker started.
+    """
+    return {
+        **metrics.snapshot(),
+        "completion_cache": cache.stats(),
+        "continuation_cache": continuation_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "kg_registry": get_kg_registry().stats(),
+        "startup": startup_timings.snapshot(),
+    }
+
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness probe: the worker is up and its event loop is responsive.
+
+    Returns:
+        dict: The status "ok".
+    """
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz(response: Response):
+    """
+    Readiness probe: the knowledge graph index and query engines are loaded. Responds with 503
+    while they are still loading. In "lazy" startup mode loading waits for the first request,
+    so the worker reports ready as soon as it accepts connections.
+
+    Returns:
+        dict: Readiness, the startup mode, the KG version served and the duration of each startup phase.
+    """
+    loaded = engines_loaded()
+    ready = loaded or STARTUP_MODE == "lazy"
+    if not ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {
+        "ready": ready,
+        "engines_loaded": loaded,
+        "startup_mode": STARTUP_MODE,
+        **serving_kg_info(),
+        **startup_timings.snapshot(),
+    }
 
 @app.get("/")
 async def root():
@@ -176,6 +518,8 @@ async def root():
     """
     return {"message": "Welcome to the dApp KG+LLM API"}
 
+startup_timings.mark("app_imported")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8081, loop="asyncio", workers = 4)
@@ -1,49 +1,67 @@
 import os
+import re
 import sys
-import json
 import bcrypt
 import yaml
-from fastapi import FastAPI, HTTPException, Depends
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from fastapi import status
-import logging
-from llama_index.core import StorageContext, KnowledgeGraphIndex, Settings
-from llama_index.readers.web import WholeSiteReader
-from llama_index.core.graph_stores import SimpleGraphStore
-from llama_index.core import StorageContext, SummaryIndex
-import s3fs
-from llama_index.readers.web import WholeSiteReader
-from llama_index.core import SummaryIndex
-from llama_index.core.indices.composability import ComposableGraph
+import threading
+from typing import Optional
 from llama_index.core import StorageContext, load_index_from_storage
-import nest_asyncio
-import re
-import json
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from common.config import start_wandb_run
-from common.models import CodeRequest, CodeResponse, KGCreationRequest, MergeKGRequest
-from common.inference import claude_inference, composable_graph_inference, load_kg_index, plot_full_kg, claude_inference_streaming
+from common.models import CodeResponse
 from common.utils import extract_code_from_response, extract_code_using_regex
-from caching.redis_cache import generate_cache_key, get_cached_result, set_cache_result, invalidate_cache
-from code_generation.kg_construction.load_and_persist_kg import load_and_persist_kg
+from common.fill_in_middle import extract_fill_in_middle, CODE_FENCE_PATTERN
+
+# Prefixes of bcrypt hashes, e.g. "$2b$12$..."
+BCRYPT_HASH_PREFIXES = (b'$2a$', b'$2b$', b'$2y$')
+
+
+class UserPasswords:
+    """
+    Maps usernames to bcrypt password hashes.
+
+    Passwords already stored as bcrypt hashes (see `api/hash_passwords.py`) are used as is.
+    Plaintext passwords are hashed the first time the user authenticates rather than at
+    startup, where hashing every user at the default cost took several seconds per worker.
+    """
+
+    def __init__(self, passwords: dict):
+        self._hashes = {}
+        self._plaintext = {}
+        for username, password in passwords.items():
+            password = password.encode('utf-8')
+            if password.startswith(BCRYPT_HASH_PREFIXES):
+                self._hashes[username] = password
+            else:
+                self._plaintext[username] = password
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._hashes) + len(self._plaintext)
+
+    def get(self, username: str) -> Optional[bytes]:
+        """Return the bcrypt hash of `username`'s password, or None for an unknown user."""
+        hashed_password = self._hashes.get(username)
+        if hashed_password is not None:
+            return hashed_password
+        with self._lock:
+            password = self._plaintext.pop(username, None)
+            if password is not None:
+                self._hashes[username] = bcrypt.hashpw(password, bcrypt.gensalt())
+            return self._hashes.get(username)
 
 
 def load_users_from_yaml(file_path):
     """
-    Loads user data from a YAML file, hashes the passwords, and creates a dictionary mapping usernames to hashed passwords.
+    Loads user data from a YAML file and creates a mapping from usernames to hashed passwords.
+    Plaintext passwords are hashed lazily, on each user's first authentication.
     :param file_path: The path to the YAML file containing user data.
-    :return: A dictionary where usernames are keys and hashed passwords are values.
+    :return: A UserPasswords mapping usernames to bcrypt hashes.
     """
     with open(file_path, 'r') as file:
         data = yaml.safe_load(file)
-        users = {}
-        for user in data['users']:
-            hashed_password = bcrypt.hashpw(user['password'].encode('utf-8'), bcrypt.gensalt())
-            users[user['username']] = hashed_password
-        return users
+        return UserPasswords({str(user['username']): str(user['password']) for user in data['users']})
 
 
 def detect_source(url: str):
@@ -105,73 +123,32 @@ def load_kg_index_from_disk(persist_path):
 
     return load_index_from_storage(storage_context)
 
-def clean_generated_code(generated_code: str) -> str:
-    cleaned_code = re.sub(r'```(json|)\s*', '', generated_code).strip()
-    cleaned_code = cleaned_code.replace('\n', '').replace('\r', '').replace('\t', '')
-    return cleaned_code
-
-def extract_value_from_generated_code(generated_code: str) -> str:
-    pattern = r'"fill_in_middle"\s*:\s*"((?:\\.|[^"\\])*)"'
-    cleaned_text = generated_code.strip('```json\n').strip('\n```')
-    match = re.search(pattern, cleaned_text)
-
-    if match:
-        value = match.group(1).replace('\\"', '"').replace('\\\\', '\\')
-        return value
-    return ""
-
-def clean_and_escape_code_logic2(generated_code: str) -> str:
-    # Remove code block markers
-    cleaned_code = re.sub(r'```(json|)\s*', '', generated_code).strip()
-    
-    # Replace escaped characters, and clean newlines, carriage returns, and tabs
-    escaped_code = cleaned_code.replace('\n', '').replace('\r', '').replace('\t', '')
-    escaped_code = escaped_code.replace('\\', '\\\\').replace('"', '\\"')
-    
-    # Remove 'fill_in_middle' key-value pairs
-    cleaned_code_without_fill_in_middle = re.sub(r'"fill_in_middle"\s*:\s*"[^"]*"', '', escaped_code)
-    
-    return cleaned_code_without_fill_in_middle
-
-def prepare_response(generated_code: str, sub_edges: list, subplot: str) -> CodeResponse:
+def prepare_response(generated_code: str, sub_edges: list, subplot: str, subgraph_id: Optional[str] = None) -> CodeResponse:
     """
-    A function that prepares a response based on the generated code, sub edges, and subplot. 
-    It tries to extract the value from the generated code and creates a result dictionary 
-    based on the extracted value, sub edges, and subplot. If the value is not found, it loads 
-    the generated code as JSON, gets the 'fill_in_middle', and creates the result dictionary. 
-    If a JSONDecodeError occurs, it cleans and escapes the generated code logic, and returns 
-    the cleaned code without 'fill_in_middle'. In case of any other exceptions, it raises an 
-    HTTPException with status code 500 and the exception detail.
+    Prepares a response from the generated code, sub edges, subplot and the ID under which
+    the edges were stored for /v1/subgraph. The `fill_in_middle` value is decoded from the
+    model answer in a single pass; if the model ignored the JSON format, the raw answer
+    without code fences is returned instead.
     """
-    try:
-        value = extract_value_from_generated_code(generated_code)
-        if value:
-            result = {
-                "generated_code": value,
-                "kg_edges": sub_edges,
-                "subgraph_plot": subplot
-            }
-        else:
-            json_response = json.loads(clean_generated_code(generated_code))
-            fill_in_middle_code = json_response.get('fill_in_middle', '')
-            result = {
-                "generated_code": fill_in_middle_code,
-                "kg_edges": sub_edges,
-                "subgraph_plot": subplot
-            }
-        return CodeResponse(**result)
-    except json.JSONDecodeError:
-        cleaned_code_without_fill_in_middle = clean_and_escape_code_logic2(generated_code)
-        # Return the remaining part as a string
-        result = {
-            "generated_code": cleaned_code_without_fill_in_middle.strip(", {}"),
-            "kg_edges": sub_edges,
-            "subgraph_plot": subplot
-        }
-        code_response_object = CodeResponse(**result)
-        return code_response_object
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    value = extract_fill_in_middle(generated_code)
+    if value is None:
+        value = CODE_FENCE_PATTERN.sub('', generated_code).strip()
+    return CodeResponse(
+        generated_code=value,
+        kg_edges=sub_edges,
+        subgraph_plot=subplot,
+        subgraph_id=subgraph_id
+    )
+
+
+def format_sse(data: str, event: str = None) -> str:
+    """
+    Formats `data` as one Server-Sent Events frame. Multi-line payloads are split
+    into several `data:` lines, which SSE clients join back with newlines.
+    """
+    frame = f"event: {event}\n" if event else ""
+    frame += "".join(f"data: {line}\n" for line in data.split("\n"))
+    return frame + "\n"
 
 
 def check_and_trim_code_length(prefix_code: str, max_length: int = 340) -> str:
@@ -184,3 +161,17 @@ def check_and_trim_code_length(prefix_code: str, max_length: int = 340) -> str:
     
     return prefix_code
 
+
+def server_timing(timings: dict) -> str:
+    """
+    Server-Timing header value of per-KG timings in milliseconds, e.g. `{"Astar": {"retrieve_ms": 12.5}}`
+    becomes `retrieve_Astar;desc="Astar retrieve";dur=12.5`.
+    """
+    entries = []
+    for kg_name, kg_timings in timings.items():
+        token = re.sub(r'[^A-Za-z0-9_-]', '_', kg_name)
+        for key, value in kg_timings.items():
+            if key.endswith('_ms'):
+                phase = key[:-len('_ms')]
+                entries.append(f'{phase}_{token};desc="{kg_name} {phase}";dur={value}')
+    return ", ".join(entries)
@@ -0,0 +1,112 @@
+"""
+Compare the legacy per-call ProcessPoolExecutor cache helpers with AsyncRedisCache.
+
+By default a fakeredis TCP server is started on a free local port as the Redis
+stand-in (`pip install fakeredis`); pass `--redis-url` to run against a real
+Redis instead. Both paths perform the same key/get/set sequence as one
+`/v1/generate_code` request.
+
+    python -m benchmarks.cache_benchmark --requests 200 --concurrency 16
+"""
+import os
+import sys
+import json
+import time
+import redis
+import socket
+import asyncio
+import argparse
+import threading
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from caching import redis_cache
+from caching.redis_cache import AsyncRedisCache, generate_cache_key, completion_cache_key
+
+PAYLOAD = {
+    "generated_code": "{ pub extrinsics: Vec<Extrinsic>}",
+    "kg_edges": [["Substrate", "Allows building", "Application-specific blockchains"]] * 6,
+    "subgraph_plot": "",
+}
+
+
+def start_fake_redis() -> str:
+    """Start a fakeredis TCP server in a daemon thread and return its URL."""
+    from fakeredis import TcpFakeServer
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = TcpFakeServer(("127.0.0.1", port))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"redis://127.0.0.1:{port}/0"
+
+
+# Legacy path, as previously implemented in api/app.py
+async def legacy_request(prefix_code: str):
+    loop = asyncio.get_event_loop()
+    with ProcessPoolExecutor() as pool:
+        cache_key = await loop.run_in_executor(pool, generate_cache_key, prefix_code)
+    with ProcessPoolExecutor() as pool:
+        cached = await loop.run_in_executor(pool, redis_cache.get_cached_result, cache_key)
+    if cached is None:
+        with ProcessPoolExecutor() as pool:
+            await loop.run_in_executor(pool, redis_cache.set_cache_result, cache_key, PAYLOAD)
+
+
+async def pooled_request(cache: AsyncRedisCache, prefix_code: str):
+    cache_key = completion_cache_key(prefix_code, "bench")
+    cached = await cache.get(cache_key)
+    if cached is None:
+        await cache.set(cache_key, PAYLOAD, namespace="bench")
+
+
+async def run(name, handler, n_requests, concurrency, hit_ratio):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    n_distinct = max(1, int(n_requests * (1 - hit_ratio)))
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            await handler(f"{name} pub struct Block<Header, Extrinsic> {{ {i % n_distinct}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n_requests)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "path": name,
+        "requests": n_requests,
+        "throughput_rps": round(n_requests / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+    }
+
+
+async def main(args):
+    url = args.redis_url or start_fake_redis()
+    # Forked pool workers inherit the module-level client
+    redis_cache.redis_client = redis.Redis.from_url(url)
+    cache = AsyncRedisCache(url=url, max_connections=args.concurrency)
+
+    results = []
+    if not args.skip_legacy:
+        results.append(await run("legacy_process_pool", legacy_request, args.requests, args.concurrency, args.hit_ratio))
+    results.append(await run("async_pooled", lambda p: pooled_request(cache, p), args.requests, args.concurrency, args.hit_ratio))
+    await cache.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--redis-url", default=None, help="Use this Redis instead of a fakeredis stand-in")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--hit-ratio", type=float, default=0.5)
+    parser.add_argument("--skip-legacy", action="store_true")
+    asyncio.run(main(parser.parse_args()))
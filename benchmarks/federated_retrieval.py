@@ -0,0 +1,122 @@
+"""
+Retrieval from several named KGs: one after another versus FederatedRetriever's concurrent fan-out.
+
+The KGs `--kgs` in `--root` (laid out as load_and_persist_kg.py persists them) are loaded
+through a KGRegistry with a memory budget of `--budget-mb`, first cold and then resident.
+Retrievers extract keywords locally and embed queries with a hashing model that sleeps
+`--embed-latency-ms` per call, standing in for the embedding API, so the benchmark needs no
+credentials. Every query is answered by each KG in turn, as a ComposableGraph's sub-queries
+are, and by a FederatedRetriever over all of them. Times are per query, in milliseconds,
+with the median retrieval time of each KG inside the fan-out.
+
+    python -m benchmarks.federated_retrieval --root /home/ubuntu/dApp/knowledge_graph_data --kgs Astar polkadot-sdk
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import hashlib
+import statistics
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def hashing_embedding(dim: int, latency_ms: float):
+    """A MockEmbedding of `dim` floats per text, stable across calls, taking `latency_ms` per call."""
+    from llama_index.core.embeddings import MockEmbedding
+
+    class HashingEmbedding(MockEmbedding):
+        def _vector(self, text):
+            time.sleep(latency_ms / 1000)
+            seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+            return np.random.default_rng(seed).standard_normal(self.embed_dim).tolist()
+
+        def _get_text_embedding(self, text):
+            return self._vector(text)
+
+        def _get_query_embedding(self, query):
+            return self._vector(query)
+
+    return HashingEmbedding(embed_dim=dim)
+
+
+def main(args):
+    from llama_index.core import Settings, StorageContext, load_index_from_storage
+    from llama_index.core.llms import MockLLM
+    from jinja2 import Template
+    from benchmarks.keyword_extraction_eval import sample_prefixes
+    from common.kg_registry import KGRegistry, FederatedRetriever, kg_dir, estimate_kg_bytes
+    from common.keyword_extraction import EntityIndex, RustKeywordExtractor
+    from common.retrieval import EmbeddingMatrix, kg_retriever
+
+    Settings.llm = MockLLM()
+    # Replaced per KG by a model of its embedding size
+    Settings.embed_model = hashing_embedding(8, args.embed_latency_ms)
+    indexes = {}
+
+    def loader(name):
+        kg_index = load_index_from_storage(StorageContext.from_defaults(persist_dir=kg_dir(args.root, name)))
+        embedding_matrix = EmbeddingMatrix.from_embedding_dict(kg_index.index_struct.embedding_dict)
+        dim = embedding_matrix.matrix.shape[1] if len(embedding_matrix) else 8
+        indexes[name] = kg_index
+        return kg_retriever(
+            kg_index, embedding_matrix=embedding_matrix,
+            keyword_extractor=RustKeywordExtractor(EntityIndex.from_index(kg_index)),
+            embed_model=hashing_embedding(dim, args.embed_latency_ms),
+            include_text=True, similarity_top_k=args.similarity_top_k, fusion="rrf",
+        )
+
+    registry = KGRegistry(loader, lambda name: estimate_kg_bytes(kg_dir(args.root, name)), args.budget_mb * 2**20)
+    started_at = time.perf_counter()
+    retriever = FederatedRetriever(registry, args.kgs, top_k=args.top_k, max_chunks=args.max_chunks)
+    retriever._load()
+    results = {"kgs": args.kgs, "cold_load_s": round(time.perf_counter() - started_at, 3), "registry": registry.stats()}
+    prompt_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code_generation", "prompts", "code_completion.prompt")
+    with open(prompt_path) as file:
+        template = Template(file.read())
+    # The same number of prefixes from every KG
+    per_kg_queries = -(-args.queries // len(args.kgs))
+    queries = [template.render({"prefix_code": prefix})
+               for name in args.kgs for prefix in sample_prefixes(indexes[name], per_kg_queries, args.seed)]
+
+    sequential, federated, per_kg = [], [], {name: [] for name in args.kgs}
+    for query in queries:
+        started_at = time.perf_counter()
+        for name in args.kgs:
+            registry.get(name).retriever.retrieve(query)
+        sequential.append((time.perf_counter() - started_at) * 1000)
+
+        retriever = FederatedRetriever(registry, args.kgs, top_k=args.top_k, max_chunks=args.max_chunks)
+        started_at = time.perf_counter()
+        retriever.retrieve(query)
+        federated.append((time.perf_counter() - started_at) * 1000)
+        for name, timings in retriever.timings.items():
+            per_kg[name].append(timings.get("retrieve_ms", 0.0))
+        print(json.dumps({"sequential_ms": round(sequential[-1], 3), "federated_ms": round(federated[-1], 3)}), file=sys.stderr)
+
+    results.update({
+        "queries": len(queries),
+        "embed_latency_ms": args.embed_latency_ms,
+        "sequential_ms": round(statistics.median(sequential), 3),
+        "federated_ms": round(statistics.median(federated), 3),
+        "speedup": round(statistics.median(sequential) / statistics.median(federated), 2),
+        "per_kg_retrieve_ms": {name: round(statistics.median(timings), 3) for name, timings in per_kg.items()},
+    })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--root", required=True, help="Directory of the named KGs, KG_REGISTRY_DIR")
+    parser.add_argument("--kgs", nargs="+", required=True, help="Names of the KGs to query")
+    parser.add_argument("--budget-mb", type=int, default=4096, help="Memory budget of the registry")
+    parser.add_argument("--queries", type=int, default=20, help="Prefixes sampled from the KGs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--embed-latency-ms", type=float, default=50.0, help="Simulated latency of one query embedding")
+    parser.add_argument("--similarity-top-k", type=int, default=3)
+    parser.add_argument("--top-k", type=int, default=10, help="Triplets and text chunks kept per KG")
+    parser.add_argument("--max-chunks", type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,134 @@
+"""
+Load test for AsyncQueryRunner with a stubbed LLM.
+
+A minimal FastAPI app mirrors the `/v1/generate_code` call pattern: a cache-hit
+route, a health route and a completion route whose query engine sleeps for
+`--llm-latency` seconds like a Bedrock call would. For each concurrency level
+the test reports completion throughput and the latency of health checks and
+cache hits issued while the completions are in progress. The "blocking" rows
+call `engine.query()` directly in the endpoint, as the service did before.
+
+    python -m benchmarks.inference_load --requests 64 --llm-latency 0.2
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+import httpx
+from fastapi import FastAPI
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.concurrency import AsyncQueryRunner
+
+
+class StubResponse:
+    def __init__(self, response):
+        self.response = response
+
+
+class StubQueryEngine:
+    """Query engine whose only cost is a fixed, GIL-releasing LLM latency."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def query(self, query):
+        time.sleep(self.latency)
+        return StubResponse('{"fill_in_middle": "pub extrinsics: Vec<Extrinsic>"}')
+
+    async def aquery(self, query):
+        await asyncio.sleep(self.latency)
+        return StubResponse('{"fill_in_middle": "pub extrinsics: Vec<Extrinsic>"}')
+
+
+def build_app(engine, runner=None) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/cached")
+    async def cached():
+        return {"generated_code": "pub extrinsics: Vec<Extrinsic>"}
+
+    @app.post("/generate")
+    async def generate():
+        if runner is None:
+            response = engine.query("prefix")
+        else:
+            response = await runner.query(engine, "prefix")
+        return {"generated_code": response.response}
+
+    return app
+
+
+async def probe(client, path, stop, latencies, interval=0.01):
+    # Latency is measured from when the probe was due, so time spent waiting
+    # for a blocked event loop is included.
+    due = time.perf_counter()
+    while True:
+        await client.get(path)
+        latencies.append(time.perf_counter() - due)
+        if stop.is_set():
+            break
+        due = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+
+
+async def run_level(name, app, n_requests, concurrency):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        semaphore = asyncio.Semaphore(concurrency)
+        stop = asyncio.Event()
+        health_latencies, cache_latencies = [], []
+        probes = [
+            asyncio.ensure_future(probe(client, "/", stop, health_latencies)),
+            asyncio.ensure_future(probe(client, "/cached", stop, cache_latencies)),
+        ]
+
+        async def one():
+            async with semaphore:
+                await client.post("/generate")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(n_requests)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await asyncio.gather(*probes)
+
+    return {
+        "path": name,
+        "concurrency": concurrency,
+        "throughput_rps": round(n_requests / elapsed, 2),
+        "health_p50_ms": round(statistics.median(health_latencies) * 1000, 2),
+        "health_max_ms": round(max(health_latencies) * 1000, 2),
+        "cache_hit_p50_ms": round(statistics.median(cache_latencies) * 1000, 2),
+    }
+
+
+async def main(args):
+    engine = StubQueryEngine(args.llm_latency)
+    results = []
+    for concurrency in args.levels:
+        if concurrency == args.levels[0] or not args.skip_blocking:
+            results.append(await run_level("blocking", build_app(engine), args.requests, concurrency))
+        runner = AsyncQueryRunner(max_concurrency=concurrency, mode=args.mode)
+        results.append(await run_level(f"runner_{args.mode}", build_app(engine, runner), args.requests, concurrency))
+        runner.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--mode", choices=AsyncQueryRunner.MODES, default="thread")
+    parser.add_argument("--skip-blocking", action="store_true", help="Only run the blocking baseline at the first level")
+    asyncio.run(main(parser.parse_args()))
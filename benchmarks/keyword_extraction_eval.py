@@ -0,0 +1,174 @@
+"""
+Offline evaluation of local keyword extraction against the LLM keyword path.
+
+Each query is code_completion.prompt rendered with one prefix. Prefixes come
+from `--prefixes` (a JSON lines file of {"prefix_code": ...}), or else from
+the first half of `--samples` random text chunks of the KG. The LLM keywords
+are the reference. For each query, the same KGRetriever retrieves once with
+the LLM keywords and once with the RustKeywordExtractor keywords. The report
+covers:
+
+- how many of the reference triplets (`kg_rel_texts`) and text chunks the local
+  keywords also retrieve (recall), and how many of theirs are in the reference
+  (precision)
+- the overlap of the keywords themselves
+- the latency of both extractors
+
+It calls the configured LLM once per query.
+
+    python -m benchmarks.keyword_extraction_eval --samples 100 --output eval.jsonl
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FixedKeywords:
+    """Keyword extractor returning keywords extracted beforehand, so both paths retrieve the same way."""
+
+    def __init__(self):
+        self.keywords = []
+
+    def extract(self, text, max_keywords=10):
+        return self.keywords[:max_keywords]
+
+
+def sample_prefixes(kg_index, n: int, seed: int = 0) -> list:
+    """The first half of the lines of `n` random text chunks of the KG."""
+    node_ids = sorted({node_id for node_ids in kg_index.index_struct.table.values() for node_id in node_ids})
+    node_ids = random.Random(seed).sample(node_ids, min(n, len(node_ids)))
+    prefixes = []
+    for node in kg_index.docstore.get_nodes(node_ids):
+        lines = node.get_content().splitlines()
+        prefixes.append("\n".join(lines[: max(1, len(lines) // 2)]))
+    return prefixes
+
+
+def retrieved(nodes) -> tuple:
+    """Triplets and text chunk IDs of a retrieval result."""
+    triplets, chunks = set(), set()
+    for node in nodes:
+        if "kg_rel_texts" in node.node.metadata:
+            triplets.update(node.node.metadata["kg_rel_texts"])
+        elif node.node.get_content() != "No relationships found.":
+            chunks.add(node.node.node_id)
+    return triplets, chunks
+
+
+def overlap(found: set, reference: set) -> tuple:
+    """Precision and recall of `found` against `reference`; 1.0 when both are empty."""
+    common = len(found & reference)
+    precision = common / len(found) if found else float(not reference)
+    recall = common / len(reference) if reference else float(not found)
+    return precision, recall
+
+
+def evaluate(kg_index, template, prefixes: list, retriever_mode: str = "hybrid", similarity_top_k: int = 3,
+             graph_store_query_depth: int = 1) -> tuple:
+    from common.keyword_extraction import EntityIndex, RustKeywordExtractor, normalize
+    from common.retrieval import EmbeddingMatrix, KGRetriever
+
+    started_at = time.perf_counter()
+    extractor = RustKeywordExtractor(EntityIndex.from_index(kg_index))
+    entity_index_s = time.perf_counter() - started_at
+    kwargs = dict(object_map=kg_index._object_map, llm=kg_index._llm, embed_model=kg_index._embed_model,
+                  retriever_mode=retriever_mode, include_text=True, similarity_top_k=similarity_top_k,
+                  graph_store_query_depth=graph_store_query_depth)
+    embedding_matrix = EmbeddingMatrix.from_embedding_dict(kg_index.index_struct.embedding_dict)
+    llm_retriever = KGRetriever(kg_index, embedding_matrix=embedding_matrix, **kwargs)
+    keywords = FixedKeywords()
+    retriever = KGRetriever(kg_index, embedding_matrix=embedding_matrix, keyword_extractor=keywords, **kwargs)
+
+    rows = []
+    for prefix in prefixes:
+        query = template.render({"prefix_code": prefix})
+        started_at = time.perf_counter()
+        llm_keywords = llm_retriever._get_keywords(query)
+        llm_s = time.perf_counter() - started_at
+        started_at = time.perf_counter()
+        local_keywords = extractor.extract(query, llm_retriever.max_keywords_per_query)
+        local_s = time.perf_counter() - started_at
+
+        keywords.keywords = llm_keywords
+        reference_triplets, reference_chunks = retrieved(retriever.retrieve(query))
+        keywords.keywords = local_keywords
+        triplets, chunks = retrieved(retriever.retrieve(query))
+
+        triplet_precision, triplet_recall = overlap(triplets, reference_triplets)
+        chunk_precision, chunk_recall = overlap(chunks, reference_chunks)
+        _, keyword_recall = overlap({normalize(k) for k in local_keywords}, {normalize(k) for k in llm_keywords})
+        rows.append({
+            "prefix_code": prefix,
+            "llm_keywords": llm_keywords,
+            "local_keywords": local_keywords,
+            "keyword_recall": keyword_recall,
+            "triplet_precision": triplet_precision,
+            "triplet_recall": triplet_recall,
+            "chunk_precision": chunk_precision,
+            "chunk_recall": chunk_recall,
+            "llm_ms": llm_s * 1000,
+            "local_ms": local_s * 1000,
+        })
+
+    mean = lambda key: round(statistics.mean(row[key] for row in rows), 3) if rows else None
+    median = lambda key: round(statistics.median(row[key] for row in rows), 3) if rows else None
+    summary = {
+        "queries": len(rows),
+        "retriever_mode": retriever_mode,
+        "entities": len(extractor.entity_index),
+        "entity_index_s": round(entity_index_s, 3),
+        "keyword_recall": mean("keyword_recall"),
+        "triplet_precision": mean("triplet_precision"),
+        "triplet_recall": mean("triplet_recall"),
+        "chunk_precision": mean("chunk_precision"),
+        "chunk_recall": mean("chunk_recall"),
+        "no_local_keywords": sum(not row["local_keywords"] for row in rows),
+        "llm_keyword_ms_median": median("llm_ms"),
+        "local_keyword_ms_median": median("local_ms"),
+    }
+    return summary, rows
+
+
+def main(args):
+    from common.config import configure_settings
+    from common.inference import template, load_kg_index_from_disk
+
+    configure_settings()
+    if args.persist_dir:
+        from llama_index.core import StorageContext, load_index_from_storage
+        kg_index = load_index_from_storage(StorageContext.from_defaults(persist_dir=args.persist_dir))
+    else:
+        kg_index = load_kg_index_from_disk()
+
+    if args.prefixes:
+        with open(args.prefixes) as f:
+            prefixes = [json.loads(line)["prefix_code"] for line in f if line.strip()]
+    else:
+        prefixes = sample_prefixes(kg_index, args.samples, args.seed)
+
+    summary, rows = evaluate(kg_index, template, prefixes, retriever_mode=args.retriever_mode,
+                             similarity_top_k=args.similarity_top_k, graph_store_query_depth=args.depth)
+    if args.output:
+        with open(args.output, "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--persist-dir", help="KG to evaluate, the one the API serves by default")
+    parser.add_argument("--prefixes", help="JSON lines file of {\"prefix_code\": ...}")
+    parser.add_argument("--samples", type=int, default=50, help="Prefixes sampled from the KG without --prefixes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--retriever-mode", choices=["keyword", "hybrid"], default="hybrid")
+    parser.add_argument("--similarity-top-k", type=int, default=3)
+    parser.add_argument("--depth", type=int, default=1, help="graph_store_query_depth")
+    parser.add_argument("--output", help="Write the per-query results to this JSON lines file")
+    main(parser.parse_args())
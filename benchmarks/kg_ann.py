@@ -0,0 +1,86 @@
+"""
+Recall and latency of the IVF ANN index against exact triplet embedding search.
+
+Synthetic embeddings are drawn around `size / 50` random topic centres, and
+each query is a perturbed embedding, so the nearest neighbours are meaningful.
+For each quantization, the index is built once. Then every `--n-probe` and
+`--rerank` setting is compared with `EmbeddingMatrix.top_k`. The benchmark
+reports recall@k, median and p95 milliseconds per query, and the memory of
+the codes next to the float32 matrix.
+
+    python -m benchmarks.kg_ann --size 100000 --dim 1024 --n-probe 1 4 16 64
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def synthetic_embeddings(size: int, dim: int, n_queries: int, noise: float = 1.5, seed: int = 0):
+    """Clustered unit embeddings and queries near random ones."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((max(1, size // 50), dim)).astype(np.float32)
+    vectors = centres[rng.integers(len(centres), size=size)]
+    vectors += noise * rng.standard_normal((size, dim)).astype(np.float32)
+    queries = vectors[rng.integers(size, size=n_queries)] + noise * rng.standard_normal((n_queries, dim)).astype(np.float32)
+    return vectors, queries
+
+
+def timed(func, queries) -> tuple:
+    timings, results = [], []
+    for query in queries:
+        started_at = time.perf_counter()
+        results.append(func(query))
+        timings.append((time.perf_counter() - started_at) * 1000)
+    return results, round(float(np.median(timings)), 3), round(float(np.percentile(timings, 95)), 3)
+
+
+def main(args):
+    from common.ann_index import ANNIndex, build_ann_index
+    from common.retrieval import EmbeddingMatrix
+
+    vectors, queries = synthetic_embeddings(args.size, args.dim, args.queries)
+    ids = [f"('Entity{i}', 'uses', 'Entity{i + 1}')" for i in range(args.size)]
+    matrix = EmbeddingMatrix.from_embedding_dict(dict(zip(ids, vectors)))
+    expected, exact_ms, exact_p95 = timed(lambda q: set(matrix.top_k(q, args.top_k)[1]), queries)
+    results = {"size": args.size, "dim": args.dim, "top_k": args.top_k, "queries": args.queries,
+               "exact": {"ms": exact_ms, "p95_ms": exact_p95, "mb": round(matrix.matrix.nbytes / 2**20, 1)},
+               "ann": []}
+    print(json.dumps(results["exact"]), file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for quantization in args.quantization:
+            ann_dir = os.path.join(tmp, quantization)
+            manifest = build_ann_index(ids, vectors, ann_dir, n_lists=args.n_lists, quantization=quantization)
+            # Rows of the matrix follow `ids`, as a snapshot's follow the ANN index of its KG
+            index = ANNIndex(ann_dir, exact=matrix.matrix)
+            for n_probe in args.n_probe:
+                for rerank in args.rerank:
+                    found, ms, p95 = timed(lambda q: set(index.top_k(q, args.top_k, n_probe=n_probe, rerank=rerank)[1]), queries)
+                    recall = np.mean([len(a & b) / len(a) for a, b in zip(expected, found)])
+                    result = {"quantization": quantization, "n_lists": manifest["n_lists"], "n_probe": n_probe,
+                              "rerank": rerank, f"recall@{args.top_k}": round(float(recall), 4), "ms": ms,
+                              "p95_ms": p95, "speedup": round(exact_ms / ms, 1), "codes_mb": manifest["codes_mb"],
+                              "build_s": manifest["build_s"]}
+                    print(json.dumps(result), file=sys.stderr)
+                    results["ann"].append(result)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=1024, help="Embedding size (cohere.embed-multilingual-v3 uses 1024)")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--n-lists", type=int, default=None, help="Inverted lists, sqrt(size) by default")
+    parser.add_argument("--n-probe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--rerank", type=int, nargs="+", default=[0, 4])
+    parser.add_argument("--quantization", nargs="+", default=["int8", "float16"])
+    main(parser.parse_args())
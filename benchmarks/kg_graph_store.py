@@ -0,0 +1,127 @@
+"""
+Rel-map latency of SimpleGraphStore versus CSRGraphStore on power-law graphs.
+
+Synthetic KGs pick subjects and objects from a power-law distribution. A few hub
+entities, like "Rust" or "Substrate" in the real KG, therefore have thousands
+of edges, and most entities have one or two. Each store answers the same
+rel-map queries at every `--depths` value:
+
+- one hub subject
+- `--subjects` random subjects, as the keyword leg of a retriever sends them
+
+CSRGraphStore runs once per `--fanout` setting. The benchmark reports median
+and p95 milliseconds per query, how many triplets each query returned and how
+many triplet lists SimpleGraphStore built before truncating them to `limit`.
+It also reports build time and the memory of each store.
+
+    python -m benchmarks.kg_graph_store --edges 10000 100000 --depths 1 2 3
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def power_law_graph(n_edges: int, skew: float = 3.0, seed: int = 0) -> dict:
+    """
+    SimpleGraphStore `graph_dict` whose subjects and objects are entity `n * u ** skew` for
+    uniform `u`, so the probability of entity `i` falls off as a power of `i`.
+    """
+    rng = random.Random(seed)
+    n_entities = max(10, n_edges // 4)
+    relations = ["uses", "implements", "depends on", "is", "defines", "calls", "written in", "part of"]
+    pick = lambda: int(n_entities * rng.random() ** skew)
+    graph_dict = {}
+    for _ in range(n_edges):
+        graph_dict.setdefault(f"Entity{pick()}", []).append([rng.choice(relations), f"Entity{pick()}"])
+    return graph_dict
+
+
+def measure(func, queries) -> dict:
+    timings, sizes = [], []
+    for subjs, depth in queries:
+        started_at = time.perf_counter()
+        rel_map = func(subjs, depth)
+        timings.append((time.perf_counter() - started_at) * 1000)
+        sizes.append(sum(len(paths) for paths in rel_map.values()))
+    return {"ms": round(float(np.median(timings)), 3), "p95_ms": round(float(np.percentile(timings, 95)), 3),
+            "triplets": round(float(np.mean(sizes)), 1)}
+
+
+def built(factory) -> tuple:
+    """The store built by `factory`, with its build time and the memory it holds."""
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    store = factory()
+    build_s = time.perf_counter() - started_at
+    mb = tracemalloc.get_traced_memory()[0] / 2**20
+    tracemalloc.stop()
+    return store, round(build_s, 3), round(mb, 1)
+
+
+def run(n_edges: int, depths: list, fanouts: list, n_subjects: int, n_queries: int, limit: int) -> dict:
+    from llama_index.core.graph_stores import SimpleGraphStore
+    from llama_index.core.graph_stores.simple import SimpleGraphStoreData
+    from common.graph_store import CSRGraphStore
+
+    graph_dict = power_law_graph(n_edges)
+    hub = max(graph_dict, key=lambda subj: len(graph_dict[subj]))
+    rng = random.Random(1)
+    subjects = list(graph_dict)
+    query_sets = {
+        "hub": [[hub]] * n_queries,
+        "random": [rng.sample(subjects, min(n_subjects, len(subjects))) for _ in range(n_queries)],
+    }
+
+    # Deep copy, so SimpleGraphStore holds its own lists like after loading graph_store.json
+    simple, simple_build_s, simple_mb = built(lambda: SimpleGraphStore(SimpleGraphStoreData(json.loads(json.dumps(graph_dict)))))
+    result = {"edges": n_edges, "entities": len({s for s in graph_dict} | {o for e in graph_dict.values() for _, o in e}),
+              "hub": hub, "hub_degree": len(graph_dict[hub]),
+              "simple": {"build_s": simple_build_s, "mb": simple_mb}, "csr": {}}
+    csr_stores = {}
+    for fanout in fanouts:
+        store, build_s, mb = built(lambda: CSRGraphStore.from_graph_dict(graph_dict, fanout=fanout))
+        csr_stores[",".join(map(str, fanout))] = store
+        result["csr"].setdefault("build_s", build_s)
+        result["csr"].setdefault("mb", mb)
+
+    result["queries"] = []
+    for kind, subj_sets in query_sets.items():
+        for depth in depths:
+            queries = [(subjs, depth) for subjs in subj_sets]
+            row = {"query": kind, "depth": depth}
+            row["simple"] = measure(lambda subjs, d: simple.get_rel_map(subjs, d, limit), queries)
+            # Triplet lists SimpleGraphStore builds before truncating them to `limit`
+            row["simple"]["triplets_built"] = round(float(np.mean([
+                sum(len(simple._data._get_rel_map(subj, depth=d, limit=limit)) for subj in subjs) for subjs, d in queries
+            ])), 1)
+            for name, store in csr_stores.items():
+                row[f"csr[{name}]"] = measure(lambda subjs, d: store.get_rel_map(subjs, d, limit), queries)
+                row[f"csr[{name}]"]["speedup"] = round(row["simple"]["ms"] / max(row[f"csr[{name}]"]["ms"], 1e-6), 1)
+            print(json.dumps(row), file=sys.stderr)
+            result["queries"].append(row)
+    return result
+
+
+def main(args):
+    fanouts = [tuple(int(cap) for cap in fanout.split(",")) for fanout in args.fanout]
+    results = [run(n_edges, args.depths, fanouts, args.subjects, args.queries, args.limit) for n_edges in args.edges]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--edges", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument("--fanout", nargs="+", default=["10,5,3", "30,10,5"], help="Comma-separated caps per depth")
+    parser.add_argument("--subjects", type=int, default=10, help="Subjects per random query")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=30, help="Triplets per rel-map query, as retrievers request")
+    main(parser.parse_args())
@@ -0,0 +1,119 @@
+"""
+Time and payload of the full-KG plot versus the precomputed layout and its slices.
+
+For power-law graphs of each `--edges` size (see benchmarks/kg_graph_store.py) the report gives:
+
+- the baseline: what `plot_full_kg` did on every call, a pyvis page of the whole graph
+  laid out by force-atlas in the browser (skipped above `--baseline-max-edges`: pyvis
+  compares every new edge with all earlier ones, which takes minutes at 100k edges);
+- the offline build: seconds, size on disk and communities found;
+- serving: milliseconds to memory-map the layout and, per slice, the median milliseconds
+  and JSON kilobytes of the first and a middle page of `--limit` nodes, of a viewport over
+  the whole graph and of a zoomed-in one (a tenth of its width), and of the community overview.
+
+    python -m benchmarks.kg_layout --edges 10000 100000 1000000 --limit 1000
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import statistics
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def timed(func, repeat: int = 1) -> tuple:
+    """Median milliseconds of `func()` over `repeat` calls, and its last result."""
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - started_at) * 1000)
+    return round(statistics.median(timings), 2), result
+
+
+def payload_kb(result) -> float:
+    return round(len(json.dumps(result, separators=(',', ':'))) / 1024, 1)
+
+
+def directory_mb(path: str) -> float:
+    return round(sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) / 2**20, 1)
+
+
+def baseline(graph_dict: dict) -> dict:
+    """The pyvis page `plot_full_kg` built from the whole graph."""
+    import networkx as nx
+    from pyvis.network import Network
+
+    def plot():
+        graph = nx.DiGraph()
+        for subj, edges in graph_dict.items():
+            for rel, obj in edges:
+                graph.add_edge(subj, obj, label=rel)
+        net = Network(notebook=False, cdn_resources="remote", height="500px", width="60%", select_menu=True, filter_menu=False)
+        net.from_nx(graph)
+        net.force_atlas_2based(central_gravity=0.015, gravity=-31)
+        return net.generate_html()
+
+    ms, html = timed(plot)
+    return {"ms": ms, "kb": round(len(html) / 1024, 1)}
+
+
+def run(n_edges: int, limit: int, repeat: int, baseline_max_edges: int, work_dir: str) -> dict:
+    from benchmarks.kg_graph_store import power_law_graph
+    from common.kg_layout import build_kg_layout, KGLayout
+
+    graph_dict = power_law_graph(n_edges)
+    result = {"edges": n_edges}
+    if n_edges <= baseline_max_edges:
+        result["pyvis_full_graph"] = baseline(graph_dict)
+        print(json.dumps(result), file=sys.stderr)
+
+    layout_dir = os.path.join(work_dir, f"layout_{n_edges}")
+    build_ms, manifest = timed(lambda: build_kg_layout(graph_dict, layout_dir))
+    result["build"] = {"s": round(build_ms / 1000, 2), "mb": directory_mb(layout_dir), "nodes": manifest["nodes"],
+                       "communities": manifest["communities"], "largest_community": manifest["largest_community"]}
+    load_ms, layout = timed(lambda: KGLayout(layout_dir))
+    result["load_ms"] = load_ms
+
+    x0, y0, x1, y1 = manifest["bounds"]
+    rng = random.Random(0)
+    cx, cy = (float(v) for v in layout.positions[rng.randrange(len(layout))])
+    half = (x1 - x0) / 20
+    slices = {
+        "first_page": lambda: layout.page(0, limit),
+        "middle_page": lambda: layout.page(len(layout) // 2, limit),
+        "viewport_all": lambda: layout.viewport(x0, y0, x1, y1, limit=limit),
+        "viewport_zoomed": lambda: layout.viewport(cx - half, cy - half, cx + half, cy + half, limit=limit),
+        "communities": lambda: layout.communities(100),
+    }
+    for name, func in slices.items():
+        ms, sliced = timed(func, repeat)
+        result[name] = {"ms": ms, "kb": payload_kb(sliced), "nodes": len(sliced.get("nodes", sliced.get("communities", []))),
+                        "edges": len(sliced.get("edges", []))}
+    print(json.dumps(result), file=sys.stderr)
+    shutil.rmtree(layout_dir, ignore_errors=True)
+    return result
+
+
+def main(args):
+    work_dir = tempfile.mkdtemp(prefix="kg_layout_")
+    try:
+        results = [run(n_edges, args.limit, args.repeat, args.baseline_max_edges, work_dir) for n_edges in args.edges]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--edges", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--limit", type=int, default=1000, help="Nodes per page or viewport")
+    parser.add_argument("--repeat", type=int, default=10, help="Calls per slice")
+    parser.add_argument("--baseline-max-edges", type=int, default=10000,
+                        help="Largest graph to build the full pyvis page of")
+    main(parser.parse_args())
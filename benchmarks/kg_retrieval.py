@@ -0,0 +1,100 @@
+"""
+Top-k triplet embedding search: KGTableRetriever versus EmbeddingMatrix.
+
+For each KG size a random embedding dict (triplet text -> `--dim` floats, as
+persisted by llama_index) is searched the way KGTableRetriever's embedding leg
+does it, by collecting every embedding into a list and calling
+`get_top_k_embeddings`, and with `EmbeddingMatrix.top_k` (one matrix-vector
+product plus `argpartition`) and `EmbeddingMatrix.top_k_batch` for
+`--batch` queries at once. Every query must return the same triplets from
+all three. Times are per query, in milliseconds.
+
+    python -m benchmarks.kg_retrieval --sizes 1000 10000 100000 --dim 1024
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def llama_index_top_k(embedding_dict: dict, query: list, k: int) -> list:
+    """The embedding leg of KGTableRetriever._retrieve."""
+    from llama_index.core.indices.query.embedding_utils import get_top_k_embeddings
+
+    all_rel_texts = list(embedding_dict.keys())
+    rel_text_embeddings = [embedding_dict[_id] for _id in all_rel_texts]
+    _, top_rel_texts = get_top_k_embeddings(query, rel_text_embeddings, similarity_top_k=k, embedding_ids=all_rel_texts)
+    return top_rel_texts
+
+
+def per_query_ms(func, queries) -> tuple:
+    """Median and max milliseconds of `func(query)` over `queries`, and the results."""
+    timings, results = [], []
+    for query in queries:
+        started_at = time.perf_counter()
+        results.append(func(query))
+        timings.append((time.perf_counter() - started_at) * 1000)
+    return round(statistics.median(timings), 3), round(max(timings), 3), results
+
+
+def run(size: int, dim: int, k: int, n_queries: int, batch: int, seed: int = 0) -> dict:
+    from common.retrieval import EmbeddingMatrix
+
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((size, dim)).astype(np.float32)
+    # JSON-loaded embeddings are lists of Python floats
+    embedding_dict = {f"('Entity{i}', 'uses', 'Entity{i + 1}')": vectors[i].tolist() for i in range(size)}
+    queries = rng.standard_normal((n_queries, dim)).astype(np.float32).tolist()
+
+    started_at = time.perf_counter()
+    matrix = EmbeddingMatrix.from_embedding_dict(embedding_dict)
+    build_s = time.perf_counter() - started_at
+
+    upstream_median, upstream_max, expected = per_query_ms(lambda q: llama_index_top_k(embedding_dict, q, k), queries)
+    matrix_median, matrix_max, found = per_query_ms(lambda q: matrix.top_k(q, k)[1], queries)
+
+    batches = [queries[i:i + batch] for i in range(0, n_queries, batch)]
+    started_at = time.perf_counter()
+    batched = [ids for queries_batch in batches for _, ids in matrix.top_k_batch(queries_batch, k)]
+    batch_ms = (time.perf_counter() - started_at) * 1000 / n_queries
+
+    # Equal scores may be ordered differently, so compare as sets
+    if any(set(a) != set(b) or set(a) != set(c) for a, b, c in zip(expected, found, batched)):
+        raise AssertionError(f"Top-{k} triplets differ at size {size}")
+
+    return {
+        "size": size,
+        "matrix_build_s": round(build_s, 3),
+        "matrix_mb": round(matrix.matrix.nbytes / 2**20, 1),
+        "llama_index_ms": upstream_median,
+        "llama_index_max_ms": upstream_max,
+        "matrix_ms": matrix_median,
+        "matrix_max_ms": matrix_max,
+        f"matrix_batch{batch}_ms": round(batch_ms, 3),
+        "speedup": round(upstream_median / matrix_median, 1),
+    }
+
+
+def main(args):
+    results = []
+    for size in args.sizes:
+        result = run(size, args.dim, args.top_k, args.queries, args.batch)
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+    print(json.dumps({"dim": args.dim, "top_k": args.top_k, "queries": args.queries, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--dim", type=int, default=1024, help="Embedding size (cohere.embed-multilingual-v3 uses 1024)")
+    parser.add_argument("--top-k", type=int, default=3, help="similarity_top_k of the query engines")
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=10)
+    main(parser.parse_args())
@@ -0,0 +1,184 @@
+"""
+Load time and memory of the JSON KG index versus the memory-mapped snapshot.
+
+A synthetic KG (triplets with `--dim` embeddings, text chunks and a keyword
+table) is persisted in the llama_index JSON format and compiled into a
+snapshot. For each path, `--workers` processes load the index at the same
+time, as uvicorn workers would, then run one hybrid-style lookup that touches
+every embedding. Each worker reports its load time, RSS, private (anonymous)
+memory and PSS, which splits shared pages evenly between the processes
+mapping them. The sum of PSS is the memory the workers really cost together.
+
+    python -m benchmarks.kg_snapshot_load --triplets 5000 --dim 1024 --workers 4
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def memory_mb() -> dict:
+    """RSS, anonymous and file-backed RSS, and PSS of this process in MB (Linux only)."""
+    usage = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "RssAnon", "RssFile"):
+                usage[key] = int(value.split()[0]) / 1024
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                usage["Pss"] = int(line.split()[1]) / 1024
+    return {"rss_mb": round(usage["VmRSS"], 1), "anon_mb": round(usage["RssAnon"], 1),
+            "file_mb": round(usage["RssFile"], 1), "pss_mb": round(usage["Pss"], 1)}
+
+
+def build_kg(persist_dir: str, n_triplets: int, dim: int, seed: int = 0):
+    """Persist a synthetic KnowledgeGraphIndex in the llama_index JSON layout."""
+    from llama_index.core.schema import TextNode
+    from llama_index.core.storage.docstore.utils import doc_to_json
+
+    rng = random.Random(seed)
+    n_entities = max(10, n_triplets // 4)
+    entities = [f"Entity{i}" for i in range(n_entities)]
+    relations = ["uses", "implements", "depends on", "is", "defines", "calls"]
+    n_nodes = max(1, n_triplets // 3)
+    node_ids = [f"node-{i:08d}" for i in range(n_nodes)]
+
+    graph_dict, table, embedding_dict = {}, {}, {}
+    vectors = np.random.default_rng(seed).standard_normal((n_triplets, dim)).astype(np.float32)
+    for i in range(n_triplets):
+        # Power-law-ish subjects so a few hub entities have many edges
+        subj = entities[min(int(rng.paretovariate(1.2)) - 1, n_entities - 1)]
+        rel, obj = rng.choice(relations), rng.choice(entities)
+        graph_dict.setdefault(subj, []).append([rel, obj])
+        node_id = node_ids[i % n_nodes]
+        for keyword in (subj, obj):
+            table.setdefault(keyword, set()).add(node_id)
+        embedding_dict[str((subj, rel, obj))] = vectors[i].tolist()
+
+    docstore = {"docstore/data": {}, "docstore/metadata": {}, "docstore/ref_doc_info": {}}
+    for i, node_id in enumerate(node_ids):
+        node = TextNode(id_=node_id, text=f"pub fn item_{i}() -> Result<(), Error> {{ /* chunk {i} */ }}", metadata={"file": f"src/lib_{i % 50}.rs"})
+        docstore["docstore/data"][node_id] = doc_to_json(node)
+        docstore["docstore/metadata"][node_id] = {"doc_hash": node.hash}
+
+    index_struct = {"index_id": "bench", "summary": None, "table": {k: sorted(v) for k, v in table.items()}, "rel_map": {}, "embedding_dict": embedding_dict}
+    os.makedirs(persist_dir, exist_ok=True)
+    with open(os.path.join(persist_dir, "index_store.json"), "w") as f:
+        json.dump({"index_store/data": {"bench": {"__type__": "kg", "__data__": json.dumps(index_struct)}}}, f)
+    with open(os.path.join(persist_dir, "graph_store.json"), "w") as f:
+        json.dump({"graph_dict": graph_dict}, f)
+    with open(os.path.join(persist_dir, "docstore.json"), "w") as f:
+        json.dump(docstore, f)
+    for name in ("default__vector_store.json", "image__vector_store.json"):
+        with open(os.path.join(persist_dir, name), "w") as f:
+            json.dump({"embedding_dict": {}, "text_id_to_ref_doc_id": {}, "metadata_dict": {}}, f)
+
+
+def worker(path: str, directory: str, dim: int):
+    """Load the index one way, touch all of it once and report timings and memory."""
+    from llama_index.core import Settings, StorageContext, load_index_from_storage
+    from llama_index.core.embeddings import MockEmbedding
+    from llama_index.core.llms import MockLLM
+    from common.kg_snapshot import KGSnapshot
+
+    Settings.llm = MockLLM()
+    Settings.embed_model = MockEmbedding(embed_dim=dim)
+    before = memory_mb()
+    started_at = time.perf_counter()
+    if path == "json":
+        index = load_index_from_storage(StorageContext.from_defaults(persist_dir=directory))
+    else:
+        index = KGSnapshot(directory).load_index()
+    load_s = time.perf_counter() - started_at
+
+    # What one hybrid query reads: every triplet embedding, a rel map and a few text chunks
+    started_at = time.perf_counter()
+    query = np.ones(dim, dtype=np.float32)
+    embedding_dict = index.index_struct.embedding_dict
+    best = max(embedding_dict, key=lambda triplet: float(np.dot(query, embedding_dict[triplet])))
+    index.graph_store.get_rel_map(["Entity0", "Entity1"], depth=2)
+    node_ids = list(index.index_struct.table["Entity0"])[:10]
+    index.docstore.get_nodes(node_ids)
+    first_query_s = time.perf_counter() - started_at
+
+    report = {"path": path, "load_s": round(load_s, 3), "first_query_s": round(first_query_s, 3),
+              "baseline_rss_mb": before["rss_mb"], **memory_mb(), "best": best}
+    print(json.dumps(report), flush=True)
+    # Stay alive until every worker has reported so shared pages are counted once per worker
+    sys.stdin.read()
+
+
+def run_workers(path: str, directory: str, n_workers: int, dim: int) -> list:
+    procs = [
+        subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.kg_snapshot_load", "--worker", path, "--dir", directory, "--dim", str(dim)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+        for _ in range(n_workers)
+    ]
+    reports = [json.loads(proc.stdout.readline()) for proc in procs]
+    for proc in procs:
+        proc.stdin.close()
+        proc.wait()
+    return reports
+
+
+def main(args):
+    from common.kg_snapshot import compile_snapshot
+
+    with tempfile.TemporaryDirectory() as tmp:
+        persist_dir = os.path.join(tmp, "kg")
+        snapshot_dir = os.path.join(tmp, "kg_snapshot")
+        started_at = time.perf_counter()
+        build_kg(persist_dir, args.triplets, args.dim)
+        json_mb = sum(os.path.getsize(os.path.join(persist_dir, f)) for f in os.listdir(persist_dir)) / 2**20
+        print(f"built {args.triplets} triplets in {time.perf_counter() - started_at:.1f}s, JSON {json_mb:.1f} MB", file=sys.stderr)
+
+        started_at = time.perf_counter()
+        compile_snapshot(persist_dir, snapshot_dir)
+        snapshot_mb = sum(os.path.getsize(os.path.join(snapshot_dir, f)) for f in os.listdir(snapshot_dir)) / 2**20
+        compile_s = time.perf_counter() - started_at
+
+        results = {"triplets": args.triplets, "dim": args.dim, "workers": args.workers,
+                   "json_mb": round(json_mb, 1), "snapshot_mb": round(snapshot_mb, 1), "compile_s": round(compile_s, 2)}
+        for path, directory in (("json", persist_dir), ("snapshot", snapshot_dir)):
+            reports = run_workers(path, directory, args.workers, args.dim)
+            if len({report["best"] for report in reports}) != 1:
+                raise AssertionError("Workers disagree on the best triplet")
+            results[path] = {
+                "load_s_max": max(r["load_s"] for r in reports),
+                "first_query_s_max": max(r["first_query_s"] for r in reports),
+                "rss_mb_per_worker": max(r["rss_mb"] for r in reports),
+                "rss_growth_mb_per_worker": max(round(r["rss_mb"] - r["baseline_rss_mb"], 1) for r in reports),
+                "private_mb_per_worker": max(r["anon_mb"] for r in reports),
+                "pss_mb_total": round(sum(r["pss_mb"] for r in reports), 1),
+                "best": reports[0]["best"],
+            }
+        if results["json"]["best"] != results["snapshot"]["best"]:
+            raise AssertionError("JSON and snapshot paths retrieved different triplets")
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--triplets", type=int, default=5000)
+    parser.add_argument("--dim", type=int, default=1024, help="Embedding size (cohere.embed-multilingual-v3 uses 1024)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--worker", choices=["json", "snapshot"], help=argparse.SUPPRESS)
+    parser.add_argument("--dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        worker(args.worker, args.dir, args.dim)
+    else:
+        main(args)
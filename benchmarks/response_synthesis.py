@@ -0,0 +1,106 @@
+"""
+LLM calls and prompt tokens of "refine" versus packed single-call response synthesis.
+
+Both synthesizers answer the same retrieved nodes for every query: code_completion.prompt
+rendered with `--samples` prefixes of KG text chunks. The LLM is a MockLLM that records
+the prompts instead of calling the model, so the benchmark needs no credentials. The
+report gives, per mode and `--budgets` value, the LLM calls and prompt tokens per query,
+and for packed synthesis what was left out of the budget.
+
+    python -m benchmarks.response_synthesis --samples 50 --budgets 1000 2000 3000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def recording_llm():
+    """A MockLLM that keeps every prompt it is sent."""
+    from llama_index.core.llms import MockLLM
+
+    class RecordingLLM(MockLLM):
+        prompts: list = []
+
+        def complete(self, prompt, formatted=False, **kwargs):
+            self.prompts.append(prompt)
+            return super().complete(prompt, formatted=formatted, **kwargs)
+
+    return RecordingLLM(max_tokens=16)
+
+
+def run(synthesizer, llm, tokenizer, queries) -> dict:
+    calls, tokens, timings = [], [], []
+    for query, nodes in queries:
+        llm.prompts.clear()
+        started_at = time.perf_counter()
+        synthesizer.synthesize(query, nodes)
+        timings.append((time.perf_counter() - started_at) * 1000)
+        calls.append(len(llm.prompts))
+        tokens.append(sum(len(tokenizer(prompt)) for prompt in llm.prompts))
+    return {
+        "llm_calls": round(statistics.mean(calls), 2),
+        "max_llm_calls": max(calls),
+        "prompt_tokens": round(statistics.mean(tokens), 1),
+        "synthesis_ms_excluding_llm": round(statistics.median(timings), 3),
+    }
+
+
+def main(args):
+    from llama_index.core import PromptTemplate, Settings, StorageContext, load_index_from_storage
+    from llama_index.core.response_synthesizers import get_response_synthesizer
+    from benchmarks.keyword_extraction_eval import sample_prefixes
+    from common.config import configure_settings
+    from common.inference import template, text_qa_template_str, load_kg_index_from_disk
+    from common.retrieval import KGRetriever, EmbeddingMatrix
+    from common.synthesis import PackedContextSynthesizer
+
+    configure_settings()
+    if args.persist_dir:
+        kg_index = load_index_from_storage(StorageContext.from_defaults(persist_dir=args.persist_dir))
+    else:
+        kg_index = load_kg_index_from_disk()
+    retriever = KGRetriever(
+        kg_index, embedding_matrix=EmbeddingMatrix.from_embedding_dict(kg_index.index_struct.embedding_dict),
+        object_map=kg_index._object_map, llm=kg_index._llm, embed_model=kg_index._embed_model,
+        include_text=True, similarity_top_k=args.similarity_top_k, graph_store_query_depth=args.depth,
+    )
+    queries = [template.render({"prefix_code": prefix}) for prefix in sample_prefixes(kg_index, args.samples, args.seed)]
+    # Retrieval is the same for both modes and may call the LLM for keywords, so it runs first
+    queries = [(query, retriever.retrieve(query)) for query in queries]
+
+    llm = recording_llm()
+    text_qa_template = PromptTemplate(text_qa_template_str)
+    results = {"queries": len(queries), "nodes_per_query": round(statistics.mean(len(nodes) for _, nodes in queries), 2)}
+    refine = get_response_synthesizer(llm=llm, response_mode="refine", text_qa_template=text_qa_template)
+    results["refine"] = run(refine, llm, Settings.tokenizer, queries)
+    for budget in args.budgets:
+        packed = PackedContextSynthesizer(llm=llm, text_qa_template=text_qa_template, context_budget=budget)
+        row = run(packed, llm, Settings.tokenizer, queries)
+        packs = [packed.packer.pack(nodes) for _, nodes in queries]
+        row.update({
+            "context_tokens": round(statistics.mean(pack.tokens for pack in packs), 1),
+            "triplets": round(statistics.mean(pack.triplets for pack in packs), 2),
+            "chunks": round(statistics.mean(pack.chunks for pack in packs), 2),
+            "truncated": round(statistics.mean(pack.truncated for pack in packs), 2),
+            "dropped": round(statistics.mean(pack.dropped for pack in packs), 2),
+            "duplicates": round(statistics.mean(pack.duplicates for pack in packs), 2),
+        })
+        results[f"packed[{budget}]"] = row
+        print(json.dumps({f"packed[{budget}]": row}), file=sys.stderr)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--persist-dir", help="KG to retrieve from, the one the API serves by default")
+    parser.add_argument("--samples", type=int, default=50, help="Prefixes sampled from the KG")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--budgets", type=int, nargs="+", default=[1000, 2000, 3000], help="Context token budgets")
+    parser.add_argument("--similarity-top-k", type=int, default=3)
+    parser.add_argument("--depth", type=int, default=1, help="graph_store_query_depth")
+    main(parser.parse_args())
@@ -0,0 +1,138 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from common.utils import load_config
+from common.metrics import metrics
+
+config = load_config()
+
+CONTINUATION_CACHE_MAX_USERS = config.get('CONTINUATION_CACHE_MAX_USERS', 1024)
+CONTINUATION_CACHE_MAX_ENTRIES_PER_USER = config.get('CONTINUATION_CACHE_MAX_ENTRIES_PER_USER', 16)
+CONTINUATION_CACHE_TTL = config.get('CONTINUATION_CACHE_TTL', 300)
+CONTINUATION_CACHE_MAX_COMPLETION_CHARS = config.get('CONTINUATION_CACHE_MAX_COMPLETION_CHARS', 2048)
+
+
+def _digest(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class _UserIndex:
+    """Recent completions of one user, keyed by a digest of their prefix."""
+
+    def __init__(self):
+        self.entries = OrderedDict()  # prefix digest -> (prefix_bytes_len, prefix_chars_len, result, stored_at)
+        self.lengths = {}  # prefix byte length -> number of entries with that length
+
+    def add(self, digest: bytes, entry: tuple, max_entries: int):
+        if digest in self.entries:
+            self.remove(digest)
+        self.entries[digest] = entry
+        self.lengths[entry[0]] = self.lengths.get(entry[0], 0) + 1
+        while len(self.entries) > max_entries:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, digest: bytes):
+        length = self.entries.pop(digest)[0]
+        self.lengths[length] -= 1
+        if not self.lengths[length]:
+            del self.lengths[length]
+
+
+class ContinuationCache:
+    """
+    Serves keystroke-extended prefixes from a completion returned earlier.
+
+    After completion C is returned for prefix P, the editor usually sends
+    P + C[:k] as the user types the suggestion. Such a request can be answered
+    with the remaining C[k:] without calling the LLM.
+
+    Each user's recent completions are indexed by a digest of the prefix bytes,
+    together with the set of distinct prefix lengths. A lookup for prefix Q
+    encodes Q once and, for every stored length L that could be a prefix of Q,
+    hashes Q[:L] and probes the index. That is one hash per distinct length,
+    independent of how many completions are stored. Memory is bounded by the
+    number of users, entries per user and completion length, with LRU eviction
+    at both levels and a TTL per entry.
+
+    The cache is per worker and must be given the untrimmed prefix, because
+    trimming shifts the window as the user types.
+    """
+
+    def __init__(
+        self,
+        max_users: int = CONTINUATION_CACHE_MAX_USERS,
+        max_entries_per_user: int = CONTINUATION_CACHE_MAX_ENTRIES_PER_USER,
+        ttl: float = CONTINUATION_CACHE_TTL,
+        max_completion_chars: int = CONTINUATION_CACHE_MAX_COMPLETION_CHARS,
+    ):
+        self.max_users = max_users
+        self.max_entries_per_user = max_entries_per_user
+        self.ttl = ttl
+        self.max_completion_chars = max_completion_chars
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, user: str, prefix_code: str, result: dict):
+        """Remember `result` (a CodeResponse dict) as the completion of `prefix_code` for `user`."""
+        completion = result.get("generated_code") or ""
+        if not completion or len(completion) > self.max_completion_chars:
+            return
+        prefix_bytes = prefix_code.encode("utf-8")
+        entry = (len(prefix_bytes), len(prefix_code), result, time.monotonic())
+        with self._lock:
+            index = self._users.pop(user, None) or _UserIndex()
+            self._users[user] = index
+            index.add(_digest(prefix_bytes), entry, self.max_entries_per_user)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    def lookup(self, user: str, prefix_code: str) -> Optional[dict]:
+        """
+        Return a CodeResponse dict whose `generated_code` is the not yet typed part of an
+        earlier completion that `prefix_code` extends, or None.
+        """
+        prefix_bytes = prefix_code.encode("utf-8")
+        view = memoryview(prefix_bytes)
+        now = time.monotonic()
+        with self._lock:
+            index = self._users.get(user)
+            if index is None:
+                metrics.incr("continuation_cache.misses")
+                return None
+            self._users.move_to_end(user)
+            # Longest stored prefix first: it leaves the least to re-derive
+            for length in sorted(index.lengths, reverse=True):
+                if length > len(prefix_bytes) or len(prefix_bytes) - length > 4 * self.max_completion_chars:
+                    continue
+                digest = _digest(view[:length])
+                entry = index.entries.get(digest)
+                if entry is None:
+                    continue
+                _, prefix_chars, result, stored_at = entry
+                if now - stored_at > self.ttl:
+                    index.remove(digest)
+                    continue
+                typed = prefix_code[prefix_chars:]
+                completion = result["generated_code"]
+                if len(typed) < len(completion) and completion.startswith(typed):
+                    index.entries.move_to_end(digest)
+                    metrics.incr("continuation_cache.hits")
+                    return {**result, "generated_code": completion[len(typed):]}
+        metrics.incr("continuation_cache.misses")
+        return None
+
+    def clear(self):
+        """Drop every remembered completion."""
+        with self._lock:
+            self._users.clear()
+
+    def stats(self) -> dict:
+        """Number of users and completions currently held."""
+        with self._lock:
+            return {
+                "users": len(self._users),
+                "entries": sum(len(index.entries) for index in self._users.values()),
+            }
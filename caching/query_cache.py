@@ -0,0 +1,194 @@
+import re
+import time
+import hashlib
+import logging
+import threading
+import numpy as np
+import redis
+from redis.exceptions import RedisError, ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from typing import Dict, List, Optional, Sequence
+
+from caching.redis_cache import (
+    LocalLRUCache, encode_value, decode_value,
+    REDIS_URL, REDIS_MAX_CONNECTIONS, REDIS_SOCKET_TIMEOUT, REDIS_CONNECT_TIMEOUT, REDIS_RETRY_AFTER,
+)
+from caching.semantic_cache import normalize_rust
+from common.keyword_extraction import PREFIX_CODE_PATTERN
+from common.utils import load_config
+from common.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+config = load_config()
+
+EMBEDDING_CACHE_TTL = config.get('EMBEDDING_CACHE_TTL', 86400)
+EMBEDDING_CACHE_MAX_ENTRIES = config.get('EMBEDDING_CACHE_MAX_ENTRIES', 5000)
+RETRIEVAL_CACHE_TTL = config.get('RETRIEVAL_CACHE_TTL', 3600)
+RETRIEVAL_CACHE_MAX_ENTRIES = config.get('RETRIEVAL_CACHE_MAX_ENTRIES', 5000)
+# Bytes of the in-process tier of each cache
+QUERY_CACHE_LOCAL_MAX_BYTES = config.get('QUERY_CACHE_LOCAL_MAX_BYTES', 32 * 1024 * 1024)
+
+# Identifier still being typed at the end of a prefix
+PARTIAL_IDENTIFIER_PATTERN = re.compile(r"\w+\Z")
+
+
+def normalize_query(query_str: str) -> str:
+    """
+    Canonical form of a retrieval query. In a query rendered from code_completion.prompt,
+    the prefix code loses the identifier still being typed at its end, if any, and is
+    normalized with `normalize_rust`, so requests that differ only in the characters of that
+    identifier, whitespace or ordinary comments share their embedding and retrieval results.
+    Other queries are whitespace-normalized.
+    """
+    match = PREFIX_CODE_PATTERN.search(query_str)
+    if match is None:
+        return " ".join(query_str.split())
+    code = PARTIAL_IDENTIFIER_PATTERN.sub("", match.group(1).rstrip("\n"))
+    return query_str[:match.start(1)] + normalize_rust(code) + "\n" + query_str[match.end(1):]
+
+
+def query_namespace(*parts) -> str:
+    """Short digest of everything a cached value depends on, e.g. the KG version and models."""
+    return hashlib.blake2b("|".join(map(str, parts)).encode("utf-8"), digest_size=6).hexdigest()
+
+
+def create_redis_client(url: str = REDIS_URL) -> redis.Redis:
+    """Synchronous client for the retrieval path, which runs on inference worker threads."""
+    pool = redis.BlockingConnectionPool.from_url(
+        url,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_SOCKET_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+class QueryCache:
+    """
+    Synchronous two-tier cache of retrieval intermediates: a LocalLRUCache in front of Redis.
+
+    Keys are digests of a text within `namespace`, which names everything the values depend
+    on, so a new KG version or model reads a fresh namespace and the old entries expire
+    with their TTL. Both tiers are bounded by `ttl`; the local tier also by `max_entries`
+    and `max_bytes`. Like AsyncRedisCache, the client degrades to the local tier and stops
+    calling Redis for `retry_after` seconds after a connection failure. Hits and misses of
+    each tier are counted as `<name>_cache.local.hits`, `<name>_cache.redis.misses`, etc.
+    """
+
+    def __init__(self, name: str, namespace: str, ttl: float, max_entries: int,
+                 max_bytes: int = QUERY_CACHE_LOCAL_MAX_BYTES, client: Optional[redis.Redis] = None,
+                 retry_after: float = REDIS_RETRY_AFTER):
+        self.name = name
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local = LocalLRUCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+        self.client = client if client is not None else create_redis_client()
+        self.retry_after = retry_after
+        self._down_until = 0.0
+        # The retrieval path runs on several inference threads at once
+        self._lock = threading.Lock()
+
+    def key(self, text: str) -> str:
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+        return f"{self.name}:{self.namespace}:{digest}"
+
+    def encode(self, value) -> bytes:
+        return encode_value(value)
+
+    def decode(self, value: bytes):
+        return decode_value(value)
+
+    def size(self, encoded: bytes) -> int:
+        return len(encoded)
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self._down_until
+
+    def _on_error(self, exc: Exception):
+        if not isinstance(exc, (RedisConnectionError, RedisTimeoutError, OSError)):
+            logger.warning(f"Redis command failed: {exc!r}")
+            return
+        if self.available:
+            logger.warning(f"Redis unavailable ({exc!r}), {self.name} cache is local only for {self.retry_after}s")
+        self._down_until = time.monotonic() + self.retry_after
+
+    def get(self, text: str):
+        """The value cached for `text`, or None."""
+        return self.get_many([text])[0]
+
+    def set(self, text: str, value):
+        """Cache `value` for `text` in both tiers."""
+        self.set_many({text: value})
+
+    def get_many(self, texts: Sequence[str]) -> List:
+        """Values cached for `texts`, None for misses, with one Redis round trip for the local misses."""
+        keys = [self.key(text) for text in texts]
+        with self._lock:
+            values = [self.local.get(key) for key in keys]
+        misses = [i for i, value in enumerate(values) if value is None]
+        metrics.incr(f"{self.name}_cache.local.hits", len(keys) - len(misses))
+        metrics.incr(f"{self.name}_cache.local.misses", len(misses))
+        if not misses or not self.available:
+            return values
+        try:
+            encoded = self.client.mget([keys[i] for i in misses])
+        except (RedisError, OSError) as e:
+            self._on_error(e)
+            return values
+        hits = 0
+        for i, value in zip(misses, encoded):
+            if value:
+                hits += 1
+                values[i] = self.decode(value)
+                with self._lock:
+                    self.local.set(keys[i], values[i], self.size(value))
+        metrics.incr(f"{self.name}_cache.redis.hits", hits)
+        metrics.incr(f"{self.name}_cache.redis.misses", len(misses) - hits)
+        return values
+
+    def set_many(self, values: Dict[str, object]):
+        """Cache several values, writing them to Redis in one pipelined round trip."""
+        if not values:
+            return
+        encoded = {self.key(text): (value, self.encode(value)) for text, value in values.items()}
+        with self._lock:
+            for key, (value, data) in encoded.items():
+                self.local.set(key, value, self.size(data))
+        if not self.available:
+            return
+        try:
+            with self.client.pipeline(transaction=False) as pipe:
+                for key, (_, data) in encoded.items():
+                    pipe.set(key, data, ex=int(self.ttl))
+                pipe.execute()
+        except (RedisError, OSError) as e:
+            self._on_error(e)
+
+    def clear_local(self):
+        with self._lock:
+            self.local.clear()
+
+
+class EmbeddingCache(QueryCache):
+    """QueryCache of query embeddings, stored in Redis as raw float32 bytes."""
+
+    def __init__(self, namespace: str, ttl: float = EMBEDDING_CACHE_TTL, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES, **kwargs):
+        super().__init__("embedding", namespace, ttl, max_entries, **kwargs)
+
+    def encode(self, value: Sequence[float]) -> bytes:
+        return np.asarray(value, dtype=np.float32).tobytes()
+
+    def decode(self, value: bytes) -> List[float]:
+        return np.frombuffer(value, dtype=np.float32).tolist()
+
+
+class RetrievalCache(QueryCache):
+    """
+    QueryCache of the outputs of the retrieval legs: the triplets found, the rel map
+    of the keyword leg and the IDs of the text chunks with their keyword counts.
+    """
+
+    def __init__(self, namespace: str, ttl: float = RETRIEVAL_CACHE_TTL, max_entries: int = RETRIEVAL_CACHE_MAX_ENTRIES, **kwargs):
+        super().__init__("retrieval", namespace, ttl, max_entries, **kwargs)
@@ -1,22 +1,578 @@
+import math
+import zlib
 import redis
 import json
-from typing import Optional
+import time
+import random
+import hashlib
+import itertools
+import asyncio
+import logging
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError, ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from typing import Dict, List, NamedTuple, Optional
+from collections import OrderedDict
+
+from common.utils import load_config
+from common.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+config = load_config()
+
+REDIS_URL = config.get('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_MAX_CONNECTIONS = config.get('REDIS_MAX_CONNECTIONS', 64)
+REDIS_SOCKET_TIMEOUT = config.get('REDIS_SOCKET_TIMEOUT', 0.5)
+REDIS_CONNECT_TIMEOUT = config.get('REDIS_CONNECT_TIMEOUT', 0.5)
+REDIS_RETRY_AFTER = config.get('REDIS_RETRY_AFTER', 5)
+LOCAL_CACHE_MAX_ENTRIES = config.get('LOCAL_CACHE_MAX_ENTRIES', 20000)
+LOCAL_CACHE_MAX_BYTES = config.get('LOCAL_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+LOCAL_CACHE_TTL = config.get('LOCAL_CACHE_TTL', 300)
+CACHE_FRESH_TTL = config.get('CACHE_FRESH_TTL', 3600)
+CACHE_STALE_TTL = config.get('CACHE_STALE_TTL', 3600)
+CACHE_TTL_JITTER = config.get('CACHE_TTL_JITTER', 0.1)
+# Backoff between attempts to resubscribe to cache invalidations, doubling up to the maximum
+INVALIDATION_RESUBSCRIBE_MIN = 1.0
+INVALIDATION_RESUBSCRIBE_MAX = 30.0
+
+# Delete a lock key only if it still holds the caller's token
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Extend a lock's TTL only if it still holds the caller's token
+EXTEND_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Values shorter than this are stored uncompressed
+COMPRESS_MIN_BYTES = 256
+# One-byte headers of encoded values
+RAW_JSON, ZLIB_JSON = b'j', b'z'
+
+COMPLETION_KEY_PREFIX = 'completion'
 
 # Initialize Redis client
-redis_client = redis.Redis(host='localhost', port=6379, db=0)
+redis_client = redis.Redis.from_url(REDIS_URL)
 
 def generate_cache_key(*args, **kwargs) -> str:
     unique_string = ''.join(args) + ''.join(f"{k}={v}" for k, v in kwargs.items())
     return unique_string
 
+def cache_namespace(kg_version: str, prompt_hash: str, model_id: str) -> str:
+    """
+    Returns the namespace of completion cache entries produced by a given KG version,
+    prompt template and model. Changing any of them moves the cache to a fresh
+    namespace; entries of the old one are never read again and expire on their own.
+    """
+    fingerprint = f"{kg_version}|{prompt_hash}|{model_id}".encode('utf-8')
+    return hashlib.blake2b(fingerprint, digest_size=6).hexdigest()
+
+def completion_cache_key(prefix_code: str, namespace: str) -> str:
+    """Returns the fixed-length cache key of `prefix_code` within `namespace`."""
+    digest = hashlib.blake2b(prefix_code.encode('utf-8'), digest_size=16).hexdigest()
+    return f"{COMPLETION_KEY_PREFIX}:{namespace}:{digest}"
+
+def namespace_index_key(namespace: str) -> str:
+    """Returns the key of the Redis set tracking every completion key written to `namespace`."""
+    return f"{COMPLETION_KEY_PREFIX}:{namespace}:keys"
+
+def encode_value(result: dict) -> bytes:
+    """Encodes `result` as compact JSON, zlib-compressed when large enough to benefit."""
+    payload = json.dumps(result, separators=(',', ':')).encode('utf-8')
+    if len(payload) < COMPRESS_MIN_BYTES:
+        return RAW_JSON + payload
+    return ZLIB_JSON + zlib.compress(payload)
+
+def decode_value(value: bytes) -> dict:
+    """Decodes a value written by `encode_value`, or a legacy plain JSON value."""
+    header, payload = value[:1], value[1:]
+    if header == ZLIB_JSON:
+        return json.loads(zlib.decompress(payload))
+    if header == RAW_JSON:
+        return json.loads(payload)
+    return json.loads(value)
+
+def completion_expiry(fresh_ttl: float = CACHE_FRESH_TTL, stale_ttl: float = CACHE_STALE_TTL, jitter: float = CACHE_TTL_JITTER) -> int:
+    """
+    Returns the Redis TTL (the hard TTL) of a completion entry: a fresh period shortened by a
+    random fraction of up to `jitter`, followed by `stale_ttl` seconds during which the entry
+    may still be served while it is refreshed. The jitter spreads the expiry of entries
+    written together, e.g. after a deploy, so they do not all go stale at the same moment.
+    """
+    return int(fresh_ttl * (1 - jitter * random.random()) + stale_ttl)
+
 def get_cached_result(key: str) -> Optional[dict]:
     cached_result = redis_client.get(key)
     if cached_result:
-        return json.loads(cached_result)
+        return decode_value(cached_result)
     return None
 
-def set_cache_result(key: str, result: dict, expiry: int = 3600):
-    redis_client.set(key, json.dumps(result), ex=expiry)
+def set_cache_result(key: str, result: dict, expiry: Optional[int] = None):
+    redis_client.set(key, encode_value(result), ex=expiry or completion_expiry())
+
+def invalidate_cache(namespace: str) -> int:
+    """
+    Deletes every completion cached in `namespace` and returns how many keys were removed.
+    Other namespaces and unrelated keys in the same database, such as KG download
+    markers, are left untouched.
+    """
+    index_key = namespace_index_key(namespace)
+    deleted = 0
+    batch = []
+    # Keys tracked at write time, plus a SCAN sweep for any written without tracking
+    keys = itertools.chain(
+        redis_client.sscan_iter(index_key, count=500),
+        redis_client.scan_iter(match=f"{COMPLETION_KEY_PREFIX}:{namespace}:*", count=500),
+    )
+    for key in keys:
+        if key == index_key.encode('utf-8'):
+            continue
+        batch.append(key)
+        if len(batch) >= 500:
+            deleted += redis_client.unlink(*batch)
+            batch = []
+    if batch:
+        deleted += redis_client.unlink(*batch)
+    redis_client.unlink(index_key)
+    return deleted
+
+
+class CacheEntry(NamedTuple):
+    result: dict
+    # Seconds until the entry goes stale; negative once it is being served stale
+    fresh_for: float
+
+
+class AsyncRedisCache:
+    """
+    Asyncio cache client backed by a single shared Redis connection pool.
+
+    One instance is meant to live for the whole worker process. Connections are
+    borrowed from a bounded pool, so concurrent requests never open more than
+    `max_connections` sockets. When Redis is unreachable the client degrades to
+    a cache miss and stops calling Redis for `retry_after` seconds, so an outage
+    costs one timeout instead of one timeout per request.
+    """
+
+    def __init__(
+        self,
+        url: str = REDIS_URL,
+        max_connections: int = REDIS_MAX_CONNECTIONS,
+        socket_timeout: float = REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout: float = REDIS_CONNECT_TIMEOUT,
+        retry_after: float = REDIS_RETRY_AFTER,
+        client: Optional[aioredis.Redis] = None,
+    ):
+        if client is None:
+            pool = aioredis.BlockingConnectionPool.from_url(
+                url,
+                max_connections=max_connections,
+                timeout=socket_timeout,
+                socket_timeout=socket_timeout,
+                socket_connect_timeout=socket_connect_timeout,
+            )
+            client = aioredis.Redis(connection_pool=pool)
+        self.client = client
+        self.retry_after = retry_after
+        self._down_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        """False while the client is backing off after a Redis failure."""
+        return time.monotonic() >= self._down_until
+
+    def _on_error(self, exc: Exception):
+        if not isinstance(exc, (RedisConnectionError, RedisTimeoutError, OSError, asyncio.TimeoutError)):
+            # Redis answered with an error; it is reachable, so do not back off
+            logger.warning(f"Redis command failed: {exc!r}")
+            return
+        if self.available:
+            logger.warning(f"Redis unavailable ({exc!r}), serving without cache for {self.retry_after}s")
+        self._down_until = time.monotonic() + self.retry_after
+
+    async def get(self, key: str) -> Optional[dict]:
+        """Return the cached result for `key`, or None on a miss or Redis failure."""
+        if not self.available:
+            return None
+        try:
+            cached_result = await self.client.get(key)
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            self._on_error(e)
+            return None
+        if cached_result:
+            return decode_value(cached_result)
+        return None
+
+    async def get_entry(self, key: str, stale_ttl: float = CACHE_STALE_TTL) -> Optional[CacheEntry]:
+        """
+        Return the cached result for `key` with its remaining freshness, or None on a miss or
+        Redis failure. The entry goes stale `stale_ttl` seconds before its Redis TTL runs out,
+        so freshness is read from the key's PTTL and older entries need no extra metadata.
+        """
+        if not self.available:
+            return None
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.get(key)
+                pipe.pttl(key)
+                cached_result, pttl = await pipe.execute()
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            self._on_error(e)
+            return None
+        if not cached_result:
+            return None
+        # PTTL is -1 for a key without expiry
+        fresh_for = math.inf if pttl < 0 else pttl / 1000 - stale_ttl
+        return CacheEntry(decode_value(cached_result), fresh_for)
+
+    async def set(self, key: str, result: dict, expiry: int = 3600, namespace: Optional[str] = None):
+        """
+        Store `result` under `key`. If `namespace` is given, the key is also tracked in the
+        namespace's key set so `purge_namespace` can find it. Failures are logged and swallowed.
+        """
+        await self.set_many({key: result}, expiry=expiry, namespace=namespace)
+
+    async def get_many(self, keys: List[str]) -> List[Optional[dict]]:
+        """Fetch several keys in one pipelined round trip."""
+        if not keys or not self.available:
+            return [None] * len(keys)
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.get(key)
+                cached_results = await pipe.execute()
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            self._on_error(e)
+            return [None] * len(keys)
+        return [decode_value(value) if value else None for value in cached_results]
+
+    async def set_many(self, results: Dict[str, dict], expiry: int = 3600, namespace: Optional[str] = None):
+        """Store several results in one pipelined round trip."""
+        if not results or not self.available:
+            return
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for key, result in results.items():
+                    pipe.set(key, encode_value(result), ex=expiry)
+                if namespace is not None:
+                    index_key = namespace_index_key(namespace)
+                    pipe.sadd(index_key, *results)
+                    pipe.expire(index_key, expiry)
+                await pipe.execute()
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            self._on_error(e)
+
+    async def delete(self, keys: List[str]):
+        """Delete `keys` from Redis."""
+        if not keys or not self.available:
+            return
+        try:
+            await self.client.delete(*keys)
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            self._on_error(e)
+
+    async def purge_namespace(self, namespace: str) -> int:
+        """
+        Delete every completion cached in `namespace` and return how many keys were removed.
+        Keys are found through the namespace's tracked key set and a SCAN sweep, and are
+        unlinked in batches so Redis is never blocked by one large command.
+        """
+        index_key = namespace_index_key(namespace)
+        deleted = 0
+        batch = []
+
+        async def flush():
+            nonlocal deleted, batch
+            if batch:
+                deleted += await self.client.unlink(*batch)
+                batch = []
+
+        try:
+            async for key in self.client.sscan_iter(index_key, count=500):
+                batch.append(key)
+                if len(batch) >= 500:
+                    await flush()
+            async for key in self.client.scan_iter(match=f"{COMPLETION_KEY_PREFIX}:{namespace}:*", count=500):
+                if key == index_key.encode('utf-8'):
+                    continue
+                batch.append(key)
+                if len(batch) >= 500:
+                    await flush()
+            await flush()
+            await self.client.unlink(index_key)
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            self._on_error(e)
+        return deleted
+
+    async def acquire_lock(self, name: str, token: str, ttl: float) -> Optional[bool]:
+        """
+        Try to take the lock `name` for `ttl` seconds.
+
+        Returns True if acquired, False if another holder owns it and None if
+        Redis is unavailable, in which case callers should proceed unlocked.
+        """
+        if not self.available:
+            return None
+        try:
+            return bool(await self.client.set(name, token, nx=True, px=int(ttl * 1000)))
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            self._on_error(e)
+            return None
+
+    async def release_lock(self, name: str, token: str):
+        """Release the lock `name` only if it is still held with `token`."""
+        if not self.available:
+            return
+        try:
+            await self.client.eval(RELEASE_LOCK_SCRIPT, 1, name, token)
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            self._on_error(e)
+
+    async def extend_lock(self, name: str, token: str, ttl: float) -> bool:
+        """Reset the TTL of the lock `name` to `ttl` seconds if it is still held with `token`."""
+        if not self.available:
+            return False
+        try:
+            return bool(await self.client.eval(EXTEND_LOCK_SCRIPT, 1, name, token, int(ttl * 1000)))
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            self._on_error(e)
+            return False
+
+    async def lock_exists(self, name: str) -> bool:
+        """True if the lock `name` is currently held by anyone."""
+        if not self.available:
+            return False
+        try:
+            return bool(await self.client.exists(name))
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            self._on_error(e)
+            return False
+
+    async def publish(self, channel: str, message: dict):
+        """Publish `message` as JSON on `channel`."""
+        if not self.available:
+            return
+        try:
+            await self.client.publish(channel, json.dumps(message))
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            self._on_error(e)
+
+    async def close(self):
+        """Release the pooled connections."""
+        await self.client.aclose()
+
+
+class LocalLRUCache:
+    """
+    In-process LRU cache bounded by entry count, approximate payload bytes and TTL.
+
+    Values are kept as Python objects and shared between callers, so they must
+    be treated as read-only. Sizes are the length of the value's JSON encoding.
+    """
+
+    def __init__(self, max_entries: int = LOCAL_CACHE_MAX_ENTRIES, max_bytes: int = LOCAL_CACHE_MAX_BYTES, ttl: float = LOCAL_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] <= time.monotonic():
+            self.delete(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key: str, value: dict, size: int, ttl: Optional[float] = None):
+        if size > self.max_bytes:
+            return
+        self.delete(key)
+        self._entries[key] = (value, size, time.monotonic() + min(ttl or self.ttl, self.ttl))
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+
+    def delete(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+
+class TieredCache:
+    """
+    Two-tier completion cache: a per-worker LocalLRUCache in front of Redis.
+
+    Reads check the local tier first and fill it from Redis on a local miss;
+    writes go to both tiers. Completions are written with a jittered hard TTL
+    (see `completion_expiry`) and go stale `stale_ttl` seconds before it runs
+    out. Stale entries are still returned by `get_entry`, so the caller can
+    serve them while refreshing, but are never copied into the local tier,
+    which only holds fresh entries. Invalidations delete from Redis and are broadcast
+    on the `channel` pub/sub channel so every worker drops the same keys from
+    its local tier. Call `start()` once the event loop is running to subscribe.
+    A failed subscription is retried with backoff for the life of the worker,
+    and the local tier is emptied once it is back, as broadcasts may have been
+    missed meanwhile.
+    """
+
+    def __init__(
+        self,
+        redis_cache: AsyncRedisCache,
+        local: Optional[LocalLRUCache] = None,
+        channel: str = "cache:invalidate",
+        fresh_ttl: float = CACHE_FRESH_TTL,
+        stale_ttl: float = CACHE_STALE_TTL,
+        jitter: float = CACHE_TTL_JITTER,
+    ):
+        self.redis = redis_cache
+        self.local = local if local is not None else LocalLRUCache()
+        self.channel = channel
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self.jitter = jitter
+        self._listener: Optional[asyncio.Task] = None
+
+    async def get(self, key: str) -> Optional[dict]:
+        """Return the cached result for `key` from the nearest tier that has it, fresh or stale."""
+        entry = await self.get_entry(key)
+        return entry.result if entry else None
+
+    async def get_entry(self, key: str) -> Optional[CacheEntry]:
+        """
+        Return the cached result for `key` and its remaining freshness. The local tier never
+        keeps an entry past its fresh period, so local hits are reported as fresh indefinitely.
+        """
+        result = self.local.get(key)
+        if result is not None:
+            metrics.incr("cache.local.hits")
+            return CacheEntry(result, math.inf)
+        metrics.incr("cache.local.misses")
+        entry = await self.redis.get_entry(key, stale_ttl=self.stale_ttl)
+        if entry is None:
+            metrics.incr("cache.redis.misses")
+            return None
+        metrics.incr("cache.redis.hits")
+        if entry.fresh_for > 0:
+            self.local.set(key, entry.result, len(json.dumps(entry.result)), ttl=entry.fresh_for)
+        else:
+            metrics.incr("cache.stale_hits")
+        return entry
+
+    async def set(self, key: str, result: dict, expiry: Optional[int] = None, namespace: Optional[str] = None):
+        """Write `result` to both tiers. `expiry` defaults to a jittered `completion_expiry()`."""
+        expiry = expiry or completion_expiry(self.fresh_ttl, self.stale_ttl, self.jitter)
+        if expiry > self.stale_ttl:
+            self.local.set(key, result, len(json.dumps(result)), ttl=expiry - self.stale_ttl)
+        await self.redis.set(key, result, expiry=expiry, namespace=namespace)
+
+    async def invalidate(self, keys: List[str]):
+        """Delete `keys` from Redis and from the local tier of every worker."""
+        for key in keys:
+            self.local.delete(key)
+        await self.redis.delete(keys)
+        await self.redis.publish(self.channel, {"keys": keys})
+
+    async def invalidate_local(self):
+        """Empty the local tier of every worker, e.g. after a namespace change."""
+        self.local.clear()
+        await self.redis.publish(self.channel, {"all": True})
+
+    async def purge_namespace(self, namespace: str) -> int:
+        """Delete every completion of `namespace` from Redis and from every worker's local tier."""
+        deleted = await self.redis.purge_namespace(namespace)
+        await self.invalidate_local()
+        return deleted
+
+    async def start(self):
+        """Subscribe to invalidation broadcasts from other workers, in the background."""
+        if self._listener is not None and not self._listener.done():
+            return
+        self._listener = asyncio.ensure_future(self._subscribe())
+
+    async def _subscribe(self):
+        """Keep a subscription to invalidations, resubscribing with backoff whenever it fails."""
+        delay, missed = INVALIDATION_RESUBSCRIBE_MIN, False
+        while True:
+            pubsub = self.redis.client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                if missed:
+                    # Keys invalidated while unsubscribed may still be in the local tier
+                    self.local.clear()
+                    metrics.incr("cache.local.resubscribes")
+                    logger.info("Resubscribed to cache invalidations, local tier cleared")
+                delay = INVALIDATION_RESUBSCRIBE_MIN
+                await self._listen(pubsub)
+            except (RedisError, OSError, asyncio.TimeoutError) as e:
+                missed = True
+                logger.warning(f"Cache invalidation subscription failed: {e!r}, retrying in {delay:g}s")
+            finally:
+                try:
+                    await pubsub.aclose()
+                except (RedisError, OSError):
+                    pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, INVALIDATION_RESUBSCRIBE_MAX)
+
+    async def _listen(self, pubsub):
+        while True:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is None:
+                continue
+            try:
+                invalidation = json.loads(message["data"])
+                clear_all, keys = invalidation.get("all"), list(invalidation.get("keys", []))
+            except (ValueError, AttributeError, TypeError) as e:
+                # Ending the listener over one bad message would leave the local tier stale
+                metrics.incr("cache.local.bad_invalidations")
+                logger.warning(f"Ignoring malformed cache invalidation {message['data']!r}: {e!r}")
+                continue
+            metrics.incr("cache.local.invalidations")
+            if clear_all:
+                self.local.clear()
+            for key in keys:
+                self.local.delete(key)
+
+    async def close(self):
+        """Stop listening and release the Redis connections."""
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+        await self.redis.close()
+
+    def stats(self) -> dict:
+        """Hit ratio of each tier and the local tier's size."""
+        counters = metrics.snapshot()["counters"]
+
+        def ratio(tier):
+            hits, misses = counters.get(f"cache.{tier}.hits", 0), counters.get(f"cache.{tier}.misses", 0)
+            return round(hits / (hits + misses), 4) if hits + misses else None
 
-def invalidate_cache():
-    redis_client.flushdb()  # This will clear all cache entries, use with caution.
+        return {
+            "local_hit_ratio": ratio("local"),
+            "redis_hit_ratio": ratio("redis"),
+            "local_entries": len(self.local),
+            "local_bytes": self.local.bytes,
+        }
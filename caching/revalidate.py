@@ -0,0 +1,102 @@
+import math
+import time
+import uuid
+import random
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict
+
+from common.utils import load_config
+from common.metrics import metrics
+from caching.redis_cache import AsyncRedisCache, CacheEntry
+
+logger = logging.getLogger(__name__)
+
+config = load_config()
+
+CACHE_EARLY_REFRESH_BETA = config.get('CACHE_EARLY_REFRESH_BETA', 1.0)
+CACHE_REFRESH_LOCK_TTL = config.get('CACHE_REFRESH_LOCK_TTL', 60)
+
+
+class Revalidator:
+    """
+    Refreshes cached completions in the background (stale-while-revalidate).
+
+    `should_refresh()` decides whether a cache hit should trigger a refresh.
+    A stale hit always does. A fresh hit does so early with a probability that
+    grows as the entry approaches staleness, following the XFetch rule
+    `-delta * beta * log(rand()) >= fresh_for`, where `delta` is a moving average
+    of how long a refresh takes. Hot keys are therefore usually refreshed a little
+    before they go stale, and not all at the same time.
+
+    `schedule()` starts at most one refresh per key in this worker. Across workers,
+    the refresh holds a Redis lock `<prefix>:lock:<key>`; a worker that cannot take
+    it leaves the refresh to the holder. The caller keeps serving the cached result
+    in the meantime.
+    """
+
+    def __init__(
+        self,
+        cache: AsyncRedisCache,
+        beta: float = CACHE_EARLY_REFRESH_BETA,
+        lock_ttl: float = CACHE_REFRESH_LOCK_TTL,
+        initial_delta: float = 2.0,
+        prefix: str = "revalidate",
+    ):
+        self.cache = cache
+        self.beta = beta
+        self.lock_ttl = lock_ttl
+        self.delta = initial_delta
+        self.prefix = prefix
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def should_refresh(self, entry: CacheEntry) -> bool:
+        """True if `entry` is stale, or is close enough to going stale to be refreshed early."""
+        if entry.fresh_for <= 0:
+            return True
+        if math.isinf(entry.fresh_for) or self.beta <= 0:
+            return False
+        # 1 - random() lies in (0, 1], so the logarithm is finite
+        if -self.delta * self.beta * math.log(1 - random.random()) >= entry.fresh_for:
+            metrics.incr("cache.revalidate.early")
+            return True
+        return False
+
+    def schedule(self, key: str, compute: Callable[[], Awaitable[dict]]) -> bool:
+        """
+        Start a background refresh of `key` unless one is already running in this worker.
+        `compute` must write the new result to the cache. Returns True if a refresh was started.
+        """
+        if key in self._tasks:
+            return False
+        task = asyncio.ensure_future(self._refresh(key, compute))
+        self._tasks[key] = task
+        task.add_done_callback(lambda t: self._tasks.pop(key, None))
+        return True
+
+    async def _refresh(self, key: str, compute: Callable[[], Awaitable[dict]]):
+        lock_name = f"{self.prefix}:lock:{key}"
+        token = uuid.uuid4().hex
+        # Without Redis the new result could not be stored, so only refresh under the lock
+        if not await self.cache.acquire_lock(lock_name, token, self.lock_ttl):
+            metrics.incr("cache.revalidate.skipped")
+            return
+        started_at = time.perf_counter()
+        try:
+            await compute()
+            elapsed = time.perf_counter() - started_at
+            self.delta = 0.8 * self.delta + 0.2 * elapsed
+            metrics.observe("cache.revalidate", elapsed)
+            metrics.incr("cache.revalidate.refreshed")
+        except Exception:
+            metrics.incr("cache.revalidate.errors")
+            logger.exception(f"Background refresh of {key} failed")
+        finally:
+            await self.cache.release_lock(lock_name, token)
+
+    async def close(self):
+        """Cancel refreshes still in flight."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,253 @@
+import re
+import time
+import zlib
+import random
+import threading
+import numpy as np
+from typing import Callable, List, NamedTuple, Optional
+
+from common.utils import load_config
+from common.metrics import metrics
+
+config = load_config()
+
+SEMANTIC_CACHE_THRESHOLD = config.get('SEMANTIC_CACHE_THRESHOLD', 0.97)
+SEMANTIC_CACHE_MAX_ENTRIES = config.get('SEMANTIC_CACHE_MAX_ENTRIES', 10000)
+SEMANTIC_CACHE_TTL = config.get('SEMANTIC_CACHE_TTL', 3600)
+SEMANTIC_CACHE_VERIFY_RATE = config.get('SEMANTIC_CACHE_VERIFY_RATE', 0.02)
+SEMANTIC_CACHE_EMBEDDER = config.get('SEMANTIC_CACHE_EMBEDDER', 'hashing')
+
+# Comments, literals and whitespace in Rust source. Literals are matched so that
+# comment markers and whitespace inside them are left untouched.
+RUST_LEXEME_PATTERN = re.compile(r'''
+    (?P<doc_comment>///[^\n]*|//![^\n]*|/\*[*!].*?\*/)
+  | (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<raw_string>(?<!\w)b?r(?P<hashes>\#*)".*?"(?P=hashes))
+  | (?P<string>(?<!\w)b?"(?:\\.|[^"\\])*")
+  | (?P<char>(?<!\w)b?'(?:\\.|[^\\'\n])')
+  | (?P<space>\s+)
+''', re.S | re.X)
+
+IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|\d+|\S')
+SUBWORD_PATTERN = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+')
+
+
+def normalize_rust(code: str) -> str:
+    """
+    Canonicalize a Rust prefix for similarity lookup. Ordinary comments are removed,
+    doc comments (`///`, `//!`, `/** */`) are kept because they describe the code to be
+    written, and whitespace is collapsed to a single space between word characters and
+    dropped around punctuation. String and char literals are preserved verbatim.
+    """
+    def replace(match):
+        kind = match.lastgroup
+        if kind == 'doc_comment':
+            return ' '.join(match.group().split()) + ' '
+        if kind in ('comment', 'space'):
+            text = match.string
+            before = text[match.start() - 1] if match.start() > 0 else ''
+            after = text[match.end()] if match.end() < len(text) else ''
+            return ' ' if (before.isalnum() or before == '_') and (after.isalnum() or after == '_') else ''
+        return match.group()
+
+    return RUST_LEXEME_PATTERN.sub(replace, code).strip()
+
+
+class HashingEmbedder:
+    """
+    Deterministic local embedder based on feature hashing.
+
+    Identifiers are split into camel/snake-case subwords; unigrams and bigrams of
+    the resulting tokens are hashed with CRC32 into `dim` signed buckets and the
+    vector is L2-normalized. No model or network call is involved, so it is cheap
+    enough for the request path and stable across processes and test runs.
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def _tokens(self, text: str) -> List[str]:
+        tokens = []
+        for token in IDENTIFIER_PATTERN.findall(text):
+            tokens.append(token)
+            if len(token) > 1 and (token[0].isalpha() or token[0] == '_'):
+                subwords = [w.lower() for w in SUBWORD_PATTERN.findall(token)]
+                if len(subwords) > 1:
+                    tokens.extend(subwords)
+        return tokens
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        tokens = self._tokens(text)
+        features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        for feature in features:
+            h = zlib.crc32(feature.encode('utf-8'))
+            vector[h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class LlamaIndexEmbedder:
+    """
+    Adapter exposing a llama_index embedding model (e.g. Bedrock) through `embed()`. Without
+    `embed_model`, Settings.embed_model is read on the first `embed()`, after calling
+    `configure` if given, so the cache can be built before the models are configured.
+    """
+
+    def __init__(self, embed_model=None, configure: Optional[Callable[[], None]] = None):
+        self.embed_model = embed_model
+        self.configure = configure
+        self._lock = threading.Lock()
+
+    def _model(self):
+        if self.embed_model is None:
+            with self._lock:
+                if self.embed_model is None:
+                    from llama_index.core import Settings
+                    if self.configure is not None:
+                        self.configure()
+                    self.embed_model = Settings.embed_model
+        return self.embed_model
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.asarray(self._model().get_text_embedding(text), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+def create_embedder(name: str = SEMANTIC_CACHE_EMBEDDER, configure: Optional[Callable[[], None]] = None):
+    """
+    Build the embedder named in config: "hashing" (local) or "bedrock" (Settings.embed_model,
+    resolved on first use after calling `configure`, which should configure the models).
+    """
+    if name == 'hashing':
+        return HashingEmbedder()
+    if name == 'bedrock':
+        return LlamaIndexEmbedder(configure=configure)
+    raise ValueError(f"Unknown semantic cache embedder '{name}'")
+
+
+class SemanticHit(NamedTuple):
+    entry_id: tuple
+    similarity: float
+    result: dict
+
+
+class SemanticCache:
+    """
+    Near-duplicate completion cache over normalized, embedded prefixes.
+
+    Embeddings live in one preallocated float32 matrix, so a lookup is a single
+    matrix-vector product. A hit requires cosine similarity of at least
+    `threshold`. Entries expire after `ttl` seconds. When the cache is full,
+    an expired slot is reused if there is one, otherwise the least recently
+    used slot is evicted.
+
+    Because a hit returns a completion computed for a different prefix, a
+    sample of hits can be re-checked with `verify()`. A hit whose fresh
+    completion differs is counted as a false hit and evicted.
+    """
+
+    def __init__(
+        self,
+        embedder=None,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+        ttl: float = SEMANTIC_CACHE_TTL,
+        verify_rate: float = SEMANTIC_CACHE_VERIFY_RATE,
+    ):
+        self.embedder = embedder or create_embedder()
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.verify_rate = verify_rate
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._expires_at = np.zeros(max_entries, dtype=np.float64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._versions = np.zeros(max_entries, dtype=np.int64)
+        self._texts = [None] * max_entries
+        self._results = [None] * max_entries
+        self._slots = {}  # normalized text -> slot
+        self._size = 0
+
+    def lookup(self, prefix_code: str) -> Optional[SemanticHit]:
+        """Return the closest cached completion if it is similar enough, else None."""
+        query = self.embedder.embed(normalize_rust(prefix_code))
+        now = time.time()
+        with self._lock:
+            if self._size == 0:
+                metrics.incr("semantic_cache.misses")
+                return None
+            similarities = self._matrix[:self._size] @ query
+            similarities[self._expires_at[:self._size] <= now] = -np.inf
+            slot = int(np.argmax(similarities))
+            similarity = float(similarities[slot])
+            if similarity < self.threshold:
+                metrics.incr("semantic_cache.misses")
+                return None
+            self._last_used[slot] = now
+            metrics.incr("semantic_cache.hits")
+            return SemanticHit((slot, int(self._versions[slot])), similarity, self._results[slot])
+
+    def add(self, prefix_code: str, result: dict):
+        """Cache `result` as the completion for `prefix_code`."""
+        text = normalize_rust(prefix_code)
+        vector = self.embedder.embed(text)
+        now = time.time()
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            slot = self._slots.get(text)
+            if slot is None:
+                slot = self._free_slot(now)
+                self._slots[text] = slot
+            self._matrix[slot] = vector
+            self._expires_at[slot] = now + self.ttl
+            self._last_used[slot] = now
+            self._versions[slot] += 1
+            self._texts[slot] = text
+            self._results[slot] = result
+
+    def _free_slot(self, now: float) -> int:
+        if self._size < self.max_entries:
+            self._size += 1
+            return self._size - 1
+        expired = np.flatnonzero(self._expires_at <= now)
+        slot = int(expired[0]) if len(expired) else int(np.argmin(self._last_used))
+        metrics.incr("semantic_cache.evictions")
+        self._slots.pop(self._texts[slot], None)
+        return slot
+
+    def should_verify(self) -> bool:
+        """Sample whether the current hit should be re-checked against a fresh completion."""
+        return random.random() < self.verify_rate
+
+    def verify(self, hit: SemanticHit, fresh_result: dict) -> bool:
+        """
+        Compare a served hit with a fresh completion for the same request. Returns False and
+        evicts the entry if the completions differ.
+        """
+        metrics.incr("semantic_cache.verifications")
+        served = normalize_rust(hit.result.get("generated_code", ""))
+        fresh = normalize_rust(fresh_result.get("generated_code", ""))
+        if served == fresh:
+            return True
+        metrics.incr("semantic_cache.false_hits")
+        slot, version = hit.entry_id
+        with self._lock:
+            if self._versions[slot] == version:
+                self._expires_at[slot] = 0.0
+        return False
+
+    def clear(self):
+        """Expire every entry."""
+        with self._lock:
+            self._expires_at[:] = 0.0
+            self._slots.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        """Number of live entries held."""
+        with self._lock:
+            return {"entries": int(np.count_nonzero(self._expires_at[:self._size] > time.time()))}
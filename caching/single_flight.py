@@ -0,0 +1,194 @@
+import json
+import uuid
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+from redis.exceptions import RedisError
+
+from common.utils import load_config
+from common.metrics import metrics
+from caching.redis_cache import AsyncRedisCache
+
+logger = logging.getLogger(__name__)
+
+config = load_config()
+
+# The leader renews its lock every third of the TTL, so a lock outlives a dead leader by at most the TTL
+SINGLE_FLIGHT_LOCK_TTL = config.get('SINGLE_FLIGHT_LOCK_TTL', 15)
+SINGLE_FLIGHT_WAIT_TIMEOUT = config.get('SINGLE_FLIGHT_WAIT_TIMEOUT', 60)
+# How often followers check that the leader still holds its lock
+SINGLE_FLIGHT_POLL_INTERVAL = config.get('SINGLE_FLIGHT_POLL_INTERVAL', 1.0)
+
+# Published instead of a result when the leader's computation failed
+FAILED_MARKER = "__single_flight_failed__"
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent computations of the same cache key.
+
+    Inside a worker, the first caller for a key starts the computation and
+    later callers await the same task. Across workers, the leader holds a Redis
+    lock `<prefix>:lock:<key>` while computing and publishes the result on
+    `<prefix>:done:<key>`; followers in other workers wait for that message
+    through one shared pattern subscription instead of computing it again.
+    The leader renews its lock while computing. If its computation fails it
+    publishes a failure marker, and followers compute themselves at once; if
+    its process dies, followers notice the lock expiring on their next poll.
+
+    The `compute` coroutine is expected to write its result to the cache
+    before returning, so a follower that subscribes after the publish still
+    finds it there.
+    """
+
+    def __init__(
+        self,
+        cache: AsyncRedisCache,
+        lock_ttl: float = SINGLE_FLIGHT_LOCK_TTL,
+        wait_timeout: float = SINGLE_FLIGHT_WAIT_TIMEOUT,
+        prefix: str = "singleflight",
+        poll_interval: float = SINGLE_FLIGHT_POLL_INTERVAL,
+    ):
+        self.cache = cache
+        self.lock_ttl = lock_ttl
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.prefix = prefix
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._listener: Optional[asyncio.Task] = None
+
+    async def do(self, key: str, compute: Callable[[], Awaitable[dict]]) -> dict:
+        """Return the result for `key`, sharing any computation already in flight."""
+        task = self._inflight.get(key)
+        if task is None:
+            metrics.incr("single_flight.leaders")
+            task = asyncio.ensure_future(self._run(key, compute))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            metrics.incr("single_flight.coalesced_local")
+        # Shield so a disconnecting caller does not cancel the shared computation
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            metrics.incr("single_flight.errors")
+
+    async def _run(self, key: str, compute: Callable[[], Awaitable[dict]]) -> dict:
+        lock_name = f"{self.prefix}:lock:{key}"
+        channel = f"{self.prefix}:done:{key}"
+        token = uuid.uuid4().hex
+
+        acquired = await self.cache.acquire_lock(lock_name, token, self.lock_ttl)
+        if acquired is None:
+            # Redis is down: coalesce within this worker only
+            return await compute()
+        if acquired:
+            heartbeat = asyncio.ensure_future(self._renew_lock(lock_name, token))
+            try:
+                result = await compute()
+                await self.cache.publish(channel, result)
+                return result
+            except Exception:
+                await self.cache.publish(channel, {FAILED_MARKER: True})
+                raise
+            finally:
+                heartbeat.cancel()
+                await self.cache.release_lock(lock_name, token)
+
+        result = await self._wait_for_remote(key, lock_name, channel)
+        if result is not None:
+            metrics.incr("single_flight.coalesced_remote")
+            return result
+        return await compute()
+
+    async def _renew_lock(self, lock_name: str, token: str):
+        """Keep the lock of a running computation from expiring."""
+        while True:
+            await asyncio.sleep(self.lock_ttl / 3)
+            await self.cache.extend_lock(lock_name, token, self.lock_ttl)
+
+    async def _wait_for_remote(self, key: str, lock_name: str, channel: str) -> Optional[dict]:
+        """
+        Wait for another worker to publish the result for `key`. None if it failed, stopped
+        holding its lock without publishing or did not finish within `wait_timeout`.
+        """
+        if not await self._ensure_listener():
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(channel, []).append(future)
+        try:
+            # The leader may have finished between our lock attempt and subscribing
+            cached_result = await self.cache.get(key)
+            if cached_result:
+                return cached_result
+            if not await self.cache.lock_exists(lock_name):
+                return None
+            deadline = asyncio.get_running_loop().time() + self.wait_timeout
+            while True:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    metrics.incr("single_flight.remote_timeouts")
+                    return None
+                try:
+                    result = await asyncio.wait_for(asyncio.shield(future), min(self.poll_interval, remaining))
+                    break
+                except asyncio.TimeoutError:
+                    pass
+                if not await self.cache.lock_exists(lock_name):
+                    # Finished just now, or its worker died
+                    result = await self.cache.get(key)
+                    if not result:
+                        metrics.incr("single_flight.leader_lost")
+                    return result or None
+            if FAILED_MARKER in result:
+                metrics.incr("single_flight.remote_failures")
+                return None
+            return result
+        finally:
+            waiters = self._waiters.get(channel, [])
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters:
+                self._waiters.pop(channel, None)
+
+    async def _ensure_listener(self) -> bool:
+        """Start the shared pattern subscription the first time it is needed."""
+        if self._listener is not None and not self._listener.done():
+            return True
+        pubsub = self.cache.client.pubsub()
+        try:
+            await pubsub.psubscribe(f"{self.prefix}:done:*")
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            logger.warning(f"Could not subscribe for single-flight results: {e!r}")
+            await pubsub.aclose()
+            return False
+        self._listener = asyncio.ensure_future(self._listen(pubsub))
+        return True
+
+    async def _listen(self, pubsub):
+        try:
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None:
+                    continue
+                channel = message["channel"].decode()
+                result = json.loads(message["data"])
+                for future in self._waiters.pop(channel, []):
+                    if not future.done():
+                        future.set_result(result)
+        except (RedisError, OSError) as e:
+            logger.warning(f"Single-flight listener stopped: {e!r}")
+        finally:
+            await pubsub.aclose()
+
+    async def close(self):
+        """Stop the shared subscription."""
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
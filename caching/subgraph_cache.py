@@ -0,0 +1,115 @@
+import re
+import json
+import asyncio
+import logging
+from typing import Dict, List, Optional, Sequence
+
+from caching.redis_cache import AsyncRedisCache, LocalLRUCache
+from common.subgraph import Edge, subgraph_id, subgraph_html, subgraph_json
+from common.utils import load_config
+from common.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+config = load_config()
+
+# Edge sets and renderings outlive the completions that reference them
+SUBGRAPH_TTL = config.get('SUBGRAPH_TTL', 86400)
+SUBGRAPH_LOCAL_MAX_ENTRIES = config.get('SUBGRAPH_LOCAL_MAX_ENTRIES', 2000)
+SUBGRAPH_LOCAL_MAX_BYTES = config.get('SUBGRAPH_LOCAL_MAX_BYTES', 32 * 1024 * 1024)
+
+SUBGRAPH_KEY_PREFIX = 'subgraph'
+SUBGRAPH_FORMATS = ("html", "json")
+SUBGRAPH_ID_PATTERN = re.compile(r"^[0-9a-f]{24}$")
+
+
+class SubgraphCache:
+    """
+    Edge sets of completions by subgraph ID, and their visualizations rendered on demand.
+
+    The completion path only stores the parsed edges under their `subgraph_id`, a hash of
+    the edge set, so identical subgraphs share one entry. The pyvis HTML page is rendered
+    on a worker thread the first time it is requested and cached in Redis and the local
+    tier; concurrent requests for the same page in one worker wait for a single render.
+    The JSON form is cheap and built from the edges on every request. Like the completion
+    cache, both tiers degrade to misses while Redis is down; edges stored meanwhile can
+    then only be rendered by the worker that stored them.
+    """
+
+    def __init__(self, redis_cache: AsyncRedisCache, ttl: float = SUBGRAPH_TTL, local: Optional[LocalLRUCache] = None):
+        self.redis = redis_cache
+        self.ttl = ttl
+        self.local = local if local is not None else LocalLRUCache(
+            max_entries=SUBGRAPH_LOCAL_MAX_ENTRIES, max_bytes=SUBGRAPH_LOCAL_MAX_BYTES, ttl=ttl)
+        self._renders: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def key(graph_id: str, kind: str = "edges") -> str:
+        return f"{SUBGRAPH_KEY_PREFIX}:{graph_id}:{kind}"
+
+    async def _get(self, key: str) -> Optional[dict]:
+        value = self.local.get(key)
+        if value is None:
+            value = await self.redis.get(key)
+            if value is not None:
+                self.local.set(key, value, len(json.dumps(value)))
+        return value
+
+    async def _set(self, key: str, value: dict):
+        self.local.set(key, value, len(json.dumps(value)))
+        await self.redis.set(key, value, expiry=int(self.ttl))
+
+    async def put(self, edges: Sequence[Edge]) -> Optional[str]:
+        """Store `edges` and return their subgraph ID, or None if there are none."""
+        if not edges:
+            return None
+        graph_id = subgraph_id(edges)
+        key = self.key(graph_id)
+        # Already stored by this worker, and Redis keeps it at least as long
+        if self.local.get(key) is None:
+            await self._set(key, {"edges": [list(edge) for edge in edges]})
+        return graph_id
+
+    async def edges(self, graph_id: str) -> Optional[List[Edge]]:
+        """Edges stored under `graph_id`, or None if they are unknown or expired."""
+        if not SUBGRAPH_ID_PATTERN.match(graph_id):
+            return None
+        value = await self._get(self.key(graph_id))
+        return [tuple(edge) for edge in value["edges"]] if value is not None else None
+
+    async def render(self, graph_id: str, format: str = "html"):
+        """
+        The subgraph `graph_id` as an HTML page (a string) or as vis-network nodes and
+        edges (a dict), or None if its edges are unknown or expired.
+        """
+        if not SUBGRAPH_ID_PATTERN.match(graph_id):
+            return None
+        if format == "json":
+            edges = await self.edges(graph_id)
+            return subgraph_json(edges) if edges is not None else None
+        if format != "html":
+            raise ValueError(f"Unknown subgraph format {format!r}, expected one of {SUBGRAPH_FORMATS}")
+        render = self._renders.get(graph_id)
+        if render is None:
+            render = asyncio.ensure_future(self._render_html(graph_id))
+            self._renders[graph_id] = render
+            render.add_done_callback(lambda _: self._renders.pop(graph_id, None))
+        else:
+            metrics.incr("subgraph.render_coalesced")
+        # A client disconnecting must not cancel the render other requests wait for
+        return await asyncio.shield(render)
+
+    async def _render_html(self, graph_id: str) -> Optional[str]:
+        key = self.key(graph_id, "html")
+        cached = await self._get(key)
+        if cached is not None:
+            metrics.incr("subgraph.render_cache.hits")
+            return cached["html"]
+        edges = await self.edges(graph_id)
+        if edges is None:
+            return None
+        metrics.incr("subgraph.render_cache.misses")
+        with metrics.timer("subgraph.render"):
+            html = await asyncio.to_thread(subgraph_html, edges)
+        await self._set(key, {"html": html})
+        return html
@@ -0,0 +1,31 @@
+import os
+import sys
+import logging
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from common.utils import load_config
+from common.ann_index import build_ann_index_from_kg, QUANTIZATIONS
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+config = load_config()
+
+PERSIST_DISK_PATH = config['PERSIST_DISK_PATH']
+KG_ANN_PATH = config.get('KG_ANN_PATH', PERSIST_DISK_PATH.rstrip('/') + '_ann')
+
+
+if __name__ == "__main__":
+    # Build the ANN index the workers search when EMBEDDING_SEARCH is "ann". Re-run it whenever
+    # the KG is re-persisted; until then workers fall back to exact search.
+    parser = argparse.ArgumentParser(description="Build an IVF index over the quantized triplet embeddings of a persisted knowledge graph index")
+    parser.add_argument("--persist-dir", default=PERSIST_DISK_PATH)
+    parser.add_argument("--ann-dir", default=KG_ANN_PATH)
+    parser.add_argument("--n-lists", type=int, default=None, help="Number of inverted lists, sqrt(triplets) by default")
+    parser.add_argument("--quantization", choices=QUANTIZATIONS, default="int8")
+    parser.add_argument("--iterations", type=int, default=10, help="k-means iterations")
+    args = parser.parse_args()
+    build_ann_index_from_kg(args.persist_dir, args.ann_dir, n_lists=args.n_lists, quantization=args.quantization, iterations=args.iterations)
@@ -0,0 +1,30 @@
+import os
+import sys
+import logging
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from common.utils import load_config
+from common.kg_layout import build_kg_layout_from_kg
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+config = load_config()
+
+PERSIST_DISK_PATH = config['PERSIST_DISK_PATH']
+KG_LAYOUT_PATH = config.get('KG_LAYOUT_PATH', PERSIST_DISK_PATH.rstrip('/') + '_layout')
+
+
+if __name__ == "__main__":
+    # Build the layout the /v1/kg/layout endpoints and the full-KG plot serve. Re-run it whenever
+    # the KG is re-persisted; until then the endpoints answer 503.
+    parser = argparse.ArgumentParser(description="Compute node positions and communities of a persisted knowledge graph for visualization")
+    parser.add_argument("--persist-dir", default=PERSIST_DISK_PATH)
+    parser.add_argument("--layout-dir", default=KG_LAYOUT_PATH)
+    parser.add_argument("--iterations", type=int, default=10, help="Label propagation rounds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    build_kg_layout_from_kg(args.persist_dir, args.layout_dir, iterations=args.iterations, seed=args.seed)
@@ -0,0 +1,28 @@
+import os
+import sys
+import logging
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from common.utils import load_config
+from common.kg_snapshot import compile_snapshot
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+config = load_config()
+
+PERSIST_DISK_PATH = config['PERSIST_DISK_PATH']
+KG_SNAPSHOT_PATH = config.get('KG_SNAPSHOT_PATH', PERSIST_DISK_PATH.rstrip('/') + '_snapshot')
+
+
+if __name__ == "__main__":
+    # Compile the persisted KG served by the API into the binary snapshot the workers memory-map.
+    # Re-run it whenever the KG is re-persisted; until then workers fall back to the JSON files.
+    parser = argparse.ArgumentParser(description="Compile a persisted knowledge graph index into a memory-mappable snapshot")
+    parser.add_argument("--persist-dir", default=PERSIST_DISK_PATH)
+    parser.add_argument("--snapshot-dir", default=KG_SNAPSHOT_PATH)
+    args = parser.parse_args()
+    compile_snapshot(args.persist_dir, args.snapshot_dir)
@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import logging
+import argparse
+
+from dotenv import load_dotenv
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+
+from common.utils import load_config
+from common.repo_ingest import (
+    BlobStore, GitHubAPI, RepoIngester, repo_source, DEFAULT_BRANCHES, DEFAULT_EXTENSIONS
+)
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+config = load_config()
+
+REPO_BLOB_STORE_PATH = config.get('REPO_BLOB_STORE_PATH', '/home/ubuntu/dApp/repo_blobs')
+REPO_INGEST_PARALLELISM = config.get('REPO_INGEST_PARALLELISM', 4)
+GITHUB_API_CONCURRENCY = config.get('GITHUB_API_CONCURRENCY', 8)
+SOURCE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'source.txt')
+
+
+def ingest_repositories(locations, store_path=REPO_BLOB_STORE_PATH, github_token=None,
+                        parallelism=REPO_INGEST_PARALLELISM, concurrency=GITHUB_API_CONCURRENCY,
+                        branches=DEFAULT_BRANCHES, extensions=DEFAULT_EXTENSIONS):
+    """
+    Fetch the files of the repositories `locations` (GitHub URLs or local git repositories)
+    into the blob store at `store_path`. Returns the store and the result of each repository.
+    """
+    store = BlobStore(store_path)
+    api = GitHubAPI(github_token, concurrency=concurrency)
+    try:
+        sources = {}
+        for location in locations:
+            if not location.strip():
+                continue
+            try:
+                name, source = repo_source(location, api, branches)
+            except ValueError as e:
+                logger.warning(f"Skipping {location!r}: {e}")
+                continue
+            sources[name] = source
+        return store, RepoIngester(store, parallelism=parallelism, extensions=extensions).ingest(sources)
+    finally:
+        api.close()
+
+
+if __name__ == "__main__":
+    # Re-runs only download blobs that are not in the store yet. Local checkouts work as
+    # sources too, e.g. a source file listing /tmp/polkadot-sdk, to run without GitHub.
+    parser = argparse.ArgumentParser(description="Fetch the files of GitHub repositories into a local content-addressed store")
+    parser.add_argument("--sources", default=SOURCE_FILE, help="File with one GitHub URL or local repository path per line")
+    parser.add_argument("--store", default=REPO_BLOB_STORE_PATH, help="Directory of the blob store")
+    parser.add_argument("--parallelism", type=int, default=REPO_INGEST_PARALLELISM, help="Repositories ingested at once")
+    parser.add_argument("--concurrency", type=int, default=GITHUB_API_CONCURRENCY, help="GitHub API requests at once")
+    parser.add_argument("--branches", nargs="+", default=list(DEFAULT_BRANCHES), help="Branches tried in order")
+    parser.add_argument("--extensions", nargs="+", default=list(DEFAULT_EXTENSIONS), help="Extensions of the files fetched")
+    args = parser.parse_args()
+
+    load_dotenv()
+    with open(args.sources) as f:
+        locations = [line.strip() for line in f if line.strip()]
+    _, results = ingest_repositories(locations, args.store, os.getenv("GITHUB_TOKEN"), args.parallelism,
+                                     args.concurrency, args.branches, args.extensions)
+    print(json.dumps([result._asdict() for result in results], indent=2))
+    sys.exit(1 if any(result.status == "failed" for result in results) else 0)
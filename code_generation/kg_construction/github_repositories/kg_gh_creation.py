@@ -1,4 +1,5 @@
 import os
+import sys
 import nest_asyncio
 from jinja2 import Template
 from IPython.display import HTML, Markdown, display
@@ -21,6 +22,11 @@ from llama_index.core import Settings
 from llama_index.llms.bedrock import Bedrock
 from llama_index.embeddings.bedrock import BedrockEmbedding
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+
+from common.repo_ingest import load_documents
+from code_generation.kg_construction.github_repositories.ingest_repos import ingest_repositories
+
 
 # Configure logging
 logging.basicConfig(filename='logs.txt', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -218,30 +224,19 @@ def main():
 
     all_repos = load_source_data()
     logging.info(f"Total repositories to process: {len(all_repos)}")
-    gh_docs={}
-    # Load the GitHub documents for each repo
-    for repo in all_repos:
-        logging.info(f"Processing repo: {repo}")
-        owner, repo = extract_owner_repo(repo)
-        if owner and repo:
-            gh_docs[repo] = load_github_documents(github_token, owner, repo)
-            if gh_docs[repo]:
-                logging.info(f"Completed loading documents for repo: {owner}/{repo}, Number of documents: {len(gh_docs[repo])}")
-            else:
-                logging.warning(f"No documents loaded for repo: {owner}/{repo}")
-        else:
-            logging.warning(f"Invalid GitHub URL: {repo}")
-
-
-
+    # Fetch the repositories concurrently into the local blob store; files fetched by an
+    # earlier run are not downloaded again
+    store, results = ingest_repositories(all_repos, github_token=github_token)
 
     # Collapse all the docs into a single list
     documents = []
-    for repo in gh_docs.keys():
-        if gh_docs[repo] is not None:
-            documents.extend(gh_docs[repo])
-        else:
-            logging.info(f"Document with None value!")
+    for result in results:
+        if result.status == "failed":
+            logging.warning(f"No documents loaded for repo: {result.name}")
+            continue
+        repo_documents = load_documents(store, result.name)
+        logging.info(f"Completed loading documents for repo: {result.name}, Number of documents: {len(repo_documents)}")
+        documents.extend(repo_documents)
 
 
     #dumping the parsed documents
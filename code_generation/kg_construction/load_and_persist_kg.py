@@ -31,9 +31,6 @@ def get_cached_result(key: str) -> Optional[dict]:
 def set_cache_result(key: str, result: dict, expiry: int = 3600):
     redis_client.set(key, json.dumps(result), ex=expiry)
 
-def invalidate_cache():
-    redis_client.flushdb()  # This will clear all cache entries
-
 # Initialize S3 filesystem
 fs = s3fs.S3FileSystem(anon=False)
 
@@ -0,0 +1,57 @@
+import os
+import sys
+import json
+import logging
+import argparse
+
+from fsspec.core import url_to_fs
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from common.utils import load_config
+from common.kg_sync import KGSync, DEFAULT_RETRIES
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+config = load_config()
+
+BUCKET_NAME = config['BUCKET_NAME']
+PERSIST_DISK_PATH = config['PERSIST_DISK_PATH']
+KG_REGISTRY_DIR = config.get('KG_REGISTRY_DIR', os.path.dirname(PERSIST_DISK_PATH.rstrip('/')))
+KG_FOLDERS = config.get('KG_FOLDERS', [])
+KG_SYNC_PARALLELISM = config.get('KG_SYNC_PARALLELISM', 8)
+
+
+if __name__ == "__main__":
+    # Replaces load_and_persist_kg.py for provisioning: only new or changed files are downloaded,
+    # and an interrupted run continues where it stopped. Any fsspec URL works as the source,
+    # e.g. file:///tmp/kg_bucket to try it without S3.
+    parser = argparse.ArgumentParser(description="Sync persisted knowledge graph folders from S3 to local disk, downloading only changed files")
+    parser.add_argument("--source", default=f"s3://{BUCKET_NAME}", help="Bucket or directory holding the KG folders")
+    parser.add_argument("--dest", default=KG_REGISTRY_DIR, help="Local directory of the KGs, one subdirectory per folder")
+    parser.add_argument("--folders", nargs="+", default=KG_FOLDERS, help="KG folders relative to the source")
+    parser.add_argument("--parallelism", type=int, default=KG_SYNC_PARALLELISM, help="Files downloaded at once")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES)
+    parser.add_argument("--dry-run", action="store_true", help="Only list the files that would be downloaded")
+    args = parser.parse_args()
+
+    fs, source = url_to_fs(args.source)
+    sync = KGSync(fs, parallelism=args.parallelism, retries=args.retries)
+    # Local directories are named as load_and_persist_kg.py names them
+    folders = {
+        folder: (f"{source.rstrip('/')}/{folder}", os.path.join(args.dest, folder.replace('/', '_')))
+        for folder in dict.fromkeys(args.folders)
+    }
+    if args.dry_run:
+        plan = {}
+        for folder, (remote_dir, local_dir) in folders.items():
+            remote, changed = sync.plan(remote_dir, local_dir)
+            plan[folder] = {"files": len(remote), "changed": [file.path for file in changed],
+                            "bytes": sum(file.size for file in changed)}
+        print(json.dumps(plan, indent=2))
+        sys.exit(0)
+    results = sync.sync(folders)
+    print(json.dumps([result._asdict() for result in results], indent=2))
+    sys.exit(1 if any(result.status == "failed" for result in results) else 0)
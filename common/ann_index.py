@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import shutil
+import logging
+import numpy as np
+from typing import List, Optional, Sequence, Tuple
+
+from common.kg_snapshot import StringTable, _save, _load, MANIFEST_FILE
+from common.utils import kg_fingerprint
+
+logger = logging.getLogger(__name__)
+
+ANN_FORMAT_VERSION = 1
+QUANTIZATIONS = ("int8", "float16")
+# Rows assigned to centroids per matrix product
+_CHUNK_ROWS = 16384
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the most similar centroid of every row, computed in chunks to bound memory."""
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), _CHUNK_ROWS):
+        chunk = np.asarray(vectors[start:start + _CHUNK_ROWS], dtype=np.float32)
+        assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(vectors: np.ndarray, n_lists: int, iterations: int = 10, sample_size: int = 256, seed: int = 0) -> np.ndarray:
+    """
+    Spherical k-means on normalized `vectors`: `n_lists` unit centroids trained on at most
+    `sample_size` rows per list.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    sample = np.sort(rng.choice(n, size=min(n, n_lists * sample_size), replace=False))
+    training = np.asarray(vectors[sample], dtype=np.float32)
+    centroids = training[rng.choice(len(training), size=n_lists, replace=False)]
+    for _ in range(iterations):
+        assignments = _assign(training, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, training)
+        counts = np.bincount(assignments, minlength=n_lists)
+        # Empty lists restart from a random training row
+        empty = counts == 0
+        sums[empty] = training[rng.choice(len(training), size=int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids.astype(np.float32)
+
+
+def quantize(vectors: np.ndarray, quantization: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Encode normalized float32 `vectors`. "int8" stores each row scaled to [-127, 127]
+    with its float32 scale, "float16" stores the rows as half floats without scales.
+    """
+    if quantization == "float16":
+        return vectors.astype(np.float16), None
+    if quantization == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+
+
+def build_ann_index(ids: Sequence[str], embeddings: np.ndarray, ann_dir: str, n_lists: Optional[int] = None,
+                    quantization: str = "int8", iterations: int = 10, source_fingerprint: Optional[str] = None,
+                    seed: int = 0) -> dict:
+    """
+    Build an IVF index over `embeddings` (rows matching `ids`) in `ann_dir` and return its manifest.
+
+    The rows are clustered into `n_lists` inverted lists (sqrt(n) by default) by spherical
+    k-means and stored quantized, grouped by list, so probing a list reads one contiguous
+    slice. Like a KG snapshot, the index is a directory of `.npy` files written to a temporary
+    directory and renamed into place.
+    """
+    started_at = time.perf_counter()
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+    n = len(ids)
+    if n == 0:
+        raise ValueError("Cannot build an ANN index without embeddings")
+    vectors = _normalize(np.asarray(embeddings, dtype=np.float32))
+    n_lists = min(n, n_lists or max(1, int(np.sqrt(n))))
+
+    centroids = train_centroids(vectors, n_lists, iterations=iterations, seed=seed)
+    assignments = _assign(vectors, centroids)
+    order = np.argsort(assignments, kind="stable")
+    indptr = np.zeros(n_lists + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(assignments, minlength=n_lists))
+    codes, scales = quantize(vectors[order], quantization)
+
+    tmp_dir = ann_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    StringTable.save(tmp_dir, "ids", ids)
+    _save(tmp_dir, "centroids", centroids)
+    _save(tmp_dir, "lists.indptr", indptr)
+    # Original row of every stored code
+    _save(tmp_dir, "lists.rows", order.astype(np.int32))
+    _save(tmp_dir, "codes", codes)
+    if scales is not None:
+        _save(tmp_dir, "scales", scales)
+
+    sizes = np.diff(indptr)
+    manifest = {
+        "format_version": ANN_FORMAT_VERSION,
+        "source_fingerprint": source_fingerprint,
+        "quantization": quantization,
+        "count": n,
+        "dim": int(vectors.shape[1]),
+        "n_lists": n_lists,
+        "largest_list": int(sizes.max()),
+        "codes_mb": round((codes.nbytes + (scales.nbytes if scales is not None else 0)) / 2**20, 2),
+        "build_s": round(time.perf_counter() - started_at, 2),
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.exists(ann_dir):
+        old_dir = ann_dir.rstrip("/") + ".old"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.rename(ann_dir, old_dir)
+        os.rename(tmp_dir, ann_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    else:
+        os.rename(tmp_dir, ann_dir)
+    logger.info(f"Built ANN index {ann_dir}: {manifest}")
+    return manifest
+
+
+def build_ann_index_from_kg(persist_dir: str, ann_dir: str, **kwargs) -> dict:
+    """
+    Build the ANN index of the triplet embeddings of the KG persisted in `persist_dir`. Rows
+    follow the sorted triplets, as in a KG snapshot of the same KG, so the snapshot's float32
+    matrix can be used to re-rank ANN candidates.
+    """
+    with open(os.path.join(persist_dir, "index_store.json")) as f:
+        index_store = json.load(f)
+    index_structs = [s for s in index_store["index_store/data"].values() if s["__type__"] == "kg"]
+    if len(index_structs) != 1:
+        raise ValueError(f"Expected one knowledge graph index in {persist_dir}, found {len(index_structs)}")
+    embedding_dict = json.loads(index_structs[0]["__data__"]).get("embedding_dict", {})
+    triplets = sorted(embedding_dict)
+    embeddings = np.asarray([embedding_dict[t] for t in triplets], dtype=np.float32)
+    return build_ann_index(triplets, embeddings, ann_dir, source_fingerprint=kg_fingerprint(persist_dir), **kwargs)
+
+
+class ANNIndex:
+    """
+    IVF index over quantized triplet embeddings, memory-mapped read-only.
+
+    A query scores the `n_list` centroids, then only the codes of the `n_probe` most similar
+    lists, so raising `n_probe` trades latency for recall. With `rerank` > 0 and an `exact`
+    float32 matrix (rows in the same order, e.g. a KG snapshot's embeddings), the best
+    `k * rerank` candidates are re-scored exactly, which recovers most of the quantization
+    error. It has the `top_k`/`top_k_batch` interface of EmbeddingMatrix, so a KGRetriever can
+    search either.
+    """
+
+    def __init__(self, ann_dir: str, n_probe: int = 16, rerank: int = 0, exact: Optional[np.ndarray] = None):
+        self.ann_dir = ann_dir
+        with open(os.path.join(ann_dir, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        if self.manifest["format_version"] != ANN_FORMAT_VERSION:
+            raise ValueError(f"Unsupported ANN index format {self.manifest['format_version']} in {ann_dir}")
+        self.ids = StringTable.load(ann_dir, "ids")
+        self.centroids = _load(ann_dir, "centroids")
+        self.indptr = _load(ann_dir, "lists.indptr")
+        self.rows = _load(ann_dir, "lists.rows")
+        self.codes = _load(ann_dir, "codes")
+        self.scales = _load(ann_dir, "scales") if self.manifest["quantization"] == "int8" else None
+        self.n_probe = n_probe
+        self.rerank = rerank
+        if exact is not None and exact.shape != (len(self.ids), self.manifest["dim"]):
+            raise ValueError(f"Re-rank matrix of shape {exact.shape} does not match the ANN index {ann_dir}")
+        self.exact = exact
+
+    def is_current(self, persist_dir: str) -> bool:
+        """True if the index was built from the KG currently persisted in `persist_dir`."""
+        return self.manifest["source_fingerprint"] == kg_fingerprint(persist_dir)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _search(self, query: np.ndarray, centroid_scores: np.ndarray, k: int, n_probe: int, rerank: int) -> Tuple[List[float], List[str]]:
+        n_lists = len(centroid_scores)
+        probe = np.argpartition(centroid_scores, -n_probe)[-n_probe:] if n_probe < n_lists else np.arange(n_lists)
+        positions, scores = [], []
+        for list_id in probe:
+            start, end = int(self.indptr[list_id]), int(self.indptr[list_id + 1])
+            if start == end:
+                continue
+            list_scores = np.asarray(self.codes[start:end], dtype=np.float32) @ query
+            if self.scales is not None:
+                list_scores *= self.scales[start:end]
+            positions.append(np.arange(start, end))
+            scores.append(list_scores)
+        if not positions:
+            return [], []
+        positions, scores = np.concatenate(positions), np.concatenate(scores)
+
+        n_candidates = k * rerank if rerank and self.exact is not None else k
+        if n_candidates < len(scores):
+            best = np.argpartition(scores, -n_candidates)[-n_candidates:]
+            positions, scores = positions[best], scores[best]
+        rows = np.asarray(self.rows[positions], dtype=np.int64)
+        if n_candidates > k:
+            # Exact scores of the candidates; sorted rows keep the memory-mapped reads sequential
+            order = np.argsort(rows)
+            rows = rows[order]
+            scores = np.asarray(self.exact[rows], dtype=np.float32) @ query
+            if k < len(scores):
+                best = np.argpartition(scores, -k)[-k:]
+                rows, scores = rows[best], scores[best]
+        top = np.argsort(scores)[::-1]
+        return scores[top].tolist(), [self.ids[int(row)] for row in rows[top]]
+
+    def top_k(self, query_embedding: Sequence[float], k: int, n_probe: Optional[int] = None,
+              rerank: Optional[int] = None) -> Tuple[List[float], List[str]]:
+        """Approximate cosine similarities and IDs of the `k` most similar rows, best first."""
+        return self.top_k_batch([query_embedding], k, n_probe=n_probe, rerank=rerank)[0]
+
+    def top_k_batch(self, query_embeddings: Sequence[Sequence[float]], k: int, n_probe: Optional[int] = None,
+                    rerank: Optional[int] = None) -> List[Tuple[List[float], List[str]]]:
+        """`top_k` for several queries, scoring the centroids of all of them at once."""
+        if not len(self) or k <= 0:
+            return [([], []) for _ in query_embeddings]
+        n_probe = max(1, n_probe or self.n_probe)
+        rerank = self.rerank if rerank is None else rerank
+        queries = _normalize(np.asarray(query_embeddings, dtype=np.float32))
+        centroid_scores = queries @ self.centroids.T
+        return [self._search(query, scores, k, n_probe, rerank) for query, scores in zip(queries, centroid_scores)]
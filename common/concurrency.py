@@ -0,0 +1,147 @@
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from common.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Sentinel marking the end of a token stream
+_STREAM_END = object()
+
+
+class _StreamError:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+class AsyncQueryRunner:
+    """
+    Runs llama_index query engine calls without blocking the event loop.
+
+    At most `max_concurrency` queries execute at once per worker; further
+    callers wait on a semaphore. In "thread" mode the synchronous
+    `engine.query()` runs on a dedicated, equally sized thread pool. In
+    "native" mode the engine's own `aquery()` coroutine is awaited, which only
+    helps when every retriever and LLM in the pipeline implements a truly
+    asynchronous path.
+    """
+
+    MODES = ("thread", "native")
+
+    def __init__(self, max_concurrency: int = 8, mode: str = "thread"):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown inference mode '{mode}', expected one of {self.MODES}")
+        self.max_concurrency = max_concurrency
+        self.mode = mode
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="inference")
+
+    async def query(self, engine, query: str):
+        """Run `engine` on `query` and return its response."""
+        queued_at = time.perf_counter()
+        async with self._semaphore:
+            metrics.observe("inference.queue_wait", time.perf_counter() - queued_at)
+            with metrics.timer("inference.query"):
+                if self.mode == "native":
+                    return await engine.aquery(query)
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor, engine.query, query)
+
+    async def stream(self, engine, query: str, max_buffer: int = 32):
+        """
+        Run a streaming `engine` on `query` and yield its tokens.
+
+        Closing this generator (or cancelling the task iterating it) stops the
+        worker thread at the next token and closes the upstream generator,
+        which releases the LLM response stream.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=max_buffer)
+        cancelled = threading.Event()
+
+        def put(item) -> bool:
+            # Blocks while the queue is full; gives up once the consumer is gone
+            future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+            while not cancelled.is_set():
+                try:
+                    future.result(timeout=0.1)
+                    return True
+                except FutureTimeoutError:
+                    continue
+            future.cancel()
+            return False
+
+        def produce():
+            token_gen = None
+            try:
+                token_gen = engine.query(query).response_gen
+                for token in token_gen:
+                    if cancelled.is_set() or not put(token):
+                        metrics.incr("inference.stream_aborted")
+                        return
+                put(_STREAM_END)
+            except Exception as e:
+                put(_StreamError(e))
+            finally:
+                if token_gen is not None and hasattr(token_gen, "close"):
+                    token_gen.close()
+
+        queued_at = time.perf_counter()
+        async with self._semaphore:
+            metrics.observe("inference.queue_wait", time.perf_counter() - queued_at)
+            started_at = time.perf_counter()
+            producer = loop.run_in_executor(self._executor, produce)
+            try:
+                while True:
+                    item = await queue.get()
+                    if item is _STREAM_END:
+                        break
+                    if isinstance(item, _StreamError):
+                        raise item.error
+                    yield item
+            finally:
+                cancelled.set()
+                metrics.observe("inference.stream", time.perf_counter() - started_at)
+                if not producer.done():
+                    # Let the worker thread notice the cancellation without awaiting it here
+                    producer.add_done_callback(lambda f: f.exception())
+
+    def shutdown(self):
+        """Stop accepting work and release the thread pool."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class InFlight:
+    """
+    Counts the requests using a resource, such as a bundle of query engines, so whoever
+    replaces it can wait for the last of them to finish before releasing it.
+    """
+
+    def __init__(self):
+        self._count = 0
+        self._idle = threading.Condition()
+
+    def __len__(self) -> int:
+        return self._count
+
+    @contextmanager
+    def track(self):
+        """Count the enclosed block as one request in flight."""
+        with self._idle:
+            self._count += 1
+        try:
+            yield
+        finally:
+            with self._idle:
+                self._count -= 1
+                if self._count == 0:
+                    self._idle.notify_all()
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        """Block until no request is in flight, returning False if `timeout` seconds passed first."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._count == 0, timeout=timeout)
@@ -0,0 +1,126 @@
+import re
+from typing import Optional
+
+# Matches the opening of the value, e.g. `"fill_in_middle": "`. The prompt's
+# example uses an unquoted key, so quotes around the key are optional.
+OPENER_PATTERN = re.compile(r'["\']?fill_in_middle["\']?\s*:\s*"')
+CODE_FENCE_PATTERN = re.compile(r'```(json|rust|)\s*')
+
+SIMPLE_ESCAPES = {
+    '"': '"', '\\': '\\', '/': '/',
+    'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t',
+}
+
+_SEEK, _STRING, _ESCAPE, _UNICODE, _DONE = range(5)
+
+
+class FillInMiddleExtractor:
+    """
+    Incrementally decodes the `fill_in_middle` string from a streamed JSON answer.
+
+    Feed raw model tokens with `feed()`; it returns the code characters decoded
+    so far, starting as soon as the `"fill_in_middle": "` opener has arrived.
+    `done` becomes True once the closing quote is seen, at which point the
+    upstream generation can be stopped. JSON escapes, including `\\uXXXX`
+    sequences and surrogate pairs split across tokens, are decoded. Raw
+    newlines inside the string, which the model sometimes emits, are kept.
+    """
+
+    def __init__(self):
+        self._state = _SEEK
+        self._raw = ""
+        self._hex = ""
+        self._high_surrogate = None
+
+    @property
+    def found(self) -> bool:
+        """True once the opener of the value has been seen."""
+        return self._state != _SEEK
+
+    @property
+    def done(self) -> bool:
+        """True once the closing quote of the value has been seen."""
+        return self._state == _DONE
+
+    def feed(self, chunk: str) -> str:
+        """Consume `chunk` and return the newly decoded code characters."""
+        if self._state == _SEEK:
+            self._raw += chunk
+            match = OPENER_PATTERN.search(self._raw)
+            if not match:
+                return ""
+            chunk = self._raw[match.end():]
+            self._raw = ""
+            self._state = _STRING
+
+        out = []
+        for char in chunk:
+            if self._state == _STRING:
+                if char == '"':
+                    self._state = _DONE
+                    break
+                if char == '\\':
+                    self._state = _ESCAPE
+                else:
+                    self._emit(out, char)
+            elif self._state == _ESCAPE:
+                if char == 'u':
+                    self._hex = ""
+                    self._state = _UNICODE
+                else:
+                    # Unknown escapes are kept verbatim rather than dropped
+                    self._emit(out, SIMPLE_ESCAPES.get(char, '\\' + char))
+                    self._state = _STRING
+            elif self._state == _UNICODE:
+                self._hex += char
+                if len(self._hex) == 4:
+                    self._emit_code_point(out, self._hex)
+                    self._state = _STRING
+            else:
+                break
+        return "".join(out)
+
+    def flush(self) -> str:
+        """
+        Return the text that could not be decoded at the end of the stream.
+
+        If the model ignored the JSON format this is the whole answer with code
+        fences removed; otherwise it is empty.
+        """
+        if self._state != _SEEK:
+            return ""
+        raw, self._raw = self._raw, ""
+        return CODE_FENCE_PATTERN.sub('', raw).strip()
+
+    def _emit(self, out, text: str):
+        if self._high_surrogate is not None:
+            # A lone high surrogate cannot be encoded; drop it
+            self._high_surrogate = None
+        out.append(text)
+
+    def _emit_code_point(self, out, hex_digits: str):
+        try:
+            code_point = int(hex_digits, 16)
+        except ValueError:
+            self._emit(out, '\\u' + hex_digits)
+            return
+        if 0xD800 <= code_point <= 0xDBFF:
+            self._high_surrogate = code_point
+        elif 0xDC00 <= code_point <= 0xDFFF and self._high_surrogate is not None:
+            combined = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code_point - 0xDC00)
+            self._high_surrogate = None
+            out.append(chr(combined))
+        else:
+            self._emit(out, chr(code_point))
+
+
+def extract_fill_in_middle(generated_code: str) -> Optional[str]:
+    """
+    Extract the decoded `fill_in_middle` value from a complete model answer in a single pass.
+    Returns None if the answer contains no `fill_in_middle` value.
+    """
+    extractor = FillInMiddleExtractor()
+    value = extractor.feed(generated_code)
+    if not extractor.found:
+        return None
+    return value
@@ -0,0 +1,259 @@
+import os
+import json
+import logging
+import fsspec
+import numpy as np
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from llama_index.core.graph_stores.types import DEFAULT_PERSIST_FNAME, GraphStore
+
+logger = logging.getLogger(__name__)
+
+# Edges followed from each node at depth 1, 2, 3, ...; the last cap applies to deeper levels
+DEFAULT_FANOUT = (10, 5, 3)
+
+
+class Interner:
+    """
+    Two-way map between strings and dense integer IDs.
+
+    The base names are a list or a read-only StringTable. Names added later get
+    the next free IDs. Sorted base tables (the snapshot's) are searched in place
+    with `find`, instead of being copied into a dict.
+    """
+
+    def __init__(self, names: Sequence[str] = (), sorted_table: bool = False):
+        self._names = names
+        self._ids = None if sorted_table else {name: i for i, name in enumerate(names)}
+        self._added: List[str] = []
+        self._added_ids: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._names) + len(self._added)
+
+    def __getitem__(self, i: int) -> str:
+        return self._names[i] if i < len(self._names) else self._added[i - len(self._names)]
+
+    def id(self, name: str) -> int:
+        """ID of `name`, or -1."""
+        i = self._ids.get(name, -1) if self._ids is not None else self._names.find(name)
+        return i if i >= 0 else self._added_ids.get(name, -1)
+
+    def add(self, name: str) -> int:
+        """ID of `name`, interning it first if it is new."""
+        i = self.id(name)
+        if i < 0:
+            i = len(self)
+            self._added.append(name)
+            self._added_ids[name] = i
+        return i
+
+
+class CSRGraphStore(GraphStore):
+    """
+    Graph store with interned entity and relation IDs and CSR adjacency arrays.
+
+    The out-edges of entity `i` are `rel_ids[indptr[i]:indptr[i + 1]]` and
+    `obj_ids[...]` in insertion order, so listing the neighbours of a hub is one
+    array slice. Edges upserted or deleted after the arrays were built are kept
+    in a small overlay. Persisting writes the SimpleGraphStore JSON layout, so
+    the KG on disk keeps the same format.
+
+    Rel-map queries run one breadth-first search over all requested subjects
+    instead of recursing from each one:
+
+    - depth 1 edges of every subject come before any depth 2 edge, so the shared
+      `limit` keeps the closest context;
+    - at depth d at most `fanout[d - 1]` edges are followed per node;
+    - an entity already reached is not expanded again and the same edge is
+      returned once, which bounds the work on cyclic graphs and hubs like "Rust".
+
+    The paths are returned in SimpleGraphStore's shape,
+    `{subject: [[subj, rel, obj], ...]}`, with each triplet under the subject
+    whose search reached it.
+    """
+
+    def __init__(self, entities: Interner, relations: Interner, indptr: np.ndarray, rel_ids: np.ndarray,
+                 obj_ids: np.ndarray, subjects: Optional[Sequence[int]] = None, fanout: Sequence[int] = DEFAULT_FANOUT):
+        self._entities = entities
+        self._relations = relations
+        self._indptr = indptr
+        self._rel_ids = rel_ids
+        self._obj_ids = obj_ids
+        # Subjects in their original order, which rel-map queries over all subjects follow
+        self._subjects = list(subjects) if subjects is not None else [int(i) for i in np.flatnonzero(np.diff(indptr))]
+        self._base_count = len(indptr) - 1
+        self._added_edges: Dict[int, List[Tuple[int, int]]] = {}
+        self._deleted: set = set()
+        self.fanout = tuple(fanout)
+        self._fs = fsspec.filesystem("file")
+
+    @classmethod
+    def from_graph_dict(cls, graph_dict: Dict[str, List[List[str]]], **kwargs) -> "CSRGraphStore":
+        """
+        Build the store from SimpleGraphStore's `{subj: [[rel, obj], ...]}`. SimpleGraphStore
+        appends every extracted triplet, so repeated (rel, obj) pairs of a subject are kept once.
+        """
+        graph_dict = {subj: list(dict.fromkeys((rel, obj) for rel, obj in edges)) for subj, edges in graph_dict.items()}
+        entities = Interner(list(dict.fromkeys(
+            [subj for subj in graph_dict] + [obj for edges in graph_dict.values() for _, obj in edges]
+        )))
+        relations = Interner(list(dict.fromkeys(rel for edges in graph_dict.values() for rel, _ in edges)))
+        degrees = np.zeros(len(entities), dtype=np.int64)
+        for subj, edges in graph_dict.items():
+            degrees[entities.id(subj)] = len(edges)
+        indptr = np.zeros(len(entities) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(degrees)
+        rel_ids = np.empty(indptr[-1], dtype=np.int32)
+        obj_ids = np.empty(indptr[-1], dtype=np.int32)
+        for subj, edges in graph_dict.items():
+            start = indptr[entities.id(subj)]
+            rel_ids[start:start + len(edges)] = [relations.id(rel) for rel, _ in edges]
+            obj_ids[start:start + len(edges)] = [entities.id(obj) for _, obj in edges]
+        subjects = [entities.id(subj) for subj in graph_dict]
+        return cls(entities, relations, indptr, rel_ids, obj_ids, subjects=subjects, **kwargs)
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str, fs: Optional[fsspec.AbstractFileSystem] = None, **kwargs) -> "CSRGraphStore":
+        """Load a graph persisted by SimpleGraphStore (or by this store)."""
+        fs = fs or fsspec.filesystem("file")
+        if not fs.exists(persist_path):
+            logger.warning(f"No existing graph store found at {persist_path}, starting with an empty graph")
+            return cls.from_graph_dict({}, **kwargs)
+        with fs.open(persist_path, "r") as f:
+            return cls.from_graph_dict(json.load(f).get("graph_dict", {}), **kwargs)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, fs: Optional[fsspec.AbstractFileSystem] = None, **kwargs) -> "CSRGraphStore":
+        return cls.from_persist_path(os.path.join(persist_dir, DEFAULT_PERSIST_FNAME), fs=fs, **kwargs)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, **kwargs) -> "CSRGraphStore":
+        """Serve the memory-mapped graph of a KG snapshot without copying it."""
+        return cls(
+            Interner(snapshot.entities, sorted_table=True),
+            Interner(snapshot.relations, sorted_table=True),
+            snapshot.graph_indptr,
+            snapshot.graph_relations,
+            snapshot.graph_objects,
+            subjects=snapshot.graph_subjects.tolist(),
+            **kwargs,
+        )
+
+    @property
+    def client(self) -> None:
+        return None
+
+    def _edges(self, i: int, cap: Optional[int] = None) -> List[Tuple[int, int]]:
+        """
+        Distinct (relation ID, object ID) out-edges of entity `i`, at most `cap` of them.
+        Snapshots keep the duplicate edges of the JSON graph, so they are skipped here before
+        they count against the cap; the arrays are read `cap` edges at a time.
+        """
+        edges, seen = [], set()
+        if i < self._base_count:
+            start, end = int(self._indptr[i]), int(self._indptr[i + 1])
+            step = end - start if cap is None else max(cap, 1)
+            while start < end and (cap is None or len(edges) < cap):
+                stop = min(end, start + step)
+                for edge in zip(self._rel_ids[start:stop].tolist(), self._obj_ids[start:stop].tolist()):
+                    if edge in seen or (i, *edge) in self._deleted:
+                        continue
+                    seen.add(edge)
+                    edges.append(edge)
+                start = stop
+        edges += [edge for edge in self._added_edges.get(i, []) if edge not in seen]
+        return edges if cap is None else edges[:cap]
+
+    def get(self, subj: str) -> List[List[str]]:
+        """Get triplets."""
+        i = self._entities.id(subj)
+        if i < 0:
+            return []
+        return [[self._relations[r], self._entities[o]] for r, o in self._edges(i)]
+
+    def get_rel_map(self, subjs: Optional[List[str]] = None, depth: int = 2, limit: int = 30) -> Dict[str, List[List[str]]]:
+        """Get depth-aware rel map."""
+        if subjs is None:
+            subjs = [self._entities[i] for i in self.subjects()]
+        rel_map = {subj: [] for subj in subjs}
+        # (subject the search started from, entity) pairs to expand at the current depth
+        frontier = [(subj, i) for subj in rel_map for i in [self._entities.id(subj)] if i >= 0]
+        visited = {i for _, i in frontier}
+        seen_edges = set()
+        count = 0
+        for level in range(depth):
+            if not frontier or count >= limit:
+                break
+            cap = self.fanout[min(level, len(self.fanout) - 1)]
+            next_frontier = []
+            for subj, i in frontier:
+                for r, o in self._edges(i, cap):
+                    if (i, r, o) in seen_edges:
+                        continue
+                    seen_edges.add((i, r, o))
+                    rel_map[subj].append([self._entities[i], self._relations[r], self._entities[o]])
+                    count += 1
+                    if count >= limit:
+                        break
+                    if o not in visited:
+                        visited.add(o)
+                        next_frontier.append((subj, o))
+                if count >= limit:
+                    break
+            frontier = next_frontier
+        return rel_map
+
+    def subjects(self) -> Iterator[int]:
+        """IDs of the entities with out-edges, in the order they were first added."""
+        for i in self._subjects:
+            if i in self._added_edges or self._deleted:
+                if self._edges(i, 1):
+                    yield i
+            else:
+                yield i
+        for i in self._added_edges:
+            if i >= self._base_count or self._indptr[i] == self._indptr[i + 1]:
+                if self._added_edges[i]:
+                    yield i
+
+    def upsert_triplet(self, subj: str, rel: str, obj: str) -> None:
+        """Add triplet."""
+        i, r, o = self._entities.add(subj), self._relations.add(rel), self._entities.add(obj)
+        if (i, r, o) in self._deleted:
+            self._deleted.discard((i, r, o))
+        elif (r, o) not in self._edges(i):
+            self._added_edges.setdefault(i, []).append((r, o))
+
+    def delete(self, subj: str, rel: str, obj: str) -> None:
+        """Delete triplet."""
+        i, r, o = self._entities.id(subj), self._relations.id(rel), self._entities.id(obj)
+        if min(i, r, o) < 0:
+            return
+        added = self._added_edges.get(i, [])
+        if (r, o) in added:
+            added.remove((r, o))
+        elif (r, o) in self._edges(i):
+            self._deleted.add((i, r, o))
+
+    def to_dict(self) -> dict:
+        """The graph in SimpleGraphStore's serialized form."""
+        return {"graph_dict": {
+            self._entities[i]: [[self._relations[r], self._entities[o]] for r, o in self._edges(i)]
+            for i in self.subjects()
+        }}
+
+    def persist(self, persist_path: str, fs: Optional[fsspec.AbstractFileSystem] = None) -> None:
+        """Persist the graph in SimpleGraphStore's JSON layout."""
+        fs = fs or self._fs
+        dirpath = os.path.dirname(persist_path)
+        if not fs.exists(dirpath):
+            fs.makedirs(dirpath)
+        with fs.open(persist_path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    def get_schema(self, refresh: bool = False) -> str:
+        raise NotImplementedError("CSRGraphStore does not support get_schema")
+
+    def query(self, query: str, param_map: Optional[Dict[str, Any]] = {}) -> Any:
+        raise NotImplementedError("CSRGraphStore does not support query")
@@ -1,17 +1,40 @@
 import os
+import gc
+import time
+import ctypes
+import asyncio
+import threading
 import s3fs
 import logging
 import wandb
+from contextlib import aclosing, asynccontextmanager
+from typing import NamedTuple, Optional
 import networkx as nx
 from jinja2 import Template
 from llama_index.core import StorageContext, load_index_from_storage
 from common.config import Settings
-from common.utils import plot_subgraph_via_edges, load_config
+from common.utils import plot_subgraph_via_edges, load_config, kg_fingerprint, file_fingerprint
+from common.subgraph import parse_edges, subgraph_iframe
+from caching.redis_cache import cache_namespace
 from common.models import AnswerFormat
 from pyvis.network import Network
 from common.config import configure_settings
+from common.concurrency import AsyncQueryRunner, InFlight
+from common.fill_in_middle import FillInMiddleExtractor
+from common.metrics import metrics
+from common.startup import startup_timings
+from common.kg_snapshot import KGSnapshot, SnapshotEmbeddingDict, MANIFEST_FILE
+from common.retrieval import EmbeddingMatrix, NO_RELATIONSHIPS_TEXT, kg_query_engine, kg_retriever
+from common.kg_registry import KGRegistry, FederatedRetriever, UnknownKG, kg_dir, estimate_kg_bytes
+from common.ann_index import ANNIndex
+from common.kg_layout import KGLayout
+from common.keyword_extraction import EntityIndex, RustKeywordExtractor
+from common.graph_store import CSRGraphStore, DEFAULT_FANOUT
+from common.synthesis import PackedContextSynthesizer, DEFAULT_CONTEXT_BUDGET
+from caching.query_cache import EmbeddingCache, RetrievalCache, create_redis_client, query_namespace
 from llama_index.core.llms import ChatMessage
 from llama_index.core import PromptTemplate
+from llama_index.core.query_engine import RetrieverQueryEngine
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -24,6 +47,69 @@ BUCKET_NAME = config['BUCKET_NAME']
 FOLDER_NAME = config['FOLDER_NAME']
 S3_PATH = config['S3_PATH']
 PERSIST_DISK_PATH = config['PERSIST_DISK_PATH']
+KG_SNAPSHOT_PATH = config.get('KG_SNAPSHOT_PATH', PERSIST_DISK_PATH.rstrip('/') + '_snapshot')
+KG_ANN_PATH = config.get('KG_ANN_PATH', PERSIST_DISK_PATH.rstrip('/') + '_ann')
+KG_LAYOUT_PATH = config.get('KG_LAYOUT_PATH', PERSIST_DISK_PATH.rstrip('/') + '_layout')
+# Nodes of the full-KG plot, the ones with the highest degree in the precomputed layout
+KG_PLOT_MAX_NODES = config.get('KG_PLOT_MAX_NODES', 2000)
+INFERENCE_MAX_CONCURRENCY = config.get('INFERENCE_MAX_CONCURRENCY', 8)
+INFERENCE_MODE = config.get('INFERENCE_MODE', 'thread')
+LLM_MODEL = config['LLM_MODEL']
+# "vectorized": embedding search on one normalized matrix (common/retrieval.py),
+# "llama_index": the stock KGTableRetriever
+RETRIEVAL_BACKEND = config.get('RETRIEVAL_BACKEND', 'vectorized')
+# Embedding search of the "vectorized" backend. "exact": every triplet, "ann": the IVF index at
+# KG_ANN_PATH (see code_generation/kg_construction/build_ann_index.py), probing ANN_N_PROBE lists
+# and re-ranking ANN_RERANK * similarity_top_k candidates exactly if the KG snapshot is loaded
+EMBEDDING_SEARCH = config.get('EMBEDDING_SEARCH', 'exact')
+ANN_N_PROBE = config.get('ANN_N_PROBE', 16)
+ANN_RERANK = config.get('ANN_RERANK', 4)
+# Keyword extraction of each query engine, "llm" (the default) or "local": entity names found in
+# the prefix code (common/keyword_extraction.py), which saves one LLM call per query.
+# "local" needs the "vectorized" retrieval backend. Switch an engine to "local" only once
+# benchmarks/keyword_extraction_eval.py has been run against the production LLM and its recall
+# is acceptable.
+KEYWORD_EXTRACTION = config.get('KEYWORD_EXTRACTION', {})
+# Graph store serving rel-map queries. "simple": llama_index's SimpleGraphStore semantics,
+# "csr": CSRGraphStore's bounded breadth-first search following at most GRAPH_FANOUT[d - 1]
+# edges per entity at depth d (common/graph_store.py)
+GRAPH_STORE = config.get('GRAPH_STORE', 'simple')
+GRAPH_FANOUT = config.get('GRAPH_FANOUT', DEFAULT_FANOUT)
+# Response synthesis of the query engines. "refine": one LLM call per retrieved node,
+# "packed": the triplets and text chunks packed into CONTEXT_TOKEN_BUDGET[engine] tokens and
+# answered with a single LLM call (common/synthesis.py)
+RESPONSE_MODE = config.get('RESPONSE_MODE', 'refine')
+CONTEXT_TOKEN_BUDGET = config.get('CONTEXT_TOKEN_BUDGET', {})
+# Cache query embeddings and retrieval results in this worker and Redis, so a completion cache
+# miss can still skip the embedding and retrieval legs (caching/query_cache.py). Needs the
+# "vectorized" retrieval backend.
+QUERY_CACHE = config.get('QUERY_CACHE', False)
+# Hybrid retrieval of the "vectorized" backend runs the keyword and embedding legs at the same
+# time. RETRIEVAL_FUSION merges their triplets: "concat" as llama_index does, or "rrf",
+# reciprocal rank fusion weighted by RETRIEVAL_FUSION_WEIGHTS. A leg exceeding its
+# RETRIEVAL_LEG_TIMEOUT (seconds) is dropped and the other leg answers alone.
+RETRIEVAL_FUSION = config.get('RETRIEVAL_FUSION', 'concat')
+RETRIEVAL_FUSION_WEIGHTS = config.get('RETRIEVAL_FUSION_WEIGHTS', {})
+RETRIEVAL_LEG_TIMEOUT = config.get('RETRIEVAL_LEG_TIMEOUT', {})
+# Named KGs for federated queries (/v1/merge_kg), each persisted in KG_REGISTRY_DIR/<name> as
+# load_and_persist_kg.py does, with optional <name>_snapshot and <name>_ann artifacts. They are
+# loaded on first use and the least recently used are evicted to keep the estimated memory of
+# the resident ones within KG_REGISTRY_MEMORY_BUDGET_MB (common/kg_registry.py).
+KG_REGISTRY_DIR = config.get('KG_REGISTRY_DIR', os.path.dirname(PERSIST_DISK_PATH.rstrip('/')))
+KG_REGISTRY_MEMORY_BUDGET_MB = config.get('KG_REGISTRY_MEMORY_BUDGET_MB', 4096)
+# A federated query keeps the first FEDERATED_TOP_K triplets and text chunks of every KG, fuses
+# them across KGs and answers from at most FEDERATED_MAX_CHUNKS chunks. KGs answering later than
+# FEDERATED_TIMEOUT seconds are left out.
+FEDERATED_TOP_K = config.get('FEDERATED_TOP_K', 10)
+FEDERATED_MAX_CHUNKS = config.get('FEDERATED_MAX_CHUNKS', 5)
+FEDERATED_TIMEOUT = config.get('FEDERATED_TIMEOUT', None)
+# Hot reload of the served KG (reload_engines). The new engines must retrieve for every prefix of
+# KG_RELOAD_CANARY_QUERIES without an error before they replace the old ones, which are released
+# once their requests finish or KG_RELOAD_DRAIN_TIMEOUT seconds passed. Every
+# KG_RELOAD_POLL_INTERVAL seconds (0: never) each worker checks whether the KG on disk changed.
+KG_RELOAD_CANARY_QUERIES = config.get('KG_RELOAD_CANARY_QUERIES', [])
+KG_RELOAD_DRAIN_TIMEOUT = config.get('KG_RELOAD_DRAIN_TIMEOUT', 300)
+KG_RELOAD_POLL_INTERVAL = config.get('KG_RELOAD_POLL_INTERVAL', 0)
 
 # Constants
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -32,7 +118,6 @@ TEXT_QA_FILE_PATH = os.path.join(BASE_DIR, 'code_generation', 'prompts', 'text_q
 
 # Initialize S3 filesystem
 fs = s3fs.S3FileSystem(anon=False)
-Settings = configure_settings()
 
 
 
@@ -54,14 +139,56 @@ def load_kg_index(s3_path, fs):
     logger.info("Loading knowledge graph index from storage...")
     return load_index_from_storage(StorageContext.from_defaults(persist_dir=s3_path, fs=fs))
 
-def create_query_engine(kg_index, graph_store_query_depth=1, similarity_top_k=3):
+def _kg_query_engine(kg_index, embedding_matrix=None, keyword_extractor=None, query_caches=None, **kwargs):
+    """Build a query engine over `kg_index` with the configured retrieval backend."""
+    if RETRIEVAL_BACKEND == "vectorized":
+        embedding_cache, retrieval_cache = query_caches or (None, None)
+        return kg_query_engine(kg_index, embedding_matrix=embedding_matrix, keyword_extractor=keyword_extractor,
+                               embedding_cache=embedding_cache, retrieval_cache=retrieval_cache,
+                               fusion=RETRIEVAL_FUSION, fusion_weights=RETRIEVAL_FUSION_WEIGHTS,
+                               leg_timeouts=RETRIEVAL_LEG_TIMEOUT, **kwargs)
+    if keyword_extractor is not None:
+        logger.warning("Local keyword extraction needs the vectorized retrieval backend, using the LLM")
+    return kg_index.as_query_engine(**kwargs)
+
+def create_query_caches(persist_path=PERSIST_DISK_PATH, client=None):
+    """
+    The embedding and retrieval caches shared by the query engines of the KG in `persist_path`.
+    Embeddings only depend on the embedding model. Retrieval results also depend on the KG
+    version and on every setting of the retrieval backend, which are part of the retrieval
+    cache's namespace.
+    """
+    client = client if client is not None else create_redis_client()
+    embedding_cache = EmbeddingCache(query_namespace(config['EMBED_MODEL']), client=client)
+    retrieval_cache = RetrievalCache(query_namespace(
+        kg_fingerprint(persist_path), config['EMBED_MODEL'], LLM_MODEL,
+        EMBEDDING_SEARCH, ANN_N_PROBE, ANN_RERANK, GRAPH_STORE, list(GRAPH_FANOUT),
+    ), client=client)
+    return embedding_cache, retrieval_cache
+
+def _response_synthesizer(engine, text_qa_template, streaming=False):
+    """The packed single-call synthesizer of `engine` if RESPONSE_MODE is "packed", else None for "refine"."""
+    if RESPONSE_MODE != "packed":
+        return None
+    return PackedContextSynthesizer(
+        text_qa_template=text_qa_template,
+        context_budget=CONTEXT_TOKEN_BUDGET.get(engine, DEFAULT_CONTEXT_BUDGET),
+        streaming=streaming,
+    )
+
+def create_query_engine(kg_index, graph_store_query_depth=1, similarity_top_k=3, embedding_matrix=None, keyword_extractor=None, query_caches=None):
     """Create and configure the query engine."""
     logger.info("Creating and configuring the query engine...")
     text_qa_template = PromptTemplate(text_qa_template_str)
 
-    return kg_index.as_query_engine(
+    return _kg_query_engine(
+        kg_index,
+        embedding_matrix=embedding_matrix,
+        keyword_extractor=keyword_extractor,
+        query_caches=query_caches,
         include_text=True,
         response_mode="refine",
+        response_synthesizer=_response_synthesizer("query_engine", text_qa_template),
         embedding_mode="hybrid",
         graph_store_query_depth=graph_store_query_depth,
         similarity_top_k=similarity_top_k,
@@ -69,14 +196,19 @@ def create_query_engine(kg_index, graph_store_query_depth=1, similarity_top_k=3)
         text_qa_template=text_qa_template
     )
 
-def create_streaming_query_engine(kg_index, graph_store_query_depth=1, similarity_top_k=3):
+def create_streaming_query_engine(kg_index, graph_store_query_depth=1, similarity_top_k=3, embedding_matrix=None, keyword_extractor=None, query_caches=None):
     """Create and configure the query engine."""
     logger.info("Creating and configuring the query engine...")
     text_qa_template = PromptTemplate(text_qa_template_str)
 
-    return kg_index.as_query_engine(
+    return _kg_query_engine(
+        kg_index,
+        embedding_matrix=embedding_matrix,
+        keyword_extractor=keyword_extractor,
+        query_caches=query_caches,
         include_text=True,
         response_mode="refine",
+        response_synthesizer=_response_synthesizer("streaming_query_engine", text_qa_template, streaming=True),
         embedding_mode="hybrid",
         graph_store_query_depth=graph_store_query_depth,
         similarity_top_k=similarity_top_k,
@@ -86,25 +218,339 @@ def create_streaming_query_engine(kg_index, graph_store_query_depth=1, similarit
     )
 
 
-def load_kg_index_from_disk():
-    persist_path = PERSIST_DISK_PATH
-    storage_context = StorageContext.from_defaults(persist_dir=persist_path)
+def current_snapshot(persist_path=PERSIST_DISK_PATH, snapshot_path=KG_SNAPSHOT_PATH) -> Optional[KGSnapshot]:
+    """The snapshot at `snapshot_path` if it was compiled from the KG in `persist_path`, or that KG is not persisted."""
+    if not os.path.exists(os.path.join(snapshot_path, MANIFEST_FILE)):
+        return None
+    snapshot = KGSnapshot(snapshot_path)
+    if snapshot.is_current(persist_path) or not os.path.exists(os.path.join(persist_path, 'index_store.json')):
+        return snapshot
+    logger.warning(f"KG snapshot {snapshot_path} was compiled from a different version of {persist_path}, loading the JSON index instead")
+    return None
+
+
+def load_kg_index_from_disk(persist_path=PERSIST_DISK_PATH, snapshot_path=KG_SNAPSHOT_PATH):
+    """
+    Load the knowledge graph index persisted in `persist_path`. A compiled snapshot at
+    `snapshot_path` is memory-mapped and shared with the other workers if it was compiled from
+    the KG currently persisted (see code_generation/kg_construction/compile_kg_snapshot.py).
+    Otherwise the llama_index JSON files are parsed.
+    """
+    snapshot = current_snapshot(persist_path, snapshot_path)
+    if snapshot is not None:
+        logger.info(f"Loading knowledge graph index from snapshot {snapshot_path}...")
+        graph_store = CSRGraphStore.from_snapshot(snapshot, fanout=GRAPH_FANOUT) if GRAPH_STORE == 'csr' else None
+        return snapshot.load_index(graph_store=graph_store)
+    graph_store = CSRGraphStore.from_persist_dir(persist_path, fanout=GRAPH_FANOUT) if GRAPH_STORE == 'csr' else None
+    storage_context = StorageContext.from_defaults(persist_dir=persist_path, graph_store=graph_store)
 
     return load_index_from_storage(storage_context)
 
 
 
-# Uncomment this if you want to Load the knowledge graph index
-#kg_index = load_kg_index(S3_PATH, fs)
+class Engines(NamedTuple):
+    kg_index: object
+    query_engine: object
+    streaming_query_engine: object
+    # Version of the KG files the engines were built from (see serving_kg_version)
+    version: str
+    # Completion cache namespace of their completions
+    namespace: str
+    # Requests using the engines, waited for before a reload releases them
+    in_flight: InFlight
+
+
+_engines: Optional[Engines] = None
+_engines_lock = threading.Lock()
+_reload_lock = threading.Lock()
+_settings_configured = False
+_settings_lock = threading.Lock()
+
+
+def ensure_settings():
+    """Configure the LLM and embedding models once per process."""
+    global _settings_configured
+    with _settings_lock:
+        if not _settings_configured:
+            configure_settings()
+            _settings_configured = True
+
+
+def serving_kg_version():
+    """
+    Version of the KG the engines would load now: the files persisted in PERSIST_DISK_PATH and
+    the snapshot and ANN index compiled from them. Only file metadata is read.
+    """
+    parts = [kg_fingerprint(PERSIST_DISK_PATH)]
+    for path in (KG_SNAPSHOT_PATH, KG_ANN_PATH):
+        manifest = os.path.join(path, MANIFEST_FILE)
+        if os.path.exists(manifest):
+            stat = os.stat(manifest)
+            parts.append(f"{path}:{stat.st_size}:{stat.st_mtime_ns}")
+    return query_namespace(*parts)
+
+
+def build_engines(phase=startup_timings.phase) -> Engines:
+    """
+    Configure the LLM and embedding models, load the knowledge graph index and build the query
+    engines, timing each step with `phase(name)`.
+    """
+    # Read first, so files replaced while loading count as a newer version
+    version = serving_kg_version()
+    namespace = completion_namespace(kg_fingerprint(PERSIST_DISK_PATH))
+    with phase("configure_settings"):
+        ensure_settings()
+
+    # Uncomment this if you want to Load the knowledge graph index
+    #kg_index = load_kg_index(S3_PATH, fs)
+    with phase("load_kg_index"):
+        kg_index = load_kg_index_from_disk()
+
+    with phase("create_query_engines"):
+        # Both engines search the same embedding matrix
+        embedding_matrix = None
+        if RETRIEVAL_BACKEND == "vectorized":
+            embedding_matrix = load_embedding_search(kg_index)
+        keyword_extractor = None
+        if 'local' in KEYWORD_EXTRACTION.values():
+            keyword_extractor = RustKeywordExtractor(EntityIndex.from_index(kg_index))
+        keyword_extractors = {
+            engine: keyword_extractor if KEYWORD_EXTRACTION.get(engine, 'llm') == 'local' else None
+            for engine in ('query_engine', 'streaming_query_engine')
+        }
+        query_caches = create_query_caches() if QUERY_CACHE and RETRIEVAL_BACKEND == "vectorized" else None
+        return Engines(
+            kg_index=kg_index,
+            query_engine=create_query_engine(
+                kg_index, embedding_matrix=embedding_matrix, keyword_extractor=keyword_extractors['query_engine'],
+                query_caches=query_caches),
+            # Query engine that enables streaming
+            streaming_query_engine=create_streaming_query_engine(
+                kg_index, embedding_matrix=embedding_matrix, keyword_extractor=keyword_extractors['streaming_query_engine'],
+                query_caches=query_caches),
+            version=version,
+            namespace=namespace,
+            in_flight=InFlight(),
+        )
+
+
+def load_engines() -> Engines:
+    """
+    Load the engines once per process; concurrent callers wait for the first one to finish. If
+    loading fails, the error is raised and the next call tries again.
+    """
+    global _engines
+    if _engines is not None:
+        return _engines
+    with _engines_lock:
+        if _engines is None:
+            _engines = build_engines()
+    return _engines
+
+
+class ReloadInProgress(RuntimeError):
+    """Another reload of the engines is running in this process."""
+
+
+def warm_engines(engines: Engines, prefixes) -> int:
+    """
+    Retrieve for every prefix in `prefixes` with the engines' retriever, which pages in the
+    index and fills the query caches. Errors are raised. Returns the nodes retrieved.
+    """
+    retrieved = 0
+    for prefix in prefixes:
+        nodes = engines.query_engine.retriever.retrieve(template.render({'prefix_code': prefix}))
+        retrieved += sum(1 for node in nodes if node.node.get_content() != NO_RELATIONSHIPS_TEXT)
+    return retrieved
+
+
+def _release(holder: list, timeout: float):
+    """
+    Wait for the requests still using the engines in `holder`, then return their memory. The
+    engines are taken out of the list so that no reference outlives this call's own, which
+    is dropped before collecting; the caller must not keep one either.
+    """
+    started_at = time.perf_counter()
+    engines = holder.pop()
+    if not engines.in_flight.wait_idle(timeout):
+        logger.warning(f"{len(engines.in_flight)} requests still use KG version {engines.version} after {timeout}s, releasing it anyway")
+    version = engines.version
+    del engines
+    gc.collect()
+    try:
+        # Return the freed heap to the OS; glibc keeps it otherwise
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    metrics.observe("kg_reload.drain", time.perf_counter() - started_at)
+    logger.info(f"Released KG version {version}")
+
+
+def reload_engines(force=False, on_swap=None) -> dict:
+    """
+    Replace the engines with ones built from the KG currently on disk, if its version changed
+    or `force` is set. The new engines are built and warmed with KG_RELOAD_CANARY_QUERIES while
+    the old ones keep serving, then swapped in at once together with their completion cache
+    namespace, and `on_swap(engines)` is called. Requests that already hold the old engines
+    finish on them; they are released on a background thread after draining. Raises
+    ReloadInProgress if another reload is running, and any error of the build or the canaries,
+    in which case the old engines keep serving.
+    """
+    global _engines, _kg_layout
+    if not _reload_lock.acquire(blocking=False):
+        raise ReloadInProgress("A KG reload is already running")
+    try:
+        current = _engines
+        version = serving_kg_version()
+        if current is not None and current.version == version and not force:
+            return {"status": "unchanged", "version": version, "namespace": current.namespace}
+        logger.info(f"Reloading the KG, version {current.version if current else None} -> {version}...")
+        started_at = time.perf_counter()
+        engines = build_engines(phase=lambda name: metrics.timer(f"kg_reload.{name}"))
+        build_s = time.perf_counter() - started_at
+        with metrics.timer("kg_reload.warm"):
+            retrieved = warm_engines(engines, KG_RELOAD_CANARY_QUERIES)
+        if KG_RELOAD_CANARY_QUERIES and not retrieved:
+            logger.warning("No canary query retrieved anything from the new KG")
+
+        with _engines_lock:
+            old, _engines = _engines, engines
+        # Checked against the new KG on its next use
+        _kg_layout = None
+        metrics.incr("kg_reload.swaps")
+        logger.info(f"Serving KG version {engines.version}, completion cache namespace {engines.namespace}")
+        if on_swap is not None:
+            on_swap(engines)
+        previous_version = old.version if old is not None else None
+        draining = len(old.in_flight) if old is not None else 0
+        if old is not None:
+            # The thread's arguments live as long as the thread, so hand the engines over in a
+            # list _release empties, and drop this frame's reference before it collects them
+            holder = [old]
+            del old, current
+            threading.Thread(target=_release, args=(holder, KG_RELOAD_DRAIN_TIMEOUT), name="kg-release", daemon=True).start()
+        return {
+            "status": "reloaded",
+            "version": engines.version,
+            "namespace": engines.namespace,
+            "previous_version": previous_version,
+            "draining": draining,
+            "build_s": round(build_s, 3),
+            "warm_s": round(time.perf_counter() - started_at - build_s, 3),
+            "canary_nodes": retrieved,
+        }
+    except ReloadInProgress:
+        raise
+    except Exception:
+        metrics.incr("kg_reload.failures")
+        raise
+    finally:
+        _reload_lock.release()
+
+
+async def watch_kg(interval=KG_RELOAD_POLL_INTERVAL, on_swap=None):
+    """
+    Reload the engines whenever the KG on disk changes. A new version is only loaded once it
+    stayed the same for one more poll, so files still being written are not picked up; a
+    version that failed to load is not tried again until it changes.
+    """
+    pending, failed = None, None
+    while True:
+        await asyncio.sleep(interval)
+        if _engines is None:
+            continue
+        version = None
+        try:
+            version = await asyncio.to_thread(serving_kg_version)
+            if version in (_engines.version, failed):
+                pending = None
+                continue
+            if version != pending:
+                pending = version
+                continue
+            await asyncio.to_thread(reload_engines, False, on_swap)
+            pending = None
+        except ReloadInProgress:
+            continue
+        except Exception:
+            failed, pending = version, None
+            logger.exception(f"Reloading KG version {version} failed, still serving {_engines.version}")
+
+
+def load_embedding_search(kg_index, persist_path=PERSIST_DISK_PATH, ann_path=KG_ANN_PATH):
+    """
+    The triplet embedding search shared by the query engines: the ANN index if EMBEDDING_SEARCH
+    is "ann" and it was built from the KG currently persisted, otherwise exact search.
+    """
+    embedding_dict = kg_index.index_struct.embedding_dict
+    if EMBEDDING_SEARCH == "ann":
+        if os.path.exists(os.path.join(ann_path, MANIFEST_FILE)):
+            ann_index = ANNIndex(ann_path, n_probe=ANN_N_PROBE, rerank=ANN_RERANK)
+            if ann_index.is_current(persist_path) or not os.path.exists(os.path.join(persist_path, 'index_store.json')):
+                # The snapshot's float32 matrix has the rows of the ANN index, so it can re-rank
+                if isinstance(embedding_dict, SnapshotEmbeddingDict) and embedding_dict.matrix.shape == (len(ann_index), ann_index.manifest['dim']):
+                    ann_index.exact = embedding_dict.matrix
+                logger.info(f"Searching triplet embeddings with the ANN index {ann_path} ({ann_index.manifest['quantization']}, re-rank {'on' if ann_index.exact is not None else 'off'})")
+                return ann_index
+            logger.warning(f"ANN index {ann_path} was built from a different version of {persist_path}, using exact search")
+        else:
+            logger.warning(f"No ANN index at {ann_path}, using exact search")
+    return EmbeddingMatrix.from_embedding_dict(embedding_dict)
+
+
+def engines_loaded() -> bool:
+    """True once the knowledge graph index and query engines are ready to serve."""
+    return _engines is not None
+
+
+async def ensure_engines() -> Engines:
+    """Return the loaded engines, loading them on a worker thread if needed."""
+    if _engines is not None:
+        return _engines
+    return await asyncio.to_thread(load_engines)
+
+
+@asynccontextmanager
+async def serving_engines():
+    """The current engines, counted as in use by the enclosed block so a reload waits for it."""
+    engines = await ensure_engines()
+    with engines.in_flight.track():
+        yield engines
+
+
+PROMPT_FINGERPRINT = file_fingerprint(PROMPT_FILE_PATH, TEXT_QA_FILE_PATH)
+
+
+def completion_namespace(kg_version):
+    """Completion cache namespace of KG version `kg_version`, the prompt templates and model."""
+    return cache_namespace(
+        kg_version,
+        PROMPT_FINGERPRINT,
+        # Packing changes the prompts, so completions of each response mode and budget are cached apart
+        LLM_MODEL if RESPONSE_MODE != 'packed' else f"{LLM_MODEL}|packed|{sorted(CONTEXT_TOKEN_BUDGET.items())}",
+    )
+
 
-kg_index = load_kg_index_from_disk()
+# Completion cache namespace of the persisted KG at startup. Only file metadata is read, so
+# cached completions can be served before the KG is loaded.
+CACHE_NAMESPACE = completion_namespace(kg_fingerprint(PERSIST_DISK_PATH))
 
 
-# Create the query engine
-query_engine = create_query_engine(kg_index)
+def serving_kg_info() -> dict:
+    """KG version and completion cache namespace being served, None for the version before loading."""
+    engines = _engines
+    if engines is None:
+        return {"kg_version": None, "cache_namespace": CACHE_NAMESPACE}
+    return {"kg_version": engines.version, "cache_namespace": engines.namespace}
 
-# Create a query engine that enables streaming
-streaming_query_engine = create_streaming_query_engine(kg_index)
+
+def current_cache_namespace():
+    """Completion cache namespace of the engines being served, which a reload changes."""
+    engines = _engines
+    return engines.namespace if engines is not None else CACHE_NAMESPACE
+
+# Bounded, per-worker executor for queries issued from async endpoints
+query_runner = AsyncQueryRunner(max_concurrency=INFERENCE_MAX_CONCURRENCY, mode=INFERENCE_MODE)
 
 
 def composable_graph_inference(composable_graph,prefix_code):
@@ -127,6 +573,94 @@ def composable_graph_inference(composable_graph,prefix_code):
 
     return response.response, sub_edges, subplot
 
+def named_kg_paths(name):
+    """Persist, snapshot and ANN index directories of the named KG `name` in KG_REGISTRY_DIR."""
+    persist_path = kg_dir(KG_REGISTRY_DIR, name)
+    return persist_path, persist_path + '_snapshot', persist_path + '_ann'
+
+
+def estimate_named_kg(name):
+    """Bytes the named KG `name` takes once loaded. UnknownKG if there is no such KG."""
+    persist_path, snapshot_path, _ = named_kg_paths(name)
+    if not os.path.exists(os.path.join(persist_path, 'index_store.json')) and not os.path.exists(os.path.join(snapshot_path, MANIFEST_FILE)):
+        raise UnknownKG(name)
+    snapshot = current_snapshot(persist_path, snapshot_path)
+    return estimate_kg_bytes(persist_path, snapshot_path if snapshot is not None else None)
+
+
+def load_named_kg(name):
+    """Load the named KG `name` and return a retriever configured like the query engine's."""
+    ensure_settings()
+    persist_path, snapshot_path, ann_path = named_kg_paths(name)
+    kg_index = load_kg_index_from_disk(persist_path, snapshot_path)
+    retriever_kwargs = dict(include_text=True, embedding_mode="hybrid", graph_store_query_depth=1, similarity_top_k=3, use_gpu=True)
+    if RETRIEVAL_BACKEND != "vectorized":
+        return kg_index.as_retriever(**retriever_kwargs)
+    keyword_extractor = None
+    if KEYWORD_EXTRACTION.get('query_engine', 'llm') == 'local':
+        keyword_extractor = RustKeywordExtractor(EntityIndex.from_index(kg_index))
+    embedding_cache, retrieval_cache = create_query_caches(persist_path, client=_registry_redis_client()) if QUERY_CACHE else (None, None)
+    return kg_retriever(
+        kg_index,
+        embedding_matrix=load_embedding_search(kg_index, persist_path, ann_path),
+        keyword_extractor=keyword_extractor,
+        embedding_cache=embedding_cache,
+        retrieval_cache=retrieval_cache,
+        fusion=RETRIEVAL_FUSION,
+        fusion_weights=RETRIEVAL_FUSION_WEIGHTS,
+        leg_timeouts=RETRIEVAL_LEG_TIMEOUT,
+        **retriever_kwargs,
+    )
+
+
+_kg_registry: Optional[KGRegistry] = None
+_registry_redis = None
+_kg_registry_lock = threading.Lock()
+
+
+def _registry_redis_client():
+    """One Redis client for the query caches of all named KGs."""
+    global _registry_redis
+    with _kg_registry_lock:
+        if _registry_redis is None:
+            _registry_redis = create_redis_client()
+    return _registry_redis
+
+
+def get_kg_registry() -> KGRegistry:
+    """The registry of named KGs of this process."""
+    global _kg_registry
+    with _kg_registry_lock:
+        if _kg_registry is None:
+            _kg_registry = KGRegistry(load_named_kg, estimate_named_kg, memory_budget=KG_REGISTRY_MEMORY_BUDGET_MB * 2**20)
+    return _kg_registry
+
+
+async def federated_inference_async(kg_names, prefix_code):
+    """
+    Complete `prefix_code` from several named KGs. Their retrievals run concurrently and the
+    results are fused (see FederatedRetriever); a single query engine then answers from the
+    fused nodes. Returns the generated code, the edges of the fused subgraph and the load and
+    retrieval time of each KG in milliseconds. Unknown KG names raise UnknownKG.
+    """
+    logger.info(f"Performing federated inference over the KGs {kg_names}...")
+    query = template.render({'prefix_code': prefix_code})
+
+    await asyncio.to_thread(ensure_settings)
+    retriever = FederatedRetriever(get_kg_registry(), kg_names, top_k=FEDERATED_TOP_K,
+                                   max_chunks=FEDERATED_MAX_CHUNKS, timeout=FEDERATED_TIMEOUT)
+    text_qa_template = PromptTemplate(text_qa_template_str)
+    engine = RetrieverQueryEngine.from_args(
+        retriever,
+        response_mode="refine",
+        response_synthesizer=_response_synthesizer("query_engine", text_qa_template),
+        text_qa_template=text_qa_template,
+    )
+    response = await query_runner.query(engine, query)
+
+    return response.response, parse_edges(response.metadata), retriever.timings
+
+
 def claude_inference(prefix_code, suffix="}"):
     """Perform inference using Claude and return the generated code, edges, and subplot."""
     logger.info("Performing inference using Claude...")
@@ -134,7 +668,9 @@ def claude_inference(prefix_code, suffix="}"):
     # data = {'prefix_code': prefix_code}
     query = template.render({'prefix_code': prefix_code})
 
-    response = query_engine.query(query)
+    engines = load_engines()
+    with engines.in_flight.track():
+        response = engines.query_engine.query(query)
 
     # Uncomment the line below if you want to return the subgraph
     # sub_edges, subplot = plot_subgraph_via_edges(response.metadata)
@@ -149,13 +685,28 @@ def claude_inference(prefix_code, suffix="}"):
     return response.response, [], ""
 
 
+async def claude_inference_async(prefix_code, suffix="}"):
+    """Async variant of `claude_inference` that keeps the event loop free while the query runs."""
+    logger.info("Performing async inference using Claude...")
+
+    query = template.render({'prefix_code': prefix_code})
+
+    async with serving_engines() as engines:
+        response = await query_runner.query(engines.query_engine, query)
+
+    # Only the edges: the visualization is rendered on demand by /v1/subgraph
+    return response.response, parse_edges(response.metadata), ""
+
+
 def claude_inference_gradio(prefix_code, suffix="}"):
     """Perform inference using Claude and return the generated code, edges, and subplot."""
     logger.info("Performing inference using Claude...")
     
     query = template.render({'prefix_code': prefix_code})
 
-    response = query_engine.query(query)
+    engines = load_engines()
+    with engines.in_flight.track():
+        response = engines.query_engine.query(query)
 
     # Uncomment the line below if you want to return the subgraph
     sub_edges, subplot = plot_subgraph_via_edges(response.metadata)
@@ -170,17 +721,60 @@ def claude_inference_gradio(prefix_code, suffix="}"):
     return response.response, sub_edges, subplot
 
 async def claude_inference_streaming(prefix_code, suffix="}"):
+    """
+    Stream the decoded `fill_in_middle` code as it is generated, without blocking the event loop.
+    Generation is stopped as soon as the closing quote of the value arrives or the stream is closed.
+    """
     logger.info("Performing inference using Claude with streaming response...")
     query = template.render({'prefix_code': prefix_code})
-    streaming_response = streaming_query_engine.query(query)
-    for token in streaming_response.response_gen:
-        print(token)
-        yield token
-
-def plot_full_kg():
-    """Plot the full knowledge graph and return the HTML representation."""
+    extractor = FillInMiddleExtractor()
+    async with serving_engines() as engines, aclosing(query_runner.stream(engines.streaming_query_engine, query)) as tokens:
+        async for token in tokens:
+            code = extractor.feed(token)
+            if code:
+                yield code
+            if extractor.done:
+                metrics.incr("stream.stopped_after_value")
+                return
+    # The model ignored the JSON format: send whatever it produced
+    remainder = extractor.flush()
+    if remainder:
+        yield remainder
+
+_kg_layout: Optional[KGLayout] = None
+_kg_layout_lock = threading.Lock()
+
+
+def load_kg_layout() -> Optional[KGLayout]:
+    """
+    The precomputed layout of the full KG at KG_LAYOUT_PATH (see
+    code_generation/kg_construction/build_kg_layout.py), memory-mapped once per process.
+    None if it has not been built, or was built from a different version of the KG in
+    PERSIST_DISK_PATH; later calls look again.
+    """
+    global _kg_layout
+    if _kg_layout is not None:
+        return _kg_layout
+    with _kg_layout_lock:
+        if _kg_layout is None:
+            if not os.path.exists(os.path.join(KG_LAYOUT_PATH, MANIFEST_FILE)):
+                logger.warning(f"No KG layout at {KG_LAYOUT_PATH}")
+                return None
+            layout = KGLayout(KG_LAYOUT_PATH)
+            if not layout.is_current(PERSIST_DISK_PATH) and os.path.exists(os.path.join(PERSIST_DISK_PATH, 'index_store.json')):
+                logger.warning(f"KG layout {KG_LAYOUT_PATH} was built from a different version of {PERSIST_DISK_PATH}")
+                return None
+            _kg_layout = layout
+    return _kg_layout
+
+
+def plot_full_kg(max_nodes=KG_PLOT_MAX_NODES):
+    """
+    Plot the knowledge graph and return the HTML representation. With a precomputed layout,
+    only the `max_nodes` nodes with the highest degree are drawn, at their stored positions
+    and without a physics simulation. Otherwise the whole graph is laid out in the browser.
+    """
     logger.info("Plotting the full knowledge graph...")
-    g = kg_index.get_networkx_graph()
     net = Network(
         notebook=False,
         cdn_resources="remote",
@@ -189,21 +783,25 @@ def plot_full_kg():
         select_menu=True,
         filter_menu=False,
     )
-    net.from_nx(g)
-    net.force_atlas_2based(central_gravity=0.015, gravity=-31)
-
-    html = net.generate_html().replace("'", "\"")
+    layout = load_kg_layout()
+    if layout is not None:
+        graph = layout.page(0, max_nodes)
+        for node in graph["nodes"]:
+            net.add_node(node["id"], label=node["label"], x=node["x"], y=node["y"],
+                         group=node["group"], value=node["value"], physics=False)
+        for edge in graph["edges"]:
+            net.add_edge(edge["from"], edge["to"], label=edge["label"])
+        net.toggle_physics(False)
+    else:
+        engines = load_engines()
+        with engines.in_flight.track():
+            net.from_nx(engines.kg_index.get_networkx_graph())
+        net.force_atlas_2based(central_gravity=0.015, gravity=-31)
+
+    html = net.generate_html()
     logger.info("HTML representation of the full knowledge graph generated.")
 
-    return (
-        '<iframe style="width: 100%; height: 600px;margin:0 auto" '
-        'name="result" allow="midi; geolocation; microphone; camera; '
-        'display-capture; encrypted-media;" sandbox="allow-modals allow-forms '
-        'allow-scripts allow-same-origin allow-popups '
-        'allow-top-navigation-by-user-activation allow-downloads" '
-        'allowfullscreen="" allowpaymentrequest="" frameborder="0" '
-        f'srcdoc=\'{html}\'></iframe>'
-    )
+    return subgraph_iframe(html)
 
 # if __name__ == "__main__":
 #     claude_inference("/// Macro definition")
@@ -0,0 +1,138 @@
+import re
+import logging
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from common.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# The code part of a query rendered from code_completion.prompt
+PREFIX_CODE_PATTERN = re.compile(r"<prefix_code>\n?(.*?)</prefix_code>", re.DOTALL)
+DOC_COMMENT_PATTERN = re.compile(r"//[/!]?(.*)$|/\*[*!]?(.*?)\*/", re.MULTILINE | re.DOTALL)
+STRING_PATTERN = re.compile(r'"(?:\\.|[^"\\])*"')
+PATH_PATTERN = re.compile(r"\b[A-Za-z_]\w*(?:::[A-Za-z_]\w*)+")
+MACRO_PATTERN = re.compile(r"\b([A-Za-z_]\w*)!")
+IDENTIFIER_PATTERN = re.compile(r"\b[A-Za-z_]\w*")
+# Word boundaries inside identifiers: snake_case, kebab-case, camelCase, HTTPServer, paths
+WORD_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+RUST_KEYWORDS = frozenset("""
+as async await break const continue crate dyn else enum extern false fn for if impl in let loop match mod move
+mut pub ref return self Self static struct super trait true type unsafe use where while
+bool char str u8 u16 u32 u64 u128 usize i8 i16 i32 i64 i128 isize f32 f64 Option Some None Result Ok Err Vec
+String Box T
+""".split())
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have how if in into is it its of on or that the their this to was were which
+will with you your can not no all any each also more most other some such than then there these they
+""".split())
+
+# How much a match found in each part of the code counts: explicit paths and macros name
+# what the code uses, doc comments describe what it is meant to do
+SOURCE_WEIGHTS = {"path": 3.0, "macro": 3.0, "identifier": 2.0, "doc": 1.0}
+
+
+def split_words(text: str) -> List[str]:
+    """Lowercase words of `text`, splitting identifiers at case changes, `_`, `::` and punctuation."""
+    return [word.lower() for word in WORD_PATTERN.findall(text)]
+
+
+def normalize(text: str) -> str:
+    """Key under which a keyword and an entity name match, e.g. "StorageValue" -> "storage value"."""
+    return " ".join(split_words(text))
+
+
+def _ngrams(words: List[str], max_words: int) -> Iterator[str]:
+    for n in range(1, min(max_words, len(words)) + 1):
+        for i in range(len(words) - n + 1):
+            yield " ".join(words[i:i + n])
+
+
+class EntityIndex:
+    """
+    Entity names of a KG keyed by their normalized form.
+
+    KG retrieval only finds entities by their exact name (keyword table keys and
+    graph store subjects), so keywords are only useful if they are names in the
+    graph. Normalizing both sides matches e.g. `frame_support::pallet` in code
+    with the entity "Frame support pallet", and keeps every spelling of a name.
+    """
+
+    def __init__(self, names: Iterable[str]):
+        self._names: Dict[str, List[str]] = defaultdict(list)
+        for name in sorted(set(names)):
+            key = normalize(name)
+            if key and key not in STOPWORDS and key not in RUST_KEYWORDS:
+                self._names[key].append(name)
+        self.max_words = max((key.count(" ") + 1 for key in self._names), default=0)
+
+    @classmethod
+    def from_index(cls, kg_index) -> "EntityIndex":
+        """Index the keywords of a KnowledgeGraphIndex, the subjects and objects of its triplets."""
+        return cls(kg_index.index_struct.table)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._names
+
+    def get(self, key: str) -> List[str]:
+        """Entity names whose normalized form is `key`."""
+        return self._names.get(key, [])
+
+
+def rust_candidates(code: str) -> Iterator[Tuple[str, str]]:
+    """
+    Yield `(source, words)` for every span of a Rust snippet a keyword could come from:
+    paths like `frame_support::pallet` and each of their segments, macro names,
+    identifiers (without Rust keywords and primitive types), and the prose of doc and
+    line comments. `words` is the span's normalized words, to be matched as n-grams.
+    """
+    for match in DOC_COMMENT_PATTERN.finditer(code):
+        yield "doc", split_words(match.group(1) or match.group(2) or "")
+    code = STRING_PATTERN.sub(" ", DOC_COMMENT_PATTERN.sub(" ", code))
+    for match in PATH_PATTERN.finditer(code):
+        segments = [segment for segment in match.group(0).split("::") if segment not in RUST_KEYWORDS]
+        yield "path", split_words("::".join(segments))
+    for match in MACRO_PATTERN.finditer(code):
+        yield "macro", split_words(match.group(1))
+    for match in IDENTIFIER_PATTERN.finditer(code):
+        if match.group(0) not in RUST_KEYWORDS:
+            yield "identifier", split_words(match.group(0))
+
+
+class RustKeywordExtractor:
+    """
+    Extracts query keywords from a code prefix locally instead of asking the LLM.
+
+    Every n-gram of the candidate spans from `rust_candidates` is looked up in an
+    EntityIndex, and the matched entity names are ranked by how often and where they
+    occur, with longer (more specific) names first among equals. For a query rendered
+    from code_completion.prompt, only the prefix code is read.
+    """
+
+    def __init__(self, entity_index: EntityIndex):
+        self.entity_index = entity_index
+
+    def scores(self, text: str) -> Counter:
+        """Score of every entity name found in `text`."""
+        match = PREFIX_CODE_PATTERN.search(text)
+        code = match.group(1) if match else text
+        scores = Counter()
+        max_words = self.entity_index.max_words
+        for source, words in rust_candidates(code):
+            for key in _ngrams(words, max_words):
+                if key in self.entity_index:
+                    weight = SOURCE_WEIGHTS[source] * (key.count(" ") + 1)
+                    for name in self.entity_index.get(key):
+                        scores[name] += weight
+        return scores
+
+    def extract(self, text: str, max_keywords: int = 10) -> List[str]:
+        """Up to `max_keywords` entity names for `text`, best first."""
+        with metrics.timer("retrieval.keywords.local"):
+            scores = self.scores(text)
+        ranked = sorted(scores, key=lambda name: (-scores[name], -len(name), name))
+        return ranked[:max_keywords]
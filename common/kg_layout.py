@@ -0,0 +1,359 @@
+import os
+import json
+import time
+import shutil
+import logging
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+from common.kg_snapshot import StringTable, _save, _load, MANIFEST_FILE
+from common.graph_store import DEFAULT_PERSIST_FNAME
+from common.utils import kg_fingerprint
+
+logger = logging.getLogger(__name__)
+
+LAYOUT_FORMAT_VERSION = 1
+# Angle between consecutive points of a Vogel (sunflower) spiral
+GOLDEN_ANGLE = np.pi * (3 - np.sqrt(5))
+# Distance between neighbouring nodes, in vis-network canvas units
+NODE_SPACING = 10.0
+# Gap between packed community discs, relative to their radii
+COMMUNITY_PADDING = 1.3
+# Average nodes per cell of the viewport grid
+NODES_PER_CELL = 64
+# Defaults of the serving API: nodes and edges per slice
+DEFAULT_NODE_LIMIT = 1000
+DEFAULT_EDGE_LIMIT = 5000
+
+
+def _edge_arrays(graph_dict: Dict[str, List[List[str]]]) -> Tuple[List[str], List[str], np.ndarray]:
+    """Entity names, relation names and the distinct (subject, relation, object) ID rows of `graph_dict`."""
+    entities, relations, rows = {}, {}, []
+    for subj, edges in graph_dict.items():
+        i = entities.setdefault(subj, len(entities))
+        for rel, obj in edges:
+            rows.append((i, relations.setdefault(rel, len(relations)), entities.setdefault(obj, len(entities))))
+    rows = np.asarray(rows, dtype=np.int64).reshape(-1, 3)
+    # Deduplicate on one integer key per row, much faster than np.unique over rows
+    n, r = max(len(entities), 1), max(len(relations), 1)
+    keys = np.unique((rows[:, 0] * r + rows[:, 1]) * n + rows[:, 2])
+    triples = np.stack([keys // n // r, keys // n % r, keys % n], axis=1)
+    return list(entities), list(relations), triples
+
+
+def label_propagation(n: int, src: np.ndarray, dst: np.ndarray, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Community label of each of `n` nodes, by label propagation over the undirected edges.
+
+    Every node starts in its own community and repeatedly adopts the label most of its
+    neighbours have, ties broken at random. Each round updates a random half of the nodes,
+    which stops the oscillation of fully synchronous updates on bipartite structures, and
+    counts all (node, neighbour label) pairs with one sort, so a round is O(E log E) in numpy.
+    """
+    rng = np.random.default_rng(seed)
+    a = np.concatenate([src, dst]).astype(np.int64)
+    b = np.concatenate([dst, src]).astype(np.int64)
+    keep = a != b
+    a, b = a[keep], b[keep]
+    labels = np.arange(n, dtype=np.int64)
+    for _ in range(iterations):
+        pairs, counts = np.unique(a * n + labels[b], return_counts=True)
+        nodes, candidates = pairs // n, pairs % n
+        # Most frequent label per node, random among equally frequent ones. The pairs are
+        # sorted by node, so each node's candidates are one run
+        scores = counts + 0.5 * rng.random(len(counts))
+        runs = np.flatnonzero(np.r_[True, nodes[1:] != nodes[:-1]])
+        best = scores == np.repeat(np.maximum.reduceat(scores, runs), np.diff(np.r_[runs, len(nodes)]))
+        first = np.flatnonzero(best)
+        update = first[rng.random(len(first)) < 0.5]
+        changed = int(np.count_nonzero(labels[nodes[update]] != candidates[update]))
+        labels[nodes[update]] = candidates[update]
+        if changed <= n // 1000:
+            break
+    return labels
+
+
+def _spiral(k: np.ndarray) -> np.ndarray:
+    """Points `k` of a Vogel spiral: unit spacing, the first point at the origin."""
+    r, theta = np.sqrt(k), k * GOLDEN_ANGLE
+    return np.stack([r * np.cos(theta), r * np.sin(theta)], axis=1)
+
+
+def _pack_discs(radii: np.ndarray) -> np.ndarray:
+    """
+    Centers of discs with `radii`, largest first, along a Vogel spiral whose radius grows with
+    the area already placed. The largest disc sits at the origin and the others rarely overlap.
+    """
+    placed = np.concatenate([[0.0], np.cumsum(radii[:-1] ** 2)])
+    r = np.where(placed > 0, COMMUNITY_PADDING * np.sqrt(placed) + radii, 0.0)
+    theta = np.arange(len(radii)) * GOLDEN_ANGLE
+    return np.stack([r * np.cos(theta), r * np.sin(theta)], axis=1)
+
+
+def build_kg_layout(graph_dict: Dict[str, List[List[str]]], layout_dir: str, iterations: int = 10,
+                    source_fingerprint: Optional[str] = None, seed: int = 0) -> dict:
+    """
+    Lay out the graph of SimpleGraphStore's `graph_dict` in `layout_dir` and return its manifest.
+
+    Nodes are numbered by degree, highest first, so the first `k` nodes are the `k` hubs a
+    zoomed-out view shows. Communities come from `label_propagation`. Each community is a
+    disc with its nodes on a Vogel spiral, hubs in the middle, and the discs are packed
+    around the largest one. This is a fixed, O(E log E) layout instead of a force
+    simulation, so it finishes in seconds for millions of edges. Edges are sorted by
+    the larger of their two node numbers, so the edges between the first `k` nodes
+    are a prefix and every page of nodes owns one contiguous slice. A grid over
+    the positions answers viewport queries. Like the ANN index, the layout is a
+    directory of `.npy` files written to a temporary directory and renamed into place.
+    """
+    started_at = time.perf_counter()
+    names, relations, triples = _edge_arrays(graph_dict)
+    n = len(names)
+    if n == 0:
+        raise ValueError("Cannot lay out a graph without edges")
+    src, rel, dst = triples[:, 0], triples[:, 1], triples[:, 2]
+
+    degree = np.bincount(src, minlength=n) + np.bincount(dst, minlength=n)
+    # Node IDs in degree order; `rank[i]` is the new ID of entity `i`
+    order = np.lexsort((np.arange(n), -degree))
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    src, dst, degree = rank[src], rank[dst], degree[order]
+
+    labels = label_propagation(n, src, dst, iterations=iterations, seed=seed)
+    _, inverse, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+    by_size = np.argsort(-sizes, kind="stable")
+    remap = np.empty(len(sizes), dtype=np.int64)
+    remap[by_size] = np.arange(len(sizes))
+    community, sizes = remap[inverse.ravel()], sizes[by_size]
+
+    # Index of each node within its community; a stable sort keeps the degree order
+    members = np.argsort(community, kind="stable")
+    starts = np.concatenate([[0], np.cumsum(sizes)])
+    local = np.empty(n, dtype=np.int64)
+    local[members] = np.arange(n) - np.repeat(starts[:-1], sizes)
+    radii = NODE_SPACING * (np.sqrt(sizes) + 1)
+    centers = _pack_discs(radii)
+    positions = (centers[community] + NODE_SPACING * _spiral(local)).astype(np.float32)
+    hubs = members[starts[:-1]]
+
+    edge_order = np.lexsort((dst, src, np.maximum(src, dst)))
+    src, rel, dst = src[edge_order], rel[edge_order], dst[edge_order]
+    out_indptr = np.zeros(n + 1, dtype=np.int64)
+    out_indptr[1:] = np.cumsum(np.bincount(src, minlength=n))
+
+    bounds = [float(positions[:, 0].min()), float(positions[:, 1].min()),
+              float(positions[:, 0].max()), float(positions[:, 1].max())]
+    grid = max(1, int(np.ceil(np.sqrt(n / NODES_PER_CELL))))
+    cells = _cells(positions[:, 0], positions[:, 1], bounds, grid)
+    grid_nodes = np.lexsort((np.arange(n), cells))
+    grid_indptr = np.zeros(grid * grid + 1, dtype=np.int64)
+    grid_indptr[1:] = np.cumsum(np.bincount(cells, minlength=grid * grid))
+
+    tmp_dir = layout_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    StringTable.save(tmp_dir, "entities", [names[i] for i in order])
+    StringTable.save(tmp_dir, "relations", relations)
+    _save(tmp_dir, "positions", positions)
+    _save(tmp_dir, "degree", degree.astype(np.int32))
+    _save(tmp_dir, "community", community.astype(np.int32))
+    _save(tmp_dir, "edges.src", src.astype(np.int32))
+    _save(tmp_dir, "edges.rel", rel.astype(np.int32))
+    _save(tmp_dir, "edges.dst", dst.astype(np.int32))
+    _save(tmp_dir, "edges.page", np.maximum(src, dst).astype(np.int32))
+    # Edges of each source node: `src` is sorted within a page, not globally
+    _save(tmp_dir, "out.indptr", out_indptr)
+    _save(tmp_dir, "out.edges", np.argsort(src, kind="stable").astype(np.int32))
+    _save(tmp_dir, "grid.indptr", grid_indptr)
+    _save(tmp_dir, "grid.nodes", grid_nodes.astype(np.int32))
+    _save(tmp_dir, "communities.size", sizes.astype(np.int32))
+    _save(tmp_dir, "communities.center", centers.astype(np.float32))
+    _save(tmp_dir, "communities.radius", radii.astype(np.float32))
+    _save(tmp_dir, "communities.hub", hubs.astype(np.int32))
+
+    manifest = {
+        "format_version": LAYOUT_FORMAT_VERSION,
+        "source_fingerprint": source_fingerprint,
+        "nodes": n,
+        "edges": len(src),
+        "relations": len(relations),
+        "communities": len(sizes),
+        "largest_community": int(sizes[0]),
+        "max_degree": int(degree[0]),
+        "bounds": bounds,
+        "grid": grid,
+        "build_s": round(time.perf_counter() - started_at, 2),
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.exists(layout_dir):
+        old_dir = layout_dir.rstrip("/") + ".old"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.rename(layout_dir, old_dir)
+        os.rename(tmp_dir, layout_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    else:
+        os.rename(tmp_dir, layout_dir)
+    logger.info(f"Built KG layout {layout_dir}: {manifest}")
+    return manifest
+
+
+def build_kg_layout_from_kg(persist_dir: str, layout_dir: str, **kwargs) -> dict:
+    """Build the layout of the graph persisted in `persist_dir`."""
+    with open(os.path.join(persist_dir, DEFAULT_PERSIST_FNAME)) as f:
+        graph_dict = json.load(f).get("graph_dict", {})
+    return build_kg_layout(graph_dict, layout_dir, source_fingerprint=kg_fingerprint(persist_dir), **kwargs)
+
+
+def _cell(v, lo: float, hi: float, grid: int) -> np.ndarray:
+    """Grid column (or row) of coordinates `v`, with coordinates on or past the bounds in the edge cells."""
+    return np.clip((np.asarray(v, dtype=np.float64) - lo) / max(hi - lo, 1e-9) * grid, 0, grid - 1).astype(np.int64)
+
+
+def _cells(x: np.ndarray, y: np.ndarray, bounds: List[float], grid: int) -> np.ndarray:
+    """Row-major grid cell of each point."""
+    x0, y0, x1, y1 = bounds
+    return _cell(y, y0, y1, grid) * grid + _cell(x, x0, x1, grid)
+
+
+class KGLayout:
+    """
+    Precomputed full-KG layout, memory-mapped read-only, served in slices.
+
+    Slices are vis-network nodes (`id`, `label`, `x`, `y`, `group` for the community,
+    `value` for the degree) and edges (`from`, `to`, `label`). Level of detail comes from the
+    degree order of the node IDs. `min_degree` drops the minor nodes, and a slice over its
+    `limit` keeps the nodes with the highest degree. A client can page through the nodes
+    with `page`, hubs first, or ask for what is visible with `viewport`. `communities`
+    gives one marker per community, for views zoomed out too far to show single nodes.
+    """
+
+    def __init__(self, layout_dir: str):
+        self.layout_dir = layout_dir
+        with open(os.path.join(layout_dir, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        if self.manifest["format_version"] != LAYOUT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported KG layout format {self.manifest['format_version']} in {layout_dir}")
+        self.entities = StringTable.load(layout_dir, "entities")
+        self.relations = StringTable.load(layout_dir, "relations")
+        self.positions = _load(layout_dir, "positions")
+        self.degree = _load(layout_dir, "degree")
+        self.community = _load(layout_dir, "community")
+        self.src = _load(layout_dir, "edges.src")
+        self.rel = _load(layout_dir, "edges.rel")
+        self.dst = _load(layout_dir, "edges.dst")
+        self.edge_page = _load(layout_dir, "edges.page")
+        self.out_indptr = _load(layout_dir, "out.indptr")
+        self.out_edges = _load(layout_dir, "out.edges")
+        self.grid_indptr = _load(layout_dir, "grid.indptr")
+        self.grid_nodes = _load(layout_dir, "grid.nodes")
+        self.community_size = _load(layout_dir, "communities.size")
+        self.community_center = _load(layout_dir, "communities.center")
+        self.community_radius = _load(layout_dir, "communities.radius")
+        self.community_hub = _load(layout_dir, "communities.hub")
+
+    def is_current(self, persist_dir: str) -> bool:
+        """True if the layout was built from the KG currently persisted in `persist_dir`."""
+        return self.manifest["source_fingerprint"] == kg_fingerprint(persist_dir)
+
+    def __len__(self) -> int:
+        return len(self.degree)
+
+    def node_count(self, min_degree: int = 0) -> int:
+        """Number of nodes with at least `min_degree` edges; they are nodes 0 to count - 1."""
+        # The degrees are sorted in descending order
+        return len(self) - int(np.searchsorted(self.degree[::-1], min_degree, side="left"))
+
+    def _nodes(self, ids: np.ndarray) -> List[dict]:
+        positions = np.asarray(self.positions[ids])
+        degree, community = np.asarray(self.degree[ids]), np.asarray(self.community[ids])
+        return [
+            {"id": int(i), "label": self.entities[int(i)], "x": round(float(x), 1), "y": round(float(y), 1),
+             "group": int(c), "value": int(d)}
+            for i, (x, y), c, d in zip(ids, positions, community, degree)
+        ]
+
+    def _edges(self, edge_ids: np.ndarray) -> List[dict]:
+        return [
+            {"from": int(s), "to": int(d), "label": self.relations[int(r)]}
+            for s, r, d in zip(self.src[edge_ids], self.rel[edge_ids], self.dst[edge_ids])
+        ]
+
+    def page(self, offset: int = 0, limit: int = DEFAULT_NODE_LIMIT, min_degree: int = 0,
+             edge_limit: int = DEFAULT_EDGE_LIMIT) -> dict:
+        """
+        Nodes `offset` to `offset + limit` in degree order, with the edges between them and the
+        nodes of earlier pages. A client that loads pages in order gets every edge exactly once.
+        """
+        total = self.node_count(min_degree)
+        start = min(max(offset, 0), total)
+        end = min(start + max(limit, 0), total)
+        lo, hi = (int(i) for i in np.searchsorted(self.edge_page, [start, end]))
+        return {
+            "nodes": self._nodes(np.arange(start, end)),
+            "edges": self._edges(np.arange(lo, min(hi, lo + max(edge_limit, 0)))),
+            "offset": start,
+            "next_offset": end if end < total else None,
+            "total_nodes": total,
+            "truncated_edges": max(0, hi - lo - edge_limit),
+        }
+
+    def _in_box(self, x0: float, y0: float, x1: float, y1: float, max_id: int) -> np.ndarray:
+        """IDs below `max_id` of the nodes inside the box, in ascending order."""
+        grid = self.manifest["grid"]
+        bx0, by0, bx1, by1 = self.manifest["bounds"]
+        cx0, cx1 = _cell([x0, x1], bx0, bx1, grid)
+        cy0, cy1 = _cell([y0, y1], by0, by1, grid)
+        # Cells are row-major, so the cells of one grid row inside the box are contiguous
+        candidates = np.concatenate([
+            self.grid_nodes[self.grid_indptr[cy * grid + cx0]:self.grid_indptr[cy * grid + cx1 + 1]]
+            for cy in range(cy0, cy1 + 1)
+        ])
+        candidates = candidates[candidates < max_id]
+        positions = self.positions[candidates]
+        inside = (positions[:, 0] >= x0) & (positions[:, 0] <= x1) & (positions[:, 1] >= y0) & (positions[:, 1] <= y1)
+        return np.sort(candidates[inside])
+
+    def _edges_between(self, ids: np.ndarray) -> np.ndarray:
+        """IDs of the edges whose ends are both in the sorted node `ids`, in page order."""
+        starts, ends = self.out_indptr[ids], self.out_indptr[ids + 1]
+        lengths = ends - starts
+        if not lengths.sum():
+            return np.zeros(0, dtype=np.int64)
+        # Concatenated ranges starts[i]:ends[i], without a Python loop
+        positions = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + np.arange(lengths.sum())
+        edge_ids = np.asarray(self.out_edges[positions])
+        selected = np.zeros(len(self), dtype=bool)
+        selected[ids] = True
+        return np.sort(edge_ids[selected[self.dst[edge_ids]]])
+
+    def viewport(self, x0: float, y0: float, x1: float, y1: float, limit: int = DEFAULT_NODE_LIMIT,
+                 min_degree: int = 0, edge_limit: int = DEFAULT_EDGE_LIMIT) -> dict:
+        """
+        The `limit` nodes with the highest degree inside the box, with the edges between them.
+        Zooming in shrinks the box, so fewer nodes compete for the limit and minor ones appear.
+        """
+        ids = self._in_box(x0, y0, x1, y1, self.node_count(min_degree))
+        visible = len(ids)
+        ids = ids[:max(limit, 0)]
+        edge_ids = self._edges_between(ids)
+        return {
+            "nodes": self._nodes(ids),
+            "edges": self._edges(edge_ids[:max(edge_limit, 0)]),
+            "visible_nodes": visible,
+            "truncated_edges": max(0, len(edge_ids) - edge_limit),
+        }
+
+    def communities(self, limit: int = 100, min_size: int = 1) -> dict:
+        """The `limit` largest communities: center, radius, size and hub (highest degree) entity."""
+        count = min(limit, int(np.count_nonzero(np.asarray(self.community_size) >= min_size)))
+        return {
+            "communities": [
+                {"id": c, "label": self.entities[int(self.community_hub[c])], "hub": int(self.community_hub[c]),
+                 "size": int(self.community_size[c]), "x": round(float(self.community_center[c][0]), 1),
+                 "y": round(float(self.community_center[c][1]), 1), "radius": round(float(self.community_radius[c]), 1)}
+                for c in range(count)
+            ],
+            "total_communities": len(self.community_size),
+        }
@@ -0,0 +1,305 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+from common.metrics import metrics
+from common.retrieval import NO_RELATIONSHIPS_TEXT, RRF_K, knowledge_sequence_node, reciprocal_rank_fusion
+
+logger = logging.getLogger(__name__)
+
+# Resident bytes of an index parsed from the llama_index JSON files per byte of those files,
+# measured with tracemalloc on KGs of 36 KB and 600 KB (about 4.7)
+JSON_MEMORY_FACTOR = 5
+# Runs the per-KG retrievals of federated queries. Apart from LEG_EXECUTOR, which the
+# retrievers it runs submit their own legs to, so the two pools cannot deadlock each other.
+FANOUT_CONCURRENCY = 16
+FANOUT_EXECUTOR = ThreadPoolExecutor(max_workers=FANOUT_CONCURRENCY, thread_name_prefix="kg-fanout")
+# Free threads of FANOUT_EXECUTOR. Like LEG_SLOTS: a retrieval that timed out keeps its thread
+# until it returns, so work is only submitted when a thread is free and otherwise runs inline.
+FANOUT_SLOTS = threading.BoundedSemaphore(FANOUT_CONCURRENCY)
+
+
+class UnknownKG(KeyError):
+    """No KG of the name is in the registry's directory."""
+
+
+def kg_dir(root_dir: str, name: str) -> str:
+    """Directory of the KG `name` under `root_dir`, as load_and_persist_kg.py persists it."""
+    dirname = name.replace('/', '_')
+    if not dirname or dirname.startswith('.') or os.sep in dirname:
+        raise UnknownKG(name)
+    return os.path.join(root_dir, dirname)
+
+
+def estimate_kg_bytes(persist_dir: str, snapshot_dir: Optional[str] = None) -> int:
+    """
+    Memory an index takes once loaded: the size of its snapshot if `snapshot_dir` is given,
+    as every mapped page may become resident, otherwise JSON_MEMORY_FACTOR times its JSON files.
+    """
+    directory, factor = (snapshot_dir, 1) if snapshot_dir is not None else (persist_dir, JSON_MEMORY_FACTOR)
+    size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+    return size * factor
+
+
+class ResidentKG(NamedTuple):
+    name: str
+    retriever: BaseRetriever
+    nbytes: int
+
+
+class KGRegistry:
+    """
+    Named KGs loaded on first use and kept in an LRU of resident retrievers.
+
+    `loader(name)` loads the KG `name` and returns its retriever, `estimate(name)` the bytes
+    it will take; both raise UnknownKG for an unknown KG. Before a load, the least recently
+    used KGs are evicted until the resident KGs, those being loaded and the new one fit in
+    `memory_budget` bytes. A KG larger than the budget is still loaded, alone. Evicted
+    retrievers are only dropped from the registry: queries holding them finish normally.
+    Concurrent requests for the same KG wait for a single load; loads of different KGs
+    run in parallel. Counted as `kg_registry.hits`, `.loads` and `.evictions`, with the
+    load time of each KG in `kg_registry.load.<name>`.
+    """
+
+    def __init__(self, loader: Callable[[str], BaseRetriever], estimate: Callable[[str], int], memory_budget: int):
+        self.loader = loader
+        self.estimate = estimate
+        self.memory_budget = memory_budget
+        self._resident: "OrderedDict[str, ResidentKG]" = OrderedDict()
+        self._reserved: Dict[str, int] = {}
+        self._loading: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._resident
+
+    @property
+    def resident(self) -> List[str]:
+        """Names of the resident KGs, least recently used first."""
+        with self._lock:
+            return list(self._resident)
+
+    @property
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(kg.nbytes for kg in self._resident.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "resident": list(self._resident),
+                "resident_bytes": sum(kg.nbytes for kg in self._resident.values()),
+                "loading": list(self._reserved),
+                "memory_budget": self.memory_budget,
+            }
+
+    def _lookup(self, name: str) -> Optional[ResidentKG]:
+        kg = self._resident.get(name)
+        if kg is not None:
+            self._resident.move_to_end(name)
+        return kg
+
+    def get(self, name: str) -> ResidentKG:
+        """The resident KG `name`, loading it first if needed."""
+        with self._lock:
+            kg = self._lookup(name)
+            if kg is not None:
+                metrics.incr("kg_registry.hits")
+                return kg
+            load_lock = self._loading.setdefault(name, threading.Lock())
+        with load_lock:
+            with self._lock:
+                # Loaded by the request this one waited for
+                kg = self._lookup(name)
+                if kg is not None:
+                    metrics.incr("kg_registry.hits")
+                    return kg
+            nbytes = self.estimate(name)
+            with self._lock:
+                self._make_room(nbytes)
+                self._reserved[name] = nbytes
+            try:
+                with metrics.timer(f"kg_registry.load.{name}"):
+                    retriever = self.loader(name)
+            finally:
+                with self._lock:
+                    self._reserved.pop(name, None)
+            metrics.incr("kg_registry.loads")
+            kg = ResidentKG(name, retriever, nbytes)
+            with self._lock:
+                self._resident[name] = kg
+                self._loading.pop(name, None)
+            logger.info(f"Loaded KG {name!r} ({nbytes / 2**20:.1f} MiB), resident: {self.resident}")
+            return kg
+
+    def _make_room(self, nbytes: int):
+        """Evict least recently used KGs until `nbytes` more fit in the budget. Holds the lock."""
+        used = sum(kg.nbytes for kg in self._resident.values()) + sum(self._reserved.values())
+        while self._resident and used + nbytes > self.memory_budget:
+            name, kg = self._resident.popitem(last=False)
+            used -= kg.nbytes
+            metrics.incr("kg_registry.evictions")
+            logger.info(f"Evicted KG {name!r} ({kg.nbytes / 2**20:.1f} MiB) from the registry")
+        if used + nbytes > self.memory_budget:
+            logger.warning(f"KGs being loaded exceed the registry's memory budget of {self.memory_budget / 2**20:.1f} MiB")
+
+    def evict(self, name: str) -> bool:
+        """Drop the KG `name` from the registry, returning whether it was resident."""
+        with self._lock:
+            return self._resident.pop(name, None) is not None
+
+
+class FederatedRetriever(BaseRetriever):
+    """
+    Retrieves from several KGs of a registry at once and merges the results.
+
+    Each KG is loaded if needed, then all are queried concurrently on FANOUT_EXECUTOR, or on
+    the calling thread and without a timeout when none of its threads is free. From
+    every KG, the first `top_k` triplets and `top_k` text chunks are kept; triplets and chunks
+    are then merged across KGs with reciprocal rank fusion, weighted per KG by `weights`
+    (default 1). The result has the shape of a KGRetriever's: up to `max_chunks` chunk nodes
+    scored by fusion, then one node of the fused triplets. A KG whose retrieval takes more
+    than `timeout` seconds is left out of the answer, as are KGs whose retrieval fails, unless
+    all of them do. The retrieval time of each KG is observed as `kg_registry.retrieve.<name>`;
+    its load and retrieval times of the last query are also kept in `timings` (milliseconds),
+    so create one FederatedRetriever per query.
+    """
+
+    def __init__(self, registry: KGRegistry, kg_names: Sequence[str], top_k: int = 10, max_chunks: int = 5,
+                 timeout: Optional[float] = None, weights: Optional[Dict[str, float]] = None,
+                 graph_store_query_depth: int = 1, **kwargs):
+        super().__init__(**kwargs)
+        if not kg_names:
+            raise ValueError("At least one KG is needed")
+        self.registry = registry
+        self.kg_names = list(dict.fromkeys(kg_names))
+        self.top_k = top_k
+        self.max_chunks = max_chunks
+        self.timeout = timeout
+        self.weights = weights or {}
+        self.graph_store_query_depth = graph_store_query_depth
+        self.timings: Dict[str, Dict[str, float]] = {}
+
+    def _load(self) -> Dict[str, ResidentKG]:
+        """Resident KGs of the query, loaded in parallel. Unknown KGs raise UnknownKG."""
+        futures = {name: self._submit(self.registry.get, name) for name in self.kg_names if name not in self.registry}
+        loaded = {name: self._timed(self.registry.get, name) for name, future in futures.items() if future is None}
+        kgs = {}
+        for name in self.kg_names:
+            if name not in futures:
+                kgs[name] = self.registry.get(name)
+                self.timings[name] = {"load_ms": 0.0}
+                continue
+            kgs[name], elapsed = loaded[name] if futures[name] is None else futures[name].result()
+            self.timings[name] = {"load_ms": round(elapsed * 1000, 3)}
+        return kgs
+
+    @staticmethod
+    def _timed(fn: Callable, *args):
+        started_at = time.perf_counter()
+        result = fn(*args)
+        return result, time.perf_counter() - started_at
+
+    def _submit(self, fn: Callable, *args):
+        """Submit `fn(*args)`, timed, to FANOUT_EXECUTOR if one of its threads is free, else return None."""
+        if not FANOUT_SLOTS.acquire(blocking=False):
+            metrics.incr("kg_registry.fanout_inline")
+            return None
+        submitted_at = time.perf_counter()
+
+        def run():
+            try:
+                metrics.observe("kg_registry.fanout.queue_wait", time.perf_counter() - submitted_at)
+                return self._timed(fn, *args)
+            finally:
+                FANOUT_SLOTS.release()
+
+        return FANOUT_EXECUTOR.submit(run)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        self.timings = {}
+        kgs = self._load()
+        started_at = time.monotonic()
+        futures = {name: self._submit(kg.retriever.retrieve, query_bundle) for name, kg in kgs.items()}
+        # The KGs without a free thread are retrieved here, without a timeout, while the others run
+        inline = {}
+        for name, future in futures.items():
+            if future is None:
+                try:
+                    inline[name] = self._timed(kgs[name].retriever.retrieve, query_bundle)
+                except Exception as e:
+                    inline[name] = e
+        results, errors = {}, []
+        for name, future in futures.items():
+            remaining = None if self.timeout is None else max(0.0, started_at + self.timeout - time.monotonic())
+            try:
+                if future is None:
+                    if isinstance(inline[name], Exception):
+                        raise inline[name]
+                    results[name], elapsed = inline[name]
+                else:
+                    results[name], elapsed = future.result(timeout=remaining)
+            except FuturesTimeoutError:
+                metrics.incr("kg_registry.retrieve_timeouts")
+                logger.warning(f"Retrieval from KG {name!r} exceeded {self.timeout}s, answering without it")
+                self.timings[name]["timed_out"] = True
+                continue
+            except Exception as e:
+                metrics.incr("kg_registry.retrieve_errors")
+                logger.error(f"Retrieval from KG {name!r} failed: {e!r}")
+                errors.append(e)
+                continue
+            metrics.observe(f"kg_registry.retrieve.{name}", elapsed)
+            self.timings[name]["retrieve_ms"] = round(elapsed * 1000, 3)
+        if not results and errors:
+            raise errors[0]
+        return self._fuse(results)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return await asyncio.to_thread(self._retrieve, query_bundle)
+
+    def _fuse(self, results: Dict[str, List[NodeWithScore]]) -> List[NodeWithScore]:
+        """Merge the nodes of every KG into chunk nodes plus one node of the fused triplets."""
+        triplet_lists, chunk_lists, weights = [], [], []
+        chunks, rel_map = {}, {}
+        for name, nodes in results.items():
+            rel_texts, chunk_ids = [], []
+            for node_with_score in nodes:
+                node = node_with_score.node
+                if "kg_rel_texts" in node.metadata:
+                    rel_texts.extend(node.metadata["kg_rel_texts"])
+                    for subject, paths in node.metadata.get("kg_rel_map", {}).items():
+                        # A subject found in several KGs keeps the paths of all of them, once each
+                        merged = rel_map.setdefault(subject, [])
+                        merged.extend(path for path in paths if path not in merged)
+                elif node.get_content() != NO_RELATIONSHIPS_TEXT:
+                    chunk_ids.append(node.node_id)
+                    chunks.setdefault(node.node_id, node)
+            triplet_lists.append(rel_texts[: self.top_k])
+            chunk_lists.append(chunk_ids[: self.top_k])
+            weights.append(self.weights.get(name, 1.0))
+
+        chunk_scores = self._rrf_scores(chunk_lists, weights)
+        chunk_ids = sorted(chunk_scores, key=lambda node_id: -chunk_scores[node_id])[: self.max_chunks]
+        fused = [NodeWithScore(node=chunks[node_id], score=chunk_scores[node_id]) for node_id in chunk_ids]
+        rel_texts = reciprocal_rank_fusion(triplet_lists, weights)
+        if rel_texts:
+            fused.append(knowledge_sequence_node(rel_texts, rel_map, self.graph_store_query_depth))
+        return fused
+
+    @staticmethod
+    def _rrf_scores(ranked_lists: Sequence[Sequence[str]], weights: Sequence[float], k: int = RRF_K) -> Dict[str, float]:
+        """Reciprocal rank fusion scores of node IDs, in order of first occurrence."""
+        scores = {}
+        for ranked, weight in zip(ranked_lists, weights):
+            for rank, item in enumerate(ranked, start=1):
+                scores[item] = scores.get(item, 0.0) + weight / (k + rank)
+        return scores
@@ -0,0 +1,478 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+import numpy as np
+from collections.abc import Mapping
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from llama_index.core import KnowledgeGraphIndex, StorageContext
+from llama_index.core.data_structs.data_structs import KG
+from llama_index.core.graph_stores.types import GraphStore
+from llama_index.core.storage.docstore.keyval_docstore import KVDocumentStore
+from llama_index.core.storage.index_store.types import BaseIndexStore
+from llama_index.core.storage.kvstore.types import BaseKVStore, DEFAULT_COLLECTION
+
+from common.utils import kg_fingerprint
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+# Limit SimpleGraphStore applies below the first level of a rel-map query
+DEFAULT_REL_MAP_LIMIT = 30
+
+
+def _save(directory: str, name: str, array: np.ndarray):
+    np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(array))
+
+
+def _load(directory: str, name: str) -> np.ndarray:
+    path = os.path.join(directory, f"{name}.npy")
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        # Empty arrays cannot be memory-mapped
+        return np.load(path)
+
+
+class StringTable:
+    """
+    Read-only list of strings stored as one UTF-8 blob and an offsets array.
+
+    String `i` is `data[offsets[i]:offsets[i + 1]]`. Tables saved from sorted
+    strings are in code point order, which is also UTF-8 byte order, so `find()`
+    can binary search them while reading only log2(n) entries.
+    """
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray):
+        self.offsets = offsets
+        self.data = data
+
+    @staticmethod
+    def save(directory: str, name: str, strings: Iterable[str]):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded], dtype=np.int64)
+        _save(directory, f"{name}.offsets", offsets)
+        _save(directory, f"{name}.data", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    @classmethod
+    def load(cls, directory: str, name: str) -> "StringTable":
+        return cls(_load(directory, f"{name}.offsets"), _load(directory, f"{name}.data"))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def raw(self, i: int) -> bytes:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def __getitem__(self, i: int) -> str:
+        return self.raw(i).decode("utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def find(self, s: str) -> int:
+        """Index of `s` in a sorted table, or -1."""
+        target = s.encode("utf-8")
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self) and self.raw(lo) == target else -1
+
+
+def _save_csr(directory: str, name: str, rows: List[List[int]], dtype=np.int32, columns: int = 1):
+    """Save integer rows as CSR: `<name>.indptr` and one `<name>.<j>` array per column."""
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(row) for row in rows], dtype=np.int64)
+    _save(directory, f"{name}.indptr", indptr)
+    for j in range(columns):
+        values = [entry[j] if columns > 1 else entry for row in rows for entry in row]
+        _save(directory, f"{name}.{j}", np.asarray(values, dtype=dtype))
+
+
+def _collection_file(collection: str) -> str:
+    return "kv." + collection.replace("/", "__")
+
+
+def compile_snapshot(persist_dir: str, snapshot_dir: str) -> dict:
+    """
+    Convert a KnowledgeGraphIndex persisted as llama_index JSON files in `persist_dir` into a
+    binary snapshot in `snapshot_dir`, and return its manifest.
+
+    The snapshot is a directory of `.npy` arrays:
+
+    - entity and relation names as sorted string tables, and the graph as CSR adjacency
+      (`graph.indptr`, `graph.0` relation IDs, `graph.1` object IDs) in the original edge
+      order, plus the original subject order (`graph.subjects`)
+    - the keyword table as a sorted keyword table plus CSR rows of node IDs
+    - the triplet embeddings as one contiguous, L2-normalized float32 matrix whose rows
+      follow the sorted `triplets` table
+    - every docstore collection as a sorted key table plus an offset-indexed blob of JSON values
+
+    It is written to a temporary directory first and renamed into place, so a server never
+    sees a half-written snapshot.
+    """
+    started_at = time.perf_counter()
+    with open(os.path.join(persist_dir, "index_store.json")) as f:
+        index_store = json.load(f)
+    index_structs = [s for s in index_store["index_store/data"].values() if s["__type__"] == "kg"]
+    if len(index_structs) != 1:
+        raise ValueError(f"Expected one knowledge graph index in {persist_dir}, found {len(index_structs)}")
+    index_struct = json.loads(index_structs[0]["__data__"])
+
+    with open(os.path.join(persist_dir, "graph_store.json")) as f:
+        graph_dict = json.load(f).get("graph_dict", {})
+    if not graph_dict:
+        # Indices persisted before the graph store existed keep their triplets in rel_map
+        graph_dict = index_struct.get("rel_map", {})
+
+    with open(os.path.join(persist_dir, "docstore.json")) as f:
+        docstore = json.load(f)
+
+    tmp_dir = snapshot_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    # Graph
+    entities = sorted(set(graph_dict) | {obj for edges in graph_dict.values() for _, obj in edges})
+    relations = sorted({rel for edges in graph_dict.values() for rel, _ in edges})
+    entity_ids = {name: i for i, name in enumerate(entities)}
+    relation_ids = {name: i for i, name in enumerate(relations)}
+    StringTable.save(tmp_dir, "entities", entities)
+    StringTable.save(tmp_dir, "relations", relations)
+    _save_csr(tmp_dir, "graph", [
+        [(relation_ids[rel], entity_ids[obj]) for rel, obj in graph_dict.get(entity, [])]
+        for entity in entities
+    ], columns=2)
+    # Subjects in their original order, which rel-map queries over all subjects follow
+    _save(tmp_dir, "graph.subjects", np.asarray([entity_ids[subj] for subj in graph_dict], dtype=np.int32))
+
+    # Keyword table
+    table = index_struct.get("table", {})
+    keywords = sorted(table)
+    node_ids = sorted({node_id for ids in table.values() for node_id in ids})
+    node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+    StringTable.save(tmp_dir, "keywords", keywords)
+    StringTable.save(tmp_dir, "node_ids", node_ids)
+    _save_csr(tmp_dir, "keyword_table", [[node_index[node_id] for node_id in table[keyword]] for keyword in keywords])
+
+    # Triplet embeddings
+    embedding_dict = index_struct.get("embedding_dict", {})
+    triplets = sorted(embedding_dict)
+    StringTable.save(tmp_dir, "triplets", triplets)
+    embeddings = np.asarray([embedding_dict[t] for t in triplets], dtype=np.float32).reshape(len(triplets), -1)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    _save(tmp_dir, "embeddings", embeddings / np.where(norms == 0, 1, norms))
+
+    # Docstore collections
+    collections = sorted(docstore)
+    for collection in collections:
+        keys = sorted(docstore[collection])
+        StringTable.save(tmp_dir, f"{_collection_file(collection)}.keys", keys)
+        StringTable.save(tmp_dir, f"{_collection_file(collection)}.values", (
+            json.dumps(docstore[collection][key], separators=(",", ":")) for key in keys
+        ))
+
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "source_fingerprint": kg_fingerprint(persist_dir),
+        "index_id": index_struct["index_id"],
+        "summary": index_struct.get("summary"),
+        "entities": len(entities),
+        "relations": len(relations),
+        "edges": sum(len(edges) for edges in graph_dict.values()),
+        "keywords": len(keywords),
+        "nodes": len(node_ids),
+        "triplets": len(triplets),
+        "embedding_dim": int(embeddings.shape[1]) if len(triplets) else 0,
+        "docstore_collections": collections,
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.exists(snapshot_dir):
+        old_dir = snapshot_dir.rstrip("/") + ".old"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.rename(snapshot_dir, old_dir)
+        os.rename(tmp_dir, snapshot_dir)
+        # Workers still mapping the old files keep them alive until they reload
+        shutil.rmtree(old_dir, ignore_errors=True)
+    else:
+        os.rename(tmp_dir, snapshot_dir)
+    logger.info(f"Compiled KG snapshot {snapshot_dir} in {time.perf_counter() - started_at:.2f}s: {manifest}")
+    return manifest
+
+
+class SnapshotGraphStore(GraphStore):
+    """
+    Read-only graph store over the CSR adjacency of a KG snapshot.
+
+    Rel-map queries return exactly what SimpleGraphStore returns for the same
+    triplets, including the flattened `[subj, rel, obj]` paths and the limits it
+    applies per level.
+    """
+
+    def __init__(self, snapshot: "KGSnapshot"):
+        self._entities = snapshot.entities
+        self._relations = snapshot.relations
+        self._indptr = snapshot.graph_indptr
+        self._rel_ids = snapshot.graph_relations
+        self._obj_ids = snapshot.graph_objects
+        self._subjects = snapshot.graph_subjects
+
+    @property
+    def client(self) -> None:
+        return None
+
+    def get(self, subj: str) -> List[List[str]]:
+        """Get triplets."""
+        i = self._entities.find(subj)
+        if i < 0:
+            return []
+        start, end = self._indptr[i], self._indptr[i + 1]
+        return [[self._relations[r], self._entities[o]] for r, o in zip(self._rel_ids[start:end], self._obj_ids[start:end])]
+
+    def get_rel_map(self, subjs: Optional[List[str]] = None, depth: int = 2, limit: int = 30) -> Dict[str, List[List[str]]]:
+        """Get depth-aware rel map."""
+        if subjs is None:
+            subjs = [self._entities[i] for i in self._subjects]
+        # Same truncation as SimpleGraphStore, but stops expanding once the limit is reached
+        rel_count = 0
+        return_map = {}
+        for subj in subjs:
+            rel_map = self._get_rel_map(self._entities.find(subj), subj, depth=depth, limit=limit)
+            if rel_count + len(rel_map) > limit:
+                return_map[subj] = rel_map[: limit - rel_count]
+                break
+            return_map[subj] = rel_map
+            rel_count += len(rel_map)
+        return return_map
+
+    def _get_rel_map(self, i: int, subj: str, depth: int, limit: int = DEFAULT_REL_MAP_LIMIT) -> List[List[str]]:
+        if depth == 0 or i < 0:
+            return []
+        rel_map = []
+        start = self._indptr[i]
+        end = min(self._indptr[i + 1], start + limit)
+        for r, o in zip(self._rel_ids[start:end], self._obj_ids[start:end]):
+            obj = self._entities[o]
+            rel_map.append([subj, self._relations[r], obj])
+            rel_map += self._get_rel_map(int(o), obj, depth=depth - 1)
+        return rel_map
+
+    def upsert_triplet(self, subj: str, rel: str, obj: str) -> None:
+        raise NotImplementedError("KG snapshots are read-only; rebuild the snapshot instead")
+
+    def delete(self, subj: str, rel: str, obj: str) -> None:
+        raise NotImplementedError("KG snapshots are read-only; rebuild the snapshot instead")
+
+    def persist(self, persist_path: str, fs=None) -> None:
+        raise NotImplementedError("KG snapshots are written by compile_snapshot")
+
+    def get_schema(self, refresh: bool = False) -> str:
+        raise NotImplementedError("SnapshotGraphStore does not support get_schema")
+
+    def query(self, query: str, param_map: Optional[Dict[str, Any]] = {}) -> Any:
+        raise NotImplementedError("SnapshotGraphStore does not support query")
+
+
+class SnapshotKVStore(BaseKVStore):
+    """Read-only key-value store over the docstore collections of a KG snapshot."""
+
+    def __init__(self, snapshot: "KGSnapshot"):
+        self._collections = snapshot.collections
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        if collection not in self._collections:
+            return None
+        keys, values = self._collections[collection]
+        i = keys.find(key)
+        return json.loads(values.raw(i)) if i >= 0 else None
+
+    async def aget(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        return self.get(key, collection)
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        if collection not in self._collections:
+            return {}
+        keys, values = self._collections[collection]
+        return {keys[i]: json.loads(values.raw(i)) for i in range(len(keys))}
+
+    async def aget_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        return self.get_all(collection)
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        raise NotImplementedError("KG snapshots are read-only")
+
+    async def aput(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        raise NotImplementedError("KG snapshots are read-only")
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        raise NotImplementedError("KG snapshots are read-only")
+
+    async def adelete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        raise NotImplementedError("KG snapshots are read-only")
+
+
+class SnapshotIndexStore(BaseIndexStore):
+    """
+    Holds the snapshot's index struct as is. SimpleIndexStore would serialize it
+    to JSON on `add_index_struct`, copying every embedding into the worker.
+    """
+
+    def __init__(self):
+        self._index_structs = {}
+
+    def index_structs(self) -> list:
+        return list(self._index_structs.values())
+
+    def add_index_struct(self, index_struct) -> None:
+        self._index_structs[index_struct.index_id] = index_struct
+
+    def delete_index_struct(self, key: str) -> None:
+        self._index_structs.pop(key, None)
+
+    def get_index_struct(self, struct_id: Optional[str] = None):
+        if struct_id is None:
+            return next(iter(self._index_structs.values()), None)
+        return self._index_structs.get(struct_id)
+
+    def persist(self, persist_path: str = None, fs=None) -> None:
+        raise NotImplementedError("KG snapshots are written by compile_snapshot")
+
+
+class SnapshotKeywordTable(Mapping):
+    """The `KG.table` mapping (keyword -> set of node IDs) backed by the snapshot's CSR keyword table."""
+
+    def __init__(self, snapshot: "KGSnapshot"):
+        self._keywords = snapshot.keywords
+        self._node_ids = snapshot.node_ids
+        self._indptr = snapshot.keyword_indptr
+        self._nodes = snapshot.keyword_nodes
+
+    def __getitem__(self, keyword: str) -> set:
+        i = self._keywords.find(keyword)
+        if i < 0:
+            raise KeyError(keyword)
+        return {self._node_ids[n] for n in self._nodes[self._indptr[i]:self._indptr[i + 1]]}
+
+    def __contains__(self, keyword) -> bool:
+        return isinstance(keyword, str) and self._keywords.find(keyword) >= 0
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._keywords)
+
+    def __len__(self) -> int:
+        return len(self._keywords)
+
+
+class SnapshotEmbeddingDict(Mapping):
+    """
+    The `KG.embedding_dict` mapping (triplet text -> embedding) backed by the snapshot's
+    embedding matrix. Values are read-only rows of the memory-mapped, L2-normalized matrix,
+    which gives the same cosine similarities as the original embeddings.
+    """
+
+    def __init__(self, snapshot: "KGSnapshot"):
+        self.triplets = snapshot.triplets
+        self.matrix = snapshot.embeddings
+        self._rows = None
+        self._rows_lock = threading.Lock()
+
+    def row(self, triplet: str) -> int:
+        """Matrix row of `triplet`, or -1."""
+        # Retrievers look up every triplet per query, so the binary search is replaced by
+        # a dict on first use. It holds the triplet strings only, not the embeddings.
+        if self._rows is None:
+            with self._rows_lock:
+                if self._rows is None:
+                    self._rows = {triplet: i for i, triplet in enumerate(self.triplets)}
+        return self._rows.get(triplet, -1)
+
+    def __getitem__(self, triplet: str) -> np.ndarray:
+        i = self.row(triplet)
+        if i < 0:
+            raise KeyError(triplet)
+        return self.matrix[i]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.triplets)
+
+    def __len__(self) -> int:
+        return len(self.triplets)
+
+
+class KGSnapshot:
+    """
+    A compiled KG snapshot, memory-mapped read-only.
+
+    Every array is mapped with `np.load(mmap_mode="r")`, so the graph, texts and
+    embeddings stay in the OS page cache and are shared by all workers on the host
+    instead of being parsed into a private copy per worker. `load_index()` wraps the
+    snapshot in a regular KnowledgeGraphIndex for the existing query engine code.
+    """
+
+    def __init__(self, snapshot_dir: str):
+        self.snapshot_dir = snapshot_dir
+        with open(os.path.join(snapshot_dir, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        if self.manifest["format_version"] != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported KG snapshot format {self.manifest['format_version']} in {snapshot_dir}")
+        self.entities = StringTable.load(snapshot_dir, "entities")
+        self.relations = StringTable.load(snapshot_dir, "relations")
+        self.graph_indptr = _load(snapshot_dir, "graph.indptr")
+        self.graph_relations = _load(snapshot_dir, "graph.0")
+        self.graph_objects = _load(snapshot_dir, "graph.1")
+        self.graph_subjects = _load(snapshot_dir, "graph.subjects")
+        self.keywords = StringTable.load(snapshot_dir, "keywords")
+        self.node_ids = StringTable.load(snapshot_dir, "node_ids")
+        self.keyword_indptr = _load(snapshot_dir, "keyword_table.indptr")
+        self.keyword_nodes = _load(snapshot_dir, "keyword_table.0")
+        self.triplets = StringTable.load(snapshot_dir, "triplets")
+        self.embeddings = _load(snapshot_dir, "embeddings")
+        self.collections = {
+            collection: (
+                StringTable.load(snapshot_dir, f"{_collection_file(collection)}.keys"),
+                StringTable.load(snapshot_dir, f"{_collection_file(collection)}.values"),
+            )
+            for collection in self.manifest["docstore_collections"]
+        }
+
+    def is_current(self, persist_dir: str) -> bool:
+        """True if the snapshot was compiled from the KG currently persisted in `persist_dir`."""
+        return self.manifest["source_fingerprint"] == kg_fingerprint(persist_dir)
+
+    def index_struct(self) -> KG:
+        return KG(
+            index_id=self.manifest["index_id"],
+            summary=self.manifest["summary"],
+            table=SnapshotKeywordTable(self),
+            embedding_dict=SnapshotEmbeddingDict(self),
+        )
+
+    def storage_context(self, graph_store: Optional[GraphStore] = None) -> StorageContext:
+        return StorageContext.from_defaults(
+            docstore=KVDocumentStore(SnapshotKVStore(self)),
+            index_store=SnapshotIndexStore(),
+            graph_store=graph_store or SnapshotGraphStore(self),
+        )
+
+    def load_index(self, graph_store: Optional[GraphStore] = None, **kwargs) -> KnowledgeGraphIndex:
+        """
+        Build a KnowledgeGraphIndex served from the snapshot. `graph_store` replaces the
+        SnapshotGraphStore, e.g. with a CSRGraphStore over the same arrays.
+        """
+        return KnowledgeGraphIndex(
+            index_struct=self.index_struct(),
+            storage_context=self.storage_context(graph_store),
+            **kwargs,
+        )
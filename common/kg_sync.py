@@ -0,0 +1,283 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+from fsspec.utils import tokenize
+
+from common.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SYNC_FORMAT_VERSION = 1
+# Versions of the files a synced KG directory holds, written last when it is swapped in
+SYNC_MANIFEST_FILE = ".sync_manifest.json"
+# Files of an interrupted sync already downloaded into its staging directory
+STAGED_FILE = ".staged.json"
+STAGING_SUFFIX = ".sync"
+PART_SUFFIX = ".part"
+CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_PARALLELISM = 8
+DEFAULT_RETRIES = 3
+
+
+class RemoteFile(NamedTuple):
+    path: str
+    size: int
+    version: str
+
+
+class KGSyncResult(NamedTuple):
+    name: str
+    status: str
+    downloaded: int = 0
+    reused: int = 0
+    resumed: int = 0
+    deleted: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+
+def _version(info: dict) -> str:
+    """ETag of an S3 object; other filesystems get a token of the size and modification time."""
+    etag = info.get("ETag") or info.get("etag")
+    if etag:
+        return etag.strip('"')
+    return "mtime-" + tokenize(info.get("size"), info.get("mtime") or info.get("LastModified") or info.get("created"))
+
+
+def remote_manifest(fs, remote_dir: str) -> Dict[str, RemoteFile]:
+    """Every file under `remote_dir` by its path relative to it, with one listing."""
+    root = fs._strip_protocol(remote_dir).rstrip("/")
+    files = {}
+    for name, info in fs.find(root, detail=True).items():
+        if info.get("type", "file") != "file":
+            continue
+        path = posixpath.relpath(fs._strip_protocol(name), root)
+        files[path] = RemoteFile(path, int(info.get("size") or 0), _version(info))
+    return files
+
+
+def read_manifest(path: str) -> Dict[str, dict]:
+    """`{relative path: {"size", "version"}}` of a synced or staging directory, empty if it has none."""
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("format_version") != SYNC_FORMAT_VERSION:
+        return {}
+    return manifest.get("files", {})
+
+
+def _write_manifest(path: str, files: Dict[str, dict], **extra):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"format_version": SYNC_FORMAT_VERSION, **extra, "files": files}, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _entry(remote: RemoteFile) -> dict:
+    return {"size": remote.size, "version": remote.version}
+
+
+def _part_tag(file: RemoteFile) -> str:
+    return hashlib.blake2b(file.version.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _md5_etag(version: str) -> bool:
+    """An ETag that is the MD5 of the object, as S3 computes for single-part uploads."""
+    return len(version) == 32 and all(c in "0123456789abcdef" for c in version)
+
+
+class KGSync:
+    """
+    Incremental copy of KG folders from S3 (or any fsspec filesystem) to local disk.
+
+    Each local KG directory keeps a manifest of the size and ETag of its files. A sync lists
+    the remote folder once and downloads only the files whose size or ETag changed, for all
+    folders at once on a pool of `parallelism` threads. Files are downloaded into a staging
+    directory next to the KG, `<dir>.sync`, which the unchanged files are hard-linked into;
+    the finished directory then replaces the KG with two renames, so readers never see a mix
+    of versions. Files are streamed to `.part` files and verified against their size and,
+    for single-part uploads, their MD5 ETag. An interrupted sync resumes: completed files
+    are recorded in the staging directory and partial files continue from their length,
+    as long as the remote version did not change. Failed downloads are retried `retries`
+    times; a folder with a failed file is left as it was and reported as failed.
+    """
+
+    def __init__(self, fs, parallelism: int = DEFAULT_PARALLELISM, retries: int = DEFAULT_RETRIES,
+                 chunk_size: int = CHUNK_SIZE):
+        self.fs = fs
+        self.parallelism = parallelism
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+
+    def plan(self, remote_dir: str, local_dir: str) -> tuple:
+        """Remote files, and those of them that have to be downloaded into `local_dir`."""
+        remote = remote_manifest(self.fs, remote_dir)
+        local = read_manifest(os.path.join(local_dir, SYNC_MANIFEST_FILE))
+        changed = [
+            file for path, file in sorted(remote.items())
+            if local.get(path) != _entry(file) or not os.path.exists(os.path.join(local_dir, path))
+        ]
+        return remote, changed
+
+    def sync(self, folders: Dict[str, tuple]) -> List[KGSyncResult]:
+        """
+        Sync every `{name: (remote_dir, local_dir)}` folder and return their results. Folders
+        are planned one after the other and their files downloaded concurrently.
+        """
+        with ThreadPoolExecutor(max_workers=self.parallelism, thread_name_prefix="kg-sync") as executor:
+            jobs = []
+            for name, (remote_dir, local_dir) in folders.items():
+                started_at = time.perf_counter()
+                try:
+                    remote, changed = self.plan(remote_dir, local_dir)
+                except Exception as e:
+                    logger.error(f"Listing {remote_dir} failed: {e!r}")
+                    jobs.append((name, started_at, None, e))
+                    continue
+                if not remote:
+                    jobs.append((name, started_at, None, FileNotFoundError(f"No files under {remote_dir}")))
+                    continue
+                stale = set(read_manifest(os.path.join(local_dir, SYNC_MANIFEST_FILE))) - set(remote)
+                if not changed and not stale:
+                    # Left by a sync interrupted before the remote changed back
+                    shutil.rmtree(local_dir.rstrip("/") + STAGING_SUFFIX, ignore_errors=True)
+                    jobs.append((name, started_at, KGSyncResult(name, "up_to_date", reused=len(remote)), None))
+                    continue
+                staging_dir, staged = self._prepare(local_dir, remote, changed)
+                futures = [
+                    executor.submit(self._download, posixpath.join(remote_dir.rstrip("/"), file.path), staging_dir, file, staged)
+                    for file in changed if file.path not in staged
+                ]
+                jobs.append((name, started_at, (remote_dir, local_dir, staging_dir, remote, changed, staged, futures, len(stale)), None))
+
+            return [self._finish(*job) for job in jobs]
+
+    def _prepare(self, local_dir: str, remote: Dict[str, RemoteFile], changed: Sequence[RemoteFile]) -> tuple:
+        """The staging directory of `local_dir`, with the unchanged files linked in and the files an earlier run staged."""
+        staging_dir = local_dir.rstrip("/") + STAGING_SUFFIX
+        os.makedirs(staging_dir, exist_ok=True)
+        # Staged by an interrupted run, and still the current remote version
+        staged = {
+            path: entry for path, entry in read_manifest(os.path.join(staging_dir, STAGED_FILE)).items()
+            if path in remote and entry == _entry(remote[path]) and os.path.exists(os.path.join(staging_dir, path))
+        }
+        changed_paths = {file.path for file in changed}
+        # Partial files of the current remote versions; anything else left by an earlier run goes
+        keep = set(staged) | {f"{file.path}.{_part_tag(file)}{PART_SUFFIX}" for file in changed}
+        for dirpath, _, filenames in os.walk(staging_dir):
+            for filename in filenames:
+                path = os.path.relpath(os.path.join(dirpath, filename), staging_dir).replace(os.sep, "/")
+                if path not in keep and path != STAGED_FILE:
+                    os.remove(os.path.join(dirpath, filename))
+        for path, file in remote.items():
+            if path in changed_paths:
+                continue
+            target = os.path.join(staging_dir, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.link(os.path.join(local_dir, path), target)
+            except OSError:
+                shutil.copy2(os.path.join(local_dir, path), target)
+        return staging_dir, staged
+
+    def _download(self, remote_path: str, staging_dir: str, file: RemoteFile, staged: Dict[str, dict]) -> tuple:
+        """Download one file into the staging directory, returning the bytes transferred and whether it resumed."""
+        target = os.path.join(staging_dir, file.path)
+        # Named after the remote version, so a partial file of another version is never continued
+        part = f"{target}.{_part_tag(file)}{PART_SUFFIX}"
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        for attempt in range(1, self.retries + 2):
+            try:
+                transferred, resumed = self._fetch(remote_path, part, file)
+                break
+            except Exception as e:
+                if attempt > self.retries:
+                    raise
+                metrics.incr("kg_sync.retries")
+                logger.warning(f"Downloading {remote_path} failed ({e!r}), retrying ({attempt}/{self.retries})")
+                time.sleep(min(2 ** attempt, 30))
+        os.replace(part, target)
+        with self._lock:
+            staged[file.path] = _entry(file)
+            _write_manifest(os.path.join(staging_dir, STAGED_FILE), staged)
+        return transferred, resumed
+
+    def _fetch(self, remote_path: str, part: str, file: RemoteFile) -> tuple:
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if offset > file.size:
+            offset = 0
+        verify_md5 = _md5_etag(file.version)
+        digest = hashlib.md5() if verify_md5 else None
+        if digest is not None and offset:
+            with open(part, "rb") as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                    digest.update(chunk)
+        transferred = 0
+        with self.fs.open(remote_path, "rb") as src, open(part, "ab" if offset else "wb") as dst:
+            if offset:
+                src.seek(offset)
+            for chunk in iter(lambda: src.read(self.chunk_size), b""):
+                dst.write(chunk)
+                transferred += len(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+        metrics.incr("kg_sync.bytes", transferred)
+        size = os.path.getsize(part)
+        if size != file.size or (digest is not None and digest.hexdigest() != file.version):
+            os.remove(part)
+            raise IOError(f"{remote_path} does not match its listing (size {size}, expected {file.size}, ETag {file.version})")
+        return transferred, offset > 0
+
+    def _finish(self, name: str, started_at: float, job, error: Optional[Exception]) -> KGSyncResult:
+        if error is not None:
+            metrics.incr("kg_sync.failed")
+            return KGSyncResult(name, "failed", error=repr(error), seconds=round(time.perf_counter() - started_at, 3))
+        if isinstance(job, KGSyncResult):
+            metrics.incr("kg_sync.up_to_date")
+            logger.info(f"KG {name!r} is up to date")
+            return job
+        remote_dir, local_dir, staging_dir, remote, changed, staged, futures, deleted = job
+        transferred, resumed, errors = 0, 0, []
+        for future in futures:
+            try:
+                nbytes, was_resumed = future.result()
+                transferred += nbytes
+                resumed += was_resumed
+            except Exception as e:
+                errors.append(e)
+        seconds = round(time.perf_counter() - started_at, 3)
+        if errors:
+            metrics.incr("kg_sync.failed")
+            logger.error(f"Syncing KG {name!r} from {remote_dir} failed, {len(errors)} files not downloaded, keeping {local_dir}: {errors[0]!r}")
+            return KGSyncResult(name, "failed", downloaded=len(changed) - len(errors), bytes=transferred,
+                                seconds=seconds, error=repr(errors[0]))
+
+        _write_manifest(os.path.join(staging_dir, SYNC_MANIFEST_FILE), {path: _entry(file) for path, file in remote.items()},
+                        source=remote_dir)
+        if os.path.exists(os.path.join(staging_dir, STAGED_FILE)):
+            os.remove(os.path.join(staging_dir, STAGED_FILE))
+        if os.path.exists(local_dir):
+            old_dir = local_dir.rstrip("/") + ".old"
+            shutil.rmtree(old_dir, ignore_errors=True)
+            os.rename(local_dir, old_dir)
+            os.rename(staging_dir, local_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        else:
+            os.rename(staging_dir, local_dir)
+        metrics.incr("kg_sync.synced")
+        result = KGSyncResult(name, "synced", downloaded=len(changed), reused=len(remote) - len(changed),
+                              resumed=resumed, deleted=deleted, bytes=transferred, seconds=seconds)
+        logger.info(f"Synced KG {name!r} from {remote_dir} to {local_dir}: {result}")
+        return result
@@ -0,0 +1,56 @@
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Thread-safe, process-local counters and latency summaries.
+
+    Every uvicorn worker keeps its own instance; the values are exposed as JSON
+    through the `/metrics` endpoint.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._timings = {}
+
+    def incr(self, name: str, value: int = 1):
+        """Increase the counter `name` by `value`."""
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name: str, seconds: float):
+        """Record one duration sample for `name`."""
+        with self._lock:
+            timing = self._timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            timing["count"] += 1
+            timing["total"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Context manager that observes the duration of its block under `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        """Return a JSON-serializable copy of all counters and timings."""
+        with self._lock:
+            timings = {
+                name: {
+                    "count": timing["count"],
+                    "avg_ms": round(timing["total"] / timing["count"] * 1000, 3),
+                    "max_ms": round(timing["max"] * 1000, 3),
+                }
+                for name, timing in self._timings.items()
+            }
+            return {"counters": dict(self._counters), "timings": timings}
+
+
+metrics = Metrics()
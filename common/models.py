@@ -11,7 +11,9 @@ class CodeRequest(BaseModel):
 class CodeResponse(BaseModel):
     generated_code: str
     kg_edges: list
-    subgraph_plot: str
+    subgraph_plot: str = ""
+    # Rendered by /v1/subgraph/{subgraph_id}; None if no KG edges were retrieved
+    subgraph_id: Optional[str] = None
 
 class KGCreationRequest(BaseModel):
     urls: List[str]
@@ -0,0 +1,455 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import posixpath
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import httpx
+
+from common.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+GITHUB_API_URL = "https://api.github.com"
+DEFAULT_BRANCHES = ("main", "master")
+# Files of the repositories that go into the KG, as kg_gh_creation.py has always filtered them
+DEFAULT_EXTENSIONS = (".rs", ".ms", ".toml")
+DEFAULT_CONCURRENCY = 8
+DEFAULT_REPO_PARALLELISM = 4
+DEFAULT_RETRIES = 5
+# Requests left unused in each rate limit window, for anything else sharing the token
+DEFAULT_RESERVE = 50
+MANIFEST_FORMAT_VERSION = 1
+
+
+class RepoFile(NamedTuple):
+    path: str
+    sha: str
+    size: int
+
+
+class RepoIngestResult(NamedTuple):
+    name: str
+    status: str
+    branch: Optional[str] = None
+    commit: Optional[str] = None
+    files: int = 0
+    fetched: int = 0
+    cached: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+
+def git_blob_sha(data: bytes) -> str:
+    """SHA-1 git gives a blob of `data`, the key it is stored under in both GitHub and the BlobStore."""
+    digest = hashlib.sha1(b"blob %d\0" % len(data))
+    digest.update(data)
+    return digest.hexdigest()
+
+
+class BlobStore:
+    """
+    File contents on local disk, content-addressed by their git blob SHA, under `root/ab/cdef...`.
+
+    A blob is written to a temporary file and renamed into place, so concurrent writers and
+    interrupted runs never leave a partial blob; its SHA is checked before it is stored.
+    Repository manifests, the files of the last ingested commit of each repository, are kept
+    in `root/repos`.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(os.path.join(root, "repos"), exist_ok=True)
+
+    def path(self, sha: str) -> str:
+        return os.path.join(self.root, sha[:2], sha[2:])
+
+    def __contains__(self, sha: str) -> bool:
+        return os.path.exists(self.path(sha))
+
+    def get(self, sha: str) -> bytes:
+        with open(self.path(sha), "rb") as f:
+            return f.read()
+
+    def put(self, data: bytes, sha: Optional[str] = None) -> str:
+        """Store `data` and return its SHA. Raises ValueError if it is not the expected `sha`."""
+        actual = git_blob_sha(data)
+        if sha is not None and actual != sha:
+            raise ValueError(f"Blob content does not match its SHA {sha} (got {actual})")
+        path = self.path(actual)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return actual
+
+    def _manifest_path(self, name: str) -> str:
+        return os.path.join(self.root, "repos", name.replace("/", "__") + ".json")
+
+    def read_manifest(self, name: str) -> dict:
+        """Manifest of the repository `name`, empty if it was never ingested."""
+        try:
+            with open(self._manifest_path(name)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return manifest if manifest.get("format_version") == MANIFEST_FORMAT_VERSION else {}
+
+    def write_manifest(self, name: str, manifest: dict):
+        path = self._manifest_path(name)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"format_version": MANIFEST_FORMAT_VERSION, **manifest}, f, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+
+class RateLimiter:
+    """
+    GitHub API request budget shared by every thread using one token.
+
+    Tracks the primary rate limit from the `X-RateLimit-Remaining` and `X-RateLimit-Reset`
+    headers of each response: once `reserve` requests are left, requests wait for the window
+    to reset. Secondary rate limits and abuse responses block all requests for as long as
+    `Retry-After` says, or with exponential backoff. At most `concurrency` requests run at
+    once, as GitHub asks of clients.
+    """
+
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY, reserve: int = DEFAULT_RESERVE):
+        self.reserve = reserve
+        self.remaining: Optional[int] = None
+        self.reset_at = 0.0
+        self.blocked_until = 0.0
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until a request may be sent and count it against the budget."""
+        while True:
+            with self._lock:
+                now = time.time()
+                until = self.blocked_until
+                if self.remaining is not None and self.remaining <= self.reserve and self.reset_at > now:
+                    until = max(until, self.reset_at)
+                if until <= now:
+                    if self.remaining is not None:
+                        self.remaining -= 1
+                    return
+            metrics.incr("github.rate_limit_waits")
+            logger.info(f"GitHub rate limit reached, waiting {until - now:.0f}s")
+            time.sleep(min(until - now, 60))
+
+    def update(self, headers):
+        """Take the budget left from a response's headers."""
+        remaining, reset = headers.get("x-ratelimit-remaining"), headers.get("x-ratelimit-reset")
+        if remaining is None or reset is None:
+            return
+        remaining, reset_at = int(remaining), float(reset)
+        with self._lock:
+            if reset_at > self.reset_at:
+                self.remaining, self.reset_at = remaining, reset_at
+            elif reset_at == self.reset_at:
+                # Responses arrive out of order: the lowest count is the latest
+                self.remaining = min(self.remaining, remaining)
+
+    def block(self, seconds: float):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+
+
+class GitHubAPI:
+    """
+    Minimal GitHub REST client for ingestion: one connection pool and RateLimiter per token.
+    Blob downloads of every repository run on its executor of `concurrency` threads.
+    """
+
+    def __init__(self, token: Optional[str] = None, concurrency: int = DEFAULT_CONCURRENCY,
+                 retries: int = DEFAULT_RETRIES, reserve: int = DEFAULT_RESERVE, base_url: str = GITHUB_API_URL):
+        headers = {"Accept": "application/vnd.github+json", "X-GitHub-Api-Version": "2022-11-28"}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        self.client = httpx.Client(base_url=base_url, headers=headers, timeout=60, follow_redirects=True,
+                                   limits=httpx.Limits(max_connections=concurrency))
+        self.limiter = RateLimiter(concurrency, reserve)
+        self.retries = retries
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="github")
+
+    def get(self, path: str, headers: Optional[dict] = None, params: Optional[dict] = None) -> httpx.Response:
+        """GET `path`, waiting out rate limits and retrying server errors. Other errors are returned."""
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            try:
+                with self.limiter.slots:
+                    response = self.client.get(path, headers=headers, params=params)
+            except httpx.TransportError as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"GitHub request {path} failed ({e!r}), retrying ({attempt + 1}/{self.retries})")
+                time.sleep(min(2 ** attempt, 30))
+                continue
+            metrics.incr("github.requests")
+            self.limiter.update(response.headers)
+            if response.status_code in (403, 429) and self._rate_limited(response):
+                metrics.incr("github.rate_limited")
+                self.limiter.block(self._retry_after(response, attempt))
+                continue
+            if response.status_code >= 500 and attempt < self.retries:
+                time.sleep(min(2 ** attempt, 30))
+                continue
+            return response
+        raise IOError(f"GitHub request {path} still rate limited after {self.retries} retries")
+
+    @staticmethod
+    def _rate_limited(response: httpx.Response) -> bool:
+        return (response.status_code == 429 or "retry-after" in response.headers
+                or response.headers.get("x-ratelimit-remaining") == "0"
+                or "rate limit" in response.text.lower())
+
+    @staticmethod
+    def _retry_after(response: httpx.Response, attempt: int) -> float:
+        if "retry-after" in response.headers:
+            return float(response.headers["retry-after"])
+        if response.headers.get("x-ratelimit-remaining") == "0":
+            return max(1.0, float(response.headers.get("x-ratelimit-reset", 0)) - time.time() + 1)
+        # Secondary rate limit without a hint: GitHub asks for at least a minute
+        return 60.0 * 2 ** attempt
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.client.close()
+
+
+def _branch_order(branches: Sequence[str], previous: dict) -> List[str]:
+    """`branches`, starting with the one ingested last time."""
+    if previous.get("branch") in branches:
+        return [previous["branch"], *(branch for branch in branches if branch != previous["branch"])]
+    return list(branches)
+
+
+class GitHubSource:
+    """
+    A GitHub repository, read with the git data API: one request resolves the branch (none
+    if it did not move, with a conditional request), one lists the tree of its commit, and
+    each blob not in the store yet is downloaded raw.
+    """
+
+    def __init__(self, api: GitHubAPI, owner: str, repo: str, branches: Sequence[str] = DEFAULT_BRANCHES):
+        self.api = api
+        self.owner = owner
+        self.repo = repo
+        self.branches = list(branches)
+
+    @property
+    def url(self) -> str:
+        return f"https://github.com/{self.owner}/{self.repo}"
+
+    def resolve(self, previous: dict) -> Tuple[str, str, Optional[str]]:
+        """The first of the branches that exists, its commit SHA and the ETag of the lookup."""
+        for branch in _branch_order(self.branches, previous):
+            headers = {"Accept": "application/vnd.github.sha"}
+            if previous.get("branch") == branch and previous.get("etag"):
+                headers["If-None-Match"] = previous["etag"]
+            response = self.api.get(f"/repos/{self.owner}/{self.repo}/commits/{branch}", headers=headers)
+            if response.status_code == 304:
+                # Not counted against the rate limit
+                metrics.incr("github.not_modified")
+                return branch, previous["commit"], previous["etag"]
+            if response.status_code in (404, 422):
+                continue
+            response.raise_for_status()
+            return branch, response.text.strip(), response.headers.get("etag")
+        raise FileNotFoundError(f"None of the branches {self.branches} exists in {self.owner}/{self.repo}")
+
+    def list_files(self, commit: str) -> List[RepoFile]:
+        """Every file of the commit, listing subtrees one by one if the recursive listing is truncated."""
+        tree = self._tree(commit, recursive=True)
+        if not tree.get("truncated"):
+            return [RepoFile(entry["path"], entry["sha"], entry.get("size", 0)) for entry in tree["tree"] if entry["type"] == "blob"]
+        logger.info(f"Tree of {self.owner}/{self.repo} is too large to list at once, walking it")
+        files, pending = [], [("", commit)]
+        while pending:
+            prefix, sha = pending.pop()
+            for entry in self._tree(sha, recursive=False)["tree"]:
+                path = posixpath.join(prefix, entry["path"])
+                if entry["type"] == "tree":
+                    pending.append((path, entry["sha"]))
+                elif entry["type"] == "blob":
+                    files.append(RepoFile(path, entry["sha"], entry.get("size", 0)))
+        return files
+
+    def _tree(self, sha: str, recursive: bool) -> dict:
+        response = self.api.get(f"/repos/{self.owner}/{self.repo}/git/trees/{sha}", params={"recursive": "1"} if recursive else None)
+        response.raise_for_status()
+        return response.json()
+
+    def _blob(self, sha: str) -> bytes:
+        response = self.api.get(f"/repos/{self.owner}/{self.repo}/git/blobs/{sha}", headers={"Accept": "application/vnd.github.raw"})
+        response.raise_for_status()
+        return response.content
+
+    def fetch(self, shas: Iterable[str]) -> Iterator[Tuple[str, bytes]]:
+        """Contents of the blobs `shas`, downloaded concurrently on the API's executor, as they arrive."""
+        futures = {self.api.executor.submit(self._blob, sha): sha for sha in shas}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+class LocalGitSource:
+    """
+    A local git checkout or bare repository, read with the git CLI, so ingestion runs offline.
+    The branches are looked up locally, then as `origin/<branch>`, then HEAD is used.
+    """
+
+    def __init__(self, path: str, branches: Sequence[str] = DEFAULT_BRANCHES):
+        self.path = path
+        self.branches = list(branches)
+
+    @property
+    def url(self) -> str:
+        return f"file://{os.path.abspath(self.path)}"
+
+    def _git(self, *args, input: Optional[bytes] = None, check: bool = True) -> subprocess.CompletedProcess:
+        return subprocess.run(["git", "-C", self.path, *args], input=input, capture_output=True, check=check)
+
+    def resolve(self, previous: dict) -> Tuple[str, str, Optional[str]]:
+        branches = _branch_order(self.branches, previous)
+        for ref in [*branches, *(f"origin/{branch}" for branch in branches), "HEAD"]:
+            result = self._git("rev-parse", "--verify", "--quiet", f"{ref}^{{commit}}", check=False)
+            if result.returncode == 0:
+                return ref.split("/", 1)[-1], result.stdout.decode().strip(), None
+        raise FileNotFoundError(f"{self.path} has none of the branches {self.branches}")
+
+    def list_files(self, commit: str) -> List[RepoFile]:
+        files = []
+        for line in self._git("ls-tree", "-r", "-z", "--long", commit).stdout.split(b"\0"):
+            if not line:
+                continue
+            info, path = line.split(b"\t", 1)
+            _, kind, sha, size = info.split()
+            if kind == b"blob":
+                files.append(RepoFile(path.decode("utf-8", "surrogateescape"), sha.decode(), int(size)))
+        return files
+
+    def fetch(self, shas: Iterable[str], batch_size: int = 1000) -> Iterator[Tuple[str, bytes]]:
+        """Contents of the blobs `shas`, read by one `git cat-file --batch` per `batch_size` blobs."""
+        shas = list(shas)
+        for start in range(0, len(shas), batch_size):
+            yield from self._cat_files(shas[start:start + batch_size])
+
+    def _cat_files(self, shas: List[str]) -> Iterator[Tuple[str, bytes]]:
+        output = self._git("cat-file", "--batch", input="".join(f"{sha}\n" for sha in shas).encode()).stdout
+        offset = 0
+        for sha in shas:
+            header_end = output.index(b"\n", offset)
+            header = output[offset:header_end].split()
+            if header[-1] == b"missing":
+                raise FileNotFoundError(f"Blob {sha} is missing from {self.path}")
+            size = int(header[2])
+            yield sha, output[header_end + 1: header_end + 1 + size]
+            offset = header_end + 1 + size + 1
+
+
+def repo_source(location: str, api: Optional[GitHubAPI] = None, branches: Sequence[str] = DEFAULT_BRANCHES):
+    """
+    The source of a `source.txt` line and its name: a GitHub URL, read through `api`, or a
+    local path or file:// URL of a git repository, named after its directory.
+    """
+    location = location.strip()
+    if location.startswith("https://github.com/"):
+        owner, repo = location[len("https://github.com/"):].split("/")[:2]
+        repo = repo.removesuffix(".git")
+        if api is None:
+            raise ValueError(f"{location} needs a GitHub API client")
+        return f"{owner}/{repo}", GitHubSource(api, owner, repo, branches)
+    path = location.removeprefix("file://")
+    if not os.path.isdir(path):
+        raise ValueError(f"{location} is neither a GitHub URL nor a local repository")
+    return os.path.basename(os.path.abspath(path)).removesuffix(".git"), LocalGitSource(path, branches)
+
+
+class RepoIngester:
+    """
+    Fetches the files of many repositories into a BlobStore, `parallelism` repositories at once.
+
+    For each repository the branch is resolved to a commit; if it is the commit ingested last
+    time, its file list is taken from the store's manifest, otherwise the tree of the commit
+    is listed. Only the files with one of `extensions` whose blob is not stored yet are
+    fetched, so a re-run after a small change downloads only the changed files. A repository
+    that fails is reported as failed and keeps its previous manifest; the others go on.
+    """
+
+    def __init__(self, store: BlobStore, parallelism: int = DEFAULT_REPO_PARALLELISM,
+                 extensions: Sequence[str] = DEFAULT_EXTENSIONS):
+        self.store = store
+        self.parallelism = parallelism
+        self.extensions = tuple(extensions)
+
+    def ingest(self, sources: Dict[str, object]) -> List[RepoIngestResult]:
+        """Ingest every `{name: source}` and return their results in the same order."""
+        with ThreadPoolExecutor(max_workers=self.parallelism, thread_name_prefix="repo-ingest") as executor:
+            futures = [executor.submit(self.ingest_one, name, source) for name, source in sources.items()]
+            return [future.result() for future in futures]
+
+    def ingest_one(self, name: str, source) -> RepoIngestResult:
+        started_at = time.perf_counter()
+        try:
+            result = self._ingest(name, source)
+        except Exception as e:
+            metrics.incr("repo_ingest.failed")
+            logger.error(f"Ingesting repository {name!r} failed: {e!r}")
+            return RepoIngestResult(name, "failed", error=repr(e), seconds=round(time.perf_counter() - started_at, 3))
+        result = result._replace(seconds=round(time.perf_counter() - started_at, 3))
+        logger.info(f"Ingested repository {name!r}: {result}")
+        return result
+
+    def _ingest(self, name: str, source) -> RepoIngestResult:
+        previous = self.store.read_manifest(name)
+        branch, commit, etag = source.resolve(previous)
+        if previous.get("commit") == commit and previous.get("extensions") == list(self.extensions):
+            files = [RepoFile(path, sha, size) for path, (sha, size) in previous["files"].items()]
+        else:
+            files = [file for file in source.list_files(commit) if file.path.endswith(self.extensions)]
+        missing = sorted({file.sha for file in files if file.sha not in self.store})
+        transferred = 0
+        for sha, data in source.fetch(missing):
+            self.store.put(data, sha)
+            transferred += len(data)
+        metrics.incr("repo_ingest.blobs_fetched", len(missing))
+        metrics.incr("repo_ingest.blobs_cached", len(files) - len(missing))
+        metrics.incr("repo_ingest.bytes", transferred)
+        self.store.write_manifest(name, {
+            "name": name, "source": source.url, "branch": branch, "commit": commit, "etag": etag,
+            "extensions": list(self.extensions), "files": {file.path: [file.sha, file.size] for file in files},
+        })
+        status = "up_to_date" if previous.get("commit") == commit and not missing else "ingested"
+        return RepoIngestResult(name, status, branch=branch, commit=commit, files=len(files), fetched=len(missing),
+                                cached=len(files) - len(missing), bytes=transferred)
+
+
+def load_documents(store: BlobStore, name: str) -> list:
+    """
+    The files of the last ingested commit of repository `name` as llama_index Documents, with
+    the ID and metadata GithubRepositoryReader gives them. Binary files are skipped.
+    """
+    from llama_index.core import Document
+
+    manifest = store.read_manifest(name)
+    documents = []
+    for path, (sha, _) in sorted(manifest.get("files", {}).items()):
+        try:
+            text = store.get(sha).decode("utf-8")
+        except UnicodeDecodeError:
+            logger.info(f"Skipping binary file {path} of {name}")
+            continue
+        documents.append(Document(text=text, doc_id=sha, metadata={"file_path": path, "file_name": posixpath.basename(path)}))
+    return documents
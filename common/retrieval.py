@@ -0,0 +1,551 @@
+import ast
+import time
+import asyncio
+import logging
+import functools
+import threading
+import numpy as np
+from collections import defaultdict
+from concurrent.futures import Executor, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from llama_index.core.indices.knowledge_graph.retrievers import (
+    DEFAULT_NODE_SCORE,
+    GLOBAL_EXPLORE_NODE_LIMIT,
+    KGRetrieverMode,
+    KGTableRetriever,
+)
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle, TextNode
+from llama_index.core.utils import truncate_text
+
+from common.kg_snapshot import SnapshotEmbeddingDict
+from common.keyword_extraction import RustKeywordExtractor
+from common.metrics import metrics
+from caching.query_cache import EmbeddingCache, RetrievalCache, normalize_query
+
+logger = logging.getLogger(__name__)
+
+FUSION_STRATEGIES = ("concat", "rrf")
+# Rank offset of reciprocal rank fusion, which damps the weight of the first few ranks
+RRF_K = 60
+# Shared by the retrievers of a worker; a hybrid query runs both legs on it
+LEG_CONCURRENCY = 16
+LEG_EXECUTOR = ThreadPoolExecutor(max_workers=LEG_CONCURRENCY, thread_name_prefix="retrieval-leg")
+# Free threads of LEG_EXECUTOR. A leg that timed out keeps its thread until it returns, so
+# legs are only submitted when a thread is free instead of queueing behind stranded ones.
+LEG_SLOTS = threading.BoundedSemaphore(LEG_CONCURRENCY)
+# Text of the node a retriever returns when it found neither triplets nor text chunks
+NO_RELATIONSHIPS_TEXT = "No relationships found."
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _triplet_key(rel_text: str):
+    """The same key for a triplet from the keyword leg, "['a', 'b', 'c']", and the embedding leg, "('a', 'b', 'c')"."""
+    try:
+        triplet = ast.literal_eval(rel_text)
+    except (ValueError, SyntaxError):
+        return rel_text
+    return tuple(triplet) if isinstance(triplet, (list, tuple)) else rel_text
+
+
+def reciprocal_rank_fusion(ranked_lists: Sequence[Sequence[str]], weights: Sequence[float], k: int = RRF_K) -> List[str]:
+    """
+    Merge ranked triplet lists by the sum of `weight / (k + rank)` over the lists a triplet is
+    in, best first. A triplet keeps the text of its first occurrence; ties keep list order.
+    """
+    scores, texts = {}, {}
+    for ranked, weight in zip(ranked_lists, weights):
+        seen = set()
+        for rank, rel_text in enumerate(ranked, start=1):
+            key = _triplet_key(rel_text)
+            if key in seen:
+                continue
+            seen.add(key)
+            texts.setdefault(key, rel_text)
+            scores[key] = scores.get(key, 0.0) + weight / (k + rank)
+    return [texts[key] for key in sorted(scores, key=lambda key: -scores[key])]
+
+
+class EmbeddingMatrix:
+    """
+    All triplet embeddings of a KG as one L2-normalized float32 matrix.
+
+    Cosine similarity against every triplet is a single matrix-vector product,
+    and the top k are selected with `argpartition` in O(n) before sorting only
+    those k. `top_k_batch` scores several queries with one matrix product.
+    """
+
+    def __init__(self, matrix: np.ndarray, ids: Sequence[str]):
+        self.matrix = matrix
+        self.ids = ids
+
+    @classmethod
+    def from_embedding_dict(cls, embedding_dict) -> "EmbeddingMatrix":
+        """
+        Build the matrix of a KG index's `embedding_dict`. A snapshot-backed dict already
+        holds a normalized, memory-mapped matrix, which is used without copying.
+        """
+        if isinstance(embedding_dict, SnapshotEmbeddingDict):
+            return cls(embedding_dict.matrix, embedding_dict.triplets)
+        ids = list(embedding_dict.keys())
+        if not ids:
+            return cls(np.zeros((0, 0), dtype=np.float32), ids)
+        matrix = np.asarray([embedding_dict[i] for i in ids], dtype=np.float32)
+        return cls(_normalize(matrix), ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _select(self, similarities: np.ndarray, k: int) -> Tuple[List[float], List[str]]:
+        if k < len(similarities):
+            top = np.argpartition(similarities, -k)[-k:]
+        else:
+            top = np.arange(len(similarities))
+        top = top[np.argsort(similarities[top])[::-1]]
+        return similarities[top].tolist(), [self.ids[int(i)] for i in top]
+
+    def top_k(self, query_embedding: Sequence[float], k: int) -> Tuple[List[float], List[str]]:
+        """Return the cosine similarities and IDs of the `k` most similar triplets, best first."""
+        if not len(self) or k <= 0:
+            return [], []
+        query = _normalize(np.asarray(query_embedding, dtype=np.float32))
+        return self._select(self.matrix @ query, k)
+
+    def top_k_batch(self, query_embeddings: Sequence[Sequence[float]], k: int) -> List[Tuple[List[float], List[str]]]:
+        """`top_k` for several queries at once."""
+        if not len(self) or k <= 0:
+            return [([], []) for _ in query_embeddings]
+        queries = _normalize(np.asarray(query_embeddings, dtype=np.float32))
+        similarities = queries @ self.matrix.T
+        return [self._select(row, k) for row in similarities]
+
+
+class KGRetriever(KGTableRetriever):
+    """
+    KGTableRetriever whose embedding search runs on an EmbeddingMatrix, or on an
+    ANNIndex (common/ann_index.py), which has the same `top_k` interface.
+
+    The upstream retriever rebuilds a list of every triplet embedding on each
+    query and scores them one at a time in Python. This retriever returns the same
+    nodes, but its embedding leg is one matrix-vector product. The keyword and
+    embedding legs are separate methods, and `retrieve_batch` embeds and scores
+    several queries together. In "embedding" mode the keyword extraction, which is
+    an LLM call, is skipped because its result would not be used. With a
+    `keyword_extractor` (common/keyword_extraction.py), keywords are extracted
+    locally and the LLM is not called at all.
+
+    With an `embedding_cache`, the embedding of the query is cached under its
+    normalized form (`normalize_query`) and reused by queries that normalize the
+    same way. With a
+    `retrieval_cache`, the outputs of both legs are cached under the normalized
+    query, the retriever's settings and, with a local keyword extractor, the
+    keywords, so a repeated query skips embedding, graph and keyword lookups and
+    only rebuilds the nodes. The cache's namespace must name the KG version.
+
+    In hybrid mode both legs run at the same time: on `leg_executor` threads for
+    `retrieve`, as asyncio tasks for `aretrieve`. A leg still running when its
+    `leg_timeouts` entry (seconds) runs out, or failing, is dropped and the query
+    is answered from the other leg; such degraded results are not cached. A leg
+    is only submitted when one of `leg_slots`, the executor's free threads, is
+    available; otherwise it runs on the calling thread (a worker thread for
+    `aretrieve`) without a timeout. A single leg, with nothing to fall back on,
+    has no timeout either. `fusion` merges
+    the legs' triplets: "concat" as KGTableRetriever does, or "rrf", weighted
+    reciprocal rank fusion that keeps the fused order through truncation to
+    `max_knowledge_sequence`. Each leg's latency is observed as
+    `retrieval.<leg>_leg`, the time it waited for its thread as
+    `retrieval.<leg>_leg.queue_wait`, and `retrieval.slowest.<leg>` counts
+    which leg finished last.
+    """
+
+    def __init__(self, index, embedding_matrix: Optional[EmbeddingMatrix] = None,
+                 keyword_extractor: Optional[RustKeywordExtractor] = None,
+                 embedding_cache: Optional[EmbeddingCache] = None,
+                 retrieval_cache: Optional[RetrievalCache] = None,
+                 fusion: str = "concat", fusion_weights: Optional[Dict[str, float]] = None,
+                 leg_timeouts: Optional[Dict[str, float]] = None, leg_executor: Optional[Executor] = None,
+                 leg_slots: Optional[threading.Semaphore] = None, **kwargs):
+        super().__init__(index, **kwargs)
+        if fusion not in FUSION_STRATEGIES:
+            raise ValueError(f"Unknown fusion strategy {fusion!r}, expected one of {FUSION_STRATEGIES}")
+        self._embedding_matrix = embedding_matrix or EmbeddingMatrix.from_embedding_dict(self._index_struct.embedding_dict)
+        self._keyword_extractor = keyword_extractor
+        self._embedding_cache = embedding_cache
+        self._retrieval_cache = retrieval_cache
+        self.fusion = fusion
+        self.fusion_weights = fusion_weights or {}
+        self.leg_timeouts = leg_timeouts or {}
+        self._leg_executor = leg_executor or LEG_EXECUTOR
+        self._leg_slots = leg_slots or (LEG_SLOTS if leg_executor is None else threading.BoundedSemaphore(
+            getattr(leg_executor, "_max_workers", LEG_CONCURRENCY)))
+
+    def _get_keywords(self, query_str: str) -> List[str]:
+        if self._keyword_extractor is not None:
+            return self._keyword_extractor.extract(query_str, self.max_keywords_per_query)
+        with metrics.timer("retrieval.keywords.llm"):
+            return super()._get_keywords(query_str)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self.retrieve_batch([query_bundle.query_str])[0]
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return (await self.aretrieve_batch([query_bundle.query_str]))[0]
+
+    def retrieve_batch(self, query_strs: List[str]) -> List[List[NodeWithScore]]:
+        """Retrieve nodes for several queries, embedding and scoring them in one batch."""
+        keywords, cache_keys, legs = self._cached_legs(query_strs)
+        misses = [i for i, leg in enumerate(legs) if leg is None]
+        if misses:
+            self._store_legs(legs, misses, cache_keys, *self._run_legs([query_strs[i] for i in misses], [keywords[i] for i in misses]))
+        return [self._build_nodes(list(leg["rel_texts"]), leg["rel_map"], defaultdict(int, leg["chunks"])) for leg in legs]
+
+    async def aretrieve_batch(self, query_strs: List[str]) -> List[List[NodeWithScore]]:
+        """`retrieve_batch` running the retrieval legs as asyncio tasks."""
+        keywords, cache_keys, legs = self._cached_legs(query_strs)
+        misses = [i for i, leg in enumerate(legs) if leg is None]
+        if misses:
+            self._store_legs(legs, misses, cache_keys, *await self._arun_legs([query_strs[i] for i in misses], [keywords[i] for i in misses]))
+        return [self._build_nodes(list(leg["rel_texts"]), leg["rel_map"], defaultdict(int, leg["chunks"])) for leg in legs]
+
+    def _cached_legs(self, query_strs: List[str]) -> tuple:
+        """Local keywords, retrieval cache keys and cached leg outputs (None for misses) of `query_strs`."""
+        keywords = [None] * len(query_strs)
+        if self._keyword_extractor is not None and self._retriever_mode != KGRetrieverMode.EMBEDDING:
+            keywords = [self._get_keywords(query_str) for query_str in query_strs]
+        cache_keys, legs = [], [None] * len(query_strs)
+        if self._retrieval_cache is not None:
+            cache_keys = [self._retrieval_key(query_str, kws) for query_str, kws in zip(query_strs, keywords)]
+            legs = self._retrieval_cache.get_many(cache_keys)
+        return keywords, cache_keys, legs
+
+    def _store_legs(self, legs: list, misses: List[int], cache_keys: List[str], results: List[dict], degraded: bool):
+        for i, result in zip(misses, results):
+            legs[i] = result
+        # Results missing a leg that timed out or failed are not cached
+        if self._retrieval_cache is not None and not degraded:
+            self._retrieval_cache.set_many({cache_keys[i]: legs[i] for i in misses})
+
+    def _retrieval_key(self, query_str: str, keywords: Optional[List[str]]) -> str:
+        """What the retrieval legs depend on besides the KG, which the cache's namespace names."""
+        settings = (self._retriever_mode.value, self.similarity_top_k, self.graph_store_query_depth,
+                    self._include_text, self.max_keywords_per_query, self.num_chunks_per_query,
+                    self.fusion, sorted(self.fusion_weights.items()))
+        return f"{settings}|{sorted(keywords) if keywords is not None else None}|{normalize_query(query_str)}"
+
+    def _embed_batch(self, query_strs: List[str]) -> List[List[float]]:
+        """Embeddings of `query_strs`, cached under their normalized form if there is an embedding cache."""
+        if self._embedding_cache is None:
+            if len(query_strs) == 1:
+                return [self._embed_model.get_text_embedding(query_strs[0])]
+            return self._embed_model.get_text_embedding_batch(query_strs)
+        texts = [normalize_query(query_str) for query_str in query_strs]
+        embeddings = self._embedding_cache.get_many(texts)
+        # The full query is embedded, the first of those sharing a normalized text for all of them
+        misses = {}
+        for text, query_str, embedding in zip(texts, query_strs, embeddings):
+            if embedding is None:
+                misses.setdefault(text, query_str)
+        if misses:
+            computed = dict(zip(misses, self._embed_model.get_text_embedding_batch(list(misses.values()))))
+            self._embedding_cache.set_many(computed)
+            embeddings = [embedding if embedding is not None else computed[text] for text, embedding in zip(texts, embeddings)]
+        return embeddings
+
+    def _uses_embeddings(self) -> bool:
+        return self._retriever_mode != KGRetrieverMode.KEYWORD and len(self._embedding_matrix) > 0
+
+    def _legs(self, query_strs: List[str], keywords: List[Optional[List[str]]]) -> Dict[str, Callable[[], list]]:
+        """The retrieval legs to run for `query_strs`, by name."""
+        legs = {}
+        if self._retriever_mode != KGRetrieverMode.EMBEDDING:
+            legs["keyword"] = lambda: [self._keyword_leg(query_str, kws) for query_str, kws in zip(query_strs, keywords)]
+        if self._uses_embeddings():
+            legs["embedding"] = lambda: self._embedding_leg(query_strs)
+        elif len(self._embedding_matrix) == 0:
+            logger.warning("Index was not constructed with embeddings, skipping embedding usage...")
+        return {name: functools.partial(self._timed_leg, name, leg) for name, leg in legs.items()}
+
+    def _timed_leg(self, name: str, leg: Callable[[], list]) -> Tuple[list, float]:
+        started_at = time.perf_counter()
+        result = leg()
+        elapsed = time.perf_counter() - started_at
+        metrics.observe(f"retrieval.{name}_leg", elapsed)
+        return result, elapsed
+
+    def _submit_leg(self, name: str, leg: Callable[[], Tuple[list, float]]):
+        """Submit `leg` to the leg executor if one of its threads is free, else return None."""
+        if not self._leg_slots.acquire(blocking=False):
+            return None
+        submitted_at = time.perf_counter()
+
+        def run():
+            try:
+                metrics.observe(f"retrieval.{name}_leg.queue_wait", time.perf_counter() - submitted_at)
+                return leg()
+            finally:
+                self._leg_slots.release()
+
+        return self._leg_executor.submit(run)
+
+    def _leg_failed(self, name: str, exc: BaseException):
+        if isinstance(exc, (FuturesTimeoutError, asyncio.TimeoutError)):
+            metrics.incr(f"retrieval.{name}_leg.timeouts")
+            logger.warning(f"Retrieval {name} leg timed out after {self.leg_timeouts[name]}s, using the other leg only")
+        else:
+            metrics.incr(f"retrieval.{name}_leg.errors")
+            logger.warning(f"Retrieval {name} leg failed ({exc!r}), using the other leg only")
+
+    def _run_legs(self, query_strs: List[str], keywords: List[Optional[List[str]]]) -> Tuple[List[dict], bool]:
+        """
+        Run the retrieval legs of `query_strs` and fuse their results. Both legs of hybrid
+        mode run at the same time, each on the leg executor within its own timeout if it
+        gets a free thread, else on this thread.
+        """
+        legs = self._legs(query_strs, keywords)
+        if len(legs) < 2:
+            return self._fuse(len(query_strs), {name: leg() for name, leg in legs.items()})
+        with metrics.timer("retrieval.legs"):
+            futures = {name: self._submit_leg(name, leg) for name, leg in legs.items()}
+            started_at = time.monotonic()
+            results = {}
+            # The legs without a thread run here while the submitted ones run on the executor
+            for name, future in futures.items():
+                if future is None:
+                    metrics.incr(f"retrieval.{name}_leg.inline")
+                    try:
+                        results[name] = legs[name]()
+                    except Exception as e:
+                        self._leg_failed(name, e)
+                        results[name] = e
+            for name, future in futures.items():
+                if future is None:
+                    continue
+                timeout = self.leg_timeouts.get(name)
+                try:
+                    results[name] = future.result(timeout=None if timeout is None else max(0.0, started_at + timeout - time.monotonic()))
+                except Exception as e:
+                    future.cancel()
+                    self._leg_failed(name, e)
+                    results[name] = e
+        return self._fuse(len(query_strs), results)
+
+    async def _arun_legs(self, query_strs: List[str], keywords: List[Optional[List[str]]]) -> Tuple[List[dict], bool]:
+        """`_run_legs` with each leg in an asyncio task, on the leg executor or a worker thread."""
+        legs = self._legs(query_strs, keywords)
+        futures = {name: self._submit_leg(name, leg) for name, leg in legs.items()}
+
+        async def run(name, future, timeout=None):
+            if future is None:
+                metrics.incr(f"retrieval.{name}_leg.inline")
+                return await asyncio.to_thread(legs[name])
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+
+        if len(legs) < 2:
+            return self._fuse(len(query_strs), {name: await run(name, future) for name, future in futures.items()})
+
+        async def run_or_degrade(name, future):
+            try:
+                return await run(name, future, self.leg_timeouts.get(name))
+            except Exception as e:
+                self._leg_failed(name, e)
+                return e
+
+        with metrics.timer("retrieval.legs"):
+            results = await asyncio.gather(*(run_or_degrade(name, future) for name, future in futures.items()))
+        return self._fuse(len(query_strs), dict(zip(legs, results)))
+
+    def _fuse(self, n: int, results: Dict[str, object]) -> Tuple[List[dict], bool]:
+        """
+        Leg outputs of `n` queries from the `(result, seconds)` of every leg that ran, or its
+        exception. Raises if every leg failed. Returns whether a leg is missing.
+        """
+        finished = {name: result for name, result in results.items() if not isinstance(result, BaseException)}
+        if results and not finished:
+            raise next(iter(results.values()))
+        if len(finished) == 2:
+            metrics.incr(f"retrieval.slowest.{max(finished, key=lambda name: finished[name][1])}")
+        keyword_legs = finished["keyword"][0] if "keyword" in finished else [None] * n
+        embedding_hits = finished["embedding"][0] if "embedding" in finished else [[]] * n
+        fused = []
+        for keyword_leg, hits in zip(keyword_legs, embedding_hits):
+            keyword_leg = keyword_leg or {"rel_texts": [], "rel_map": {}, "chunks": {}}
+            if self.fusion == "rrf" and keyword_leg["rel_texts"] and hits:
+                rel_texts = reciprocal_rank_fusion([keyword_leg["rel_texts"], hits],
+                                                   [self.fusion_weights.get("keyword", 1.0), self.fusion_weights.get("embedding", 1.0)])
+            else:
+                rel_texts = keyword_leg["rel_texts"] + hits
+            fused.append({"rel_texts": rel_texts, "rel_map": keyword_leg["rel_map"], "chunks": keyword_leg["chunks"]})
+        return fused, len(finished) < len(results)
+
+    def _keyword_leg(self, query_str: str, keywords: Optional[List[str]] = None) -> dict:
+        """
+        Extract keywords from the query, unless given, and collect the triplets of their rel maps
+        and the text chunks they are found in, with the number of keywords found in each.
+        """
+        rel_texts = []
+        cur_rel_map = {}
+        chunk_indices_count: Dict[str, int] = defaultdict(int)
+        if keywords is None:
+            keywords = self._get_keywords(query_str)
+        logger.debug(f"Extracted keywords: {keywords}")
+        node_visited = set()
+        for keyword in keywords:
+            subjs = {keyword}
+            node_ids = self._index_struct.search_node_by_keyword(keyword)
+            for node_id in node_ids[:GLOBAL_EXPLORE_NODE_LIMIT]:
+                if node_id in node_visited:
+                    continue
+                if self._include_text:
+                    chunk_indices_count[node_id] += 1
+                node_visited.add(node_id)
+                if self.use_global_node_triplets:
+                    extended_subjs = self._get_keywords(
+                        self._docstore.get_node(node_id).get_content(metadata_mode=MetadataMode.LLM)
+                    )
+                    subjs.update(extended_subjs)
+
+            rel_map = self._graph_store.get_rel_map(list(subjs), self.graph_store_query_depth)
+            logger.debug(f"rel_map: {rel_map}")
+            if not rel_map:
+                continue
+            rel_texts.extend(str(rel_obj) for rel_objs in rel_map.values() for rel_obj in rel_objs)
+            cur_rel_map.update(rel_map)
+        return {"rel_texts": rel_texts, "rel_map": cur_rel_map, "chunks": dict(chunk_indices_count)}
+
+    def _embedding_leg(self, query_strs: List[str]) -> List[List[str]]:
+        """The triplets most similar to each query, embedding and scoring all queries at once."""
+        query_embeddings = self._embed_batch(query_strs)
+        results = self._embedding_matrix.top_k_batch(query_embeddings, self.similarity_top_k)
+        logger.debug(f"Found the following rel_texts+query similarites: {[similarities for similarities, _ in results]!s}")
+        return [top_rel_texts for _, top_rel_texts in results]
+
+    def _build_nodes(self, rel_texts: List[str], cur_rel_map: dict, chunk_indices_count: Dict[str, int]) -> List[NodeWithScore]:
+        """Merge the legs into text chunk nodes plus one node holding the KG context, as KGTableRetriever does."""
+        # remove any duplicates from keyword + embedding queries
+        if self._retriever_mode == KGRetrieverMode.HYBRID and self.fusion == "rrf":
+            # Same removals, keeping the fused order so truncation keeps the best ranked
+            rel_texts = list(dict.fromkeys(rel_texts))
+            rel_texts = [rel_text for rel_text in rel_texts if not any(rel_text != other and rel_text in other for other in rel_texts)]
+            rel_texts = rel_texts[: self.max_knowledge_sequence]
+        elif self._retriever_mode == KGRetrieverMode.HYBRID:
+            rel_texts = list(set(rel_texts))
+
+            # remove shorter rel_texts that are substrings of longer rel_texts
+            rel_texts.sort(key=len, reverse=True)
+            for i in range(len(rel_texts)):
+                for j in range(i + 1, len(rel_texts)):
+                    if rel_texts[j] in rel_texts[i]:
+                        rel_texts[j] = ""
+            rel_texts = [rel_text for rel_text in rel_texts if rel_text != ""]
+
+            rel_texts = rel_texts[: self.max_knowledge_sequence]
+
+        # The text chunks of every entity mentioned in the retrieved triplets
+        if self._include_text:
+            for keyword in self._extract_rel_text_keywords(rel_texts):
+                for node_id in self._index_struct.search_node_by_keyword(keyword):
+                    chunk_indices_count[node_id] += 1
+
+        sorted_chunk_indices = sorted(chunk_indices_count.keys(), key=lambda x: chunk_indices_count[x], reverse=True)
+        sorted_chunk_indices = sorted_chunk_indices[: self.num_chunks_per_query]
+        sorted_nodes = self._docstore.get_nodes(sorted_chunk_indices)
+
+        sorted_nodes_with_scores = []
+        for chunk_idx, node in zip(sorted_chunk_indices, sorted_nodes):
+            # nodes are found with keyword mapping, give high conf to avoid cutoff
+            sorted_nodes_with_scores.append(NodeWithScore(node=node, score=DEFAULT_NODE_SCORE))
+            logger.info(f"> Querying with idx: {chunk_idx}: {truncate_text(node.get_content(), 80)}")
+
+        # if no relationship is found, return the nodes found by keywords
+        if not rel_texts:
+            logger.info("> No relationships found, returning nodes found by keywords.")
+            if len(sorted_nodes_with_scores) == 0:
+                logger.info("> No nodes found by keywords, returning empty response.")
+                return [NodeWithScore(node=TextNode(text=NO_RELATIONSHIPS_TEXT), score=1.0)]
+            return sorted_nodes_with_scores
+
+        sorted_nodes_with_scores.append(
+            knowledge_sequence_node(rel_texts, cur_rel_map, self.graph_store_query_depth, self._graph_schema))
+        return sorted_nodes_with_scores
+
+
+def knowledge_sequence_node(rel_texts: List[str], rel_map: dict, graph_store_query_depth: int, graph_schema: str = "") -> NodeWithScore:
+    """The node holding the KG context of a query, as KGTableRetriever builds it from `rel_texts`."""
+    rel_initial_text = (
+        f"The following are knowledge sequence in max depth"
+        f" {graph_store_query_depth} "
+        f"in the form of directed graph like:\n"
+        f"`subject -[predicate]->, object, <-[predicate_next_hop]-,"
+        f" object_next_hop ...`"
+    )
+    rel_node_info = {
+        "kg_rel_texts": rel_texts,
+        "kg_rel_map": rel_map,
+    }
+    if graph_schema != "":
+        rel_node_info["kg_schema"] = {"schema": graph_schema}
+    rel_text_node = TextNode(
+        text="\n".join([rel_initial_text, *rel_texts]),
+        metadata=rel_node_info,
+        excluded_embed_metadata_keys=["kg_rel_map", "kg_rel_texts"],
+        excluded_llm_metadata_keys=["kg_rel_map", "kg_rel_texts"],
+    )
+    # this node is constructed from rel_texts, give high confidence to avoid cutoff
+    return NodeWithScore(node=rel_text_node, score=DEFAULT_NODE_SCORE)
+
+
+def kg_retriever(kg_index, embedding_matrix: Optional[EmbeddingMatrix] = None,
+                 keyword_extractor: Optional[RustKeywordExtractor] = None,
+                 embedding_cache: Optional[EmbeddingCache] = None,
+                 retrieval_cache: Optional[RetrievalCache] = None, **kwargs) -> KGRetriever:
+    """
+    A KGRetriever over `kg_index`, in hybrid mode unless the KG has no triplet embeddings or
+    `retriever_mode` says otherwise. The other arguments are those of `kg_query_engine`.
+    """
+    if embedding_matrix is None:
+        embedding_matrix = EmbeddingMatrix.from_embedding_dict(kg_index.index_struct.embedding_dict)
+    if kwargs.get("retriever_mode") is None and len(embedding_matrix) > 0:
+        kwargs["retriever_mode"] = KGRetrieverMode.HYBRID
+    kwargs["llm"] = kwargs.get("llm") or kg_index._llm
+    kwargs["embed_model"] = kwargs.get("embed_model") or kg_index._embed_model
+    return KGRetriever(
+        kg_index,
+        embedding_matrix=embedding_matrix,
+        keyword_extractor=keyword_extractor,
+        embedding_cache=embedding_cache,
+        retrieval_cache=retrieval_cache,
+        object_map=kg_index._object_map,
+        **kwargs,
+    )
+
+
+def kg_query_engine(kg_index, embedding_matrix: Optional[EmbeddingMatrix] = None,
+                    keyword_extractor: Optional[RustKeywordExtractor] = None,
+                    embedding_cache: Optional[EmbeddingCache] = None,
+                    retrieval_cache: Optional[RetrievalCache] = None, **kwargs):
+    """
+    `kg_index.as_query_engine(**kwargs)` with a KGRetriever in place of the KGTableRetriever.
+    Pass the same `embedding_matrix` to several engines of one index to build it only once,
+    a `keyword_extractor` to extract keywords without the LLM, and query caches to skip the
+    retrieval legs of repeated queries.
+    """
+    # Lazy import, as in BaseIndex.as_query_engine
+    from llama_index.core.query_engine.retriever_query_engine import RetrieverQueryEngine
+
+    llm = kwargs.pop("llm", None) or kg_index._llm
+    retriever = kg_retriever(
+        kg_index,
+        embedding_matrix=embedding_matrix,
+        keyword_extractor=keyword_extractor,
+        embedding_cache=embedding_cache,
+        retrieval_cache=retrieval_cache,
+        llm=llm,
+        embed_model=kwargs.pop("embed_model", None),
+        retriever_mode=kwargs.pop("retriever_mode", None),
+        **kwargs,
+    )
+    return RetrieverQueryEngine.from_args(retriever, llm=llm, **kwargs)
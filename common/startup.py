@@ -0,0 +1,58 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Reference point of `mark()`. The app imports this module before anything else,
+# so it approximates the start of the worker process.
+STARTED_AT = time.perf_counter()
+
+
+class StartupTimings:
+    """
+    Records how long each startup phase of a worker took, in the order they ran.
+
+    Phases run in the background are recorded when they finish. A phase that
+    raised is kept with status "failed" and its error, so a worker that never
+    becomes ready can still explain why.
+    """
+
+    def __init__(self):
+        self._phases = OrderedDict()  # name -> {"seconds", "status", ...}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float, status: str = "ok", error: str = None):
+        """Record a phase measured by the caller."""
+        phase = {"seconds": round(seconds, 3), "status": status}
+        if error is not None:
+            phase["error"] = error
+        with self._lock:
+            self._phases[name] = phase
+        logger.info(f"Startup phase '{name}' {status} in {seconds:.2f}s")
+
+    def mark(self, name: str):
+        """Record the time elapsed since startup as phase `name`, e.g. once the app module is imported."""
+        self.record(name, time.perf_counter() - STARTED_AT)
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time the enclosed block as phase `name`."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.record(name, time.perf_counter() - started_at, status="failed", error=repr(e))
+            raise
+        self.record(name, time.perf_counter() - started_at)
+
+    def snapshot(self) -> dict:
+        """Phases recorded so far and the seconds since startup."""
+        with self._lock:
+            phases = {name: dict(phase) for name, phase in self._phases.items()}
+        return {"phases": phases, "uptime_s": round(time.perf_counter() - STARTED_AT, 3)}
+
+
+startup_timings = StartupTimings()
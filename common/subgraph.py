@@ -0,0 +1,92 @@
+import re
+import ast
+import json
+import hashlib
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import networkx as nx
+from pyvis.network import Network
+
+logger = logging.getLogger(__name__)
+
+Edge = Tuple[str, str, str]
+
+# repr() of a [subj, rel, obj] or (subj, rel, obj) of plain single-quoted strings, as the
+# retrievers write `kg_rel_texts`; anything else goes through ast.literal_eval
+SIMPLE_EDGE_PATTERN = re.compile(r"^[\[(]'([^'\\]*)', '([^'\\]*)', '([^'\\]*)'[\])]$")
+
+
+def parse_edge(edge_str: str) -> Optional[Edge]:
+    """(subject, relation, object) of one `kg_rel_texts` entry, or None if it is not a triplet."""
+    match = SIMPLE_EDGE_PATTERN.match(edge_str)
+    if match:
+        return match.groups()
+    try:
+        value = ast.literal_eval(edge_str)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+    if isinstance(value, (list, tuple)) and len(value) == 3:
+        return tuple(str(part) for part in value)
+    return None
+
+
+def parse_edges(metadata: Optional[dict]) -> List[Edge]:
+    """
+    Edges of the subgraph a response was generated from: the `kg_rel_texts` of its
+    source nodes (`response.metadata`), parsed without eval and deduplicated in order.
+    """
+    edges = {}
+    for node_metadata in (metadata or {}).values():
+        for edge_str in (node_metadata or {}).get('kg_rel_texts', []):
+            edge = parse_edge(edge_str)
+            if edge is None:
+                logger.debug(f"Skipping malformed KG edge {edge_str!r}")
+                continue
+            edges.setdefault(edge)
+    return list(edges)
+
+
+def subgraph_id(edges: Iterable[Edge]) -> str:
+    """Hash of an edge set, independent of the order and repetition of its edges."""
+    canonical = json.dumps(sorted({tuple(edge) for edge in edges}), separators=(',', ':'))
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=12).hexdigest()
+
+
+def subgraph_json(edges: Iterable[Edge]) -> Dict[str, list]:
+    """Nodes and edges of the subgraph in the vis-network format, for rendering on the client."""
+    nodes, links = {}, []
+    for source, action, target in edges:
+        nodes.setdefault(source, {"id": source, "label": source})
+        nodes.setdefault(target, {"id": target, "label": target})
+        links.append({"from": source, "to": target, "label": action})
+    return {"nodes": list(nodes.values()), "edges": links}
+
+
+def subgraph_html(edges: Iterable[Edge]) -> str:
+    """Standalone pyvis HTML page of the subgraph."""
+    G = nx.DiGraph()
+    for source, action, target in edges:
+        G.add_edge(source, target, label=action)
+
+    net = Network(
+        notebook=False,
+        cdn_resources="remote",
+        height="500px",
+        width="100%",
+        select_menu=False,
+        filter_menu=False,
+    )
+    net.from_nx(G)
+    net.force_atlas_2based(central_gravity=0.015, gravity=-31)
+    return net.generate_html()
+
+
+def subgraph_iframe(html: str) -> str:
+    """`html` embedded in a sandboxed iframe, as the Gradio demo shows it."""
+    html = html.replace("'", "\"")
+    return f"""<iframe style="width: 100%; height: 600px;margin:0 auto" name="result" allow="midi; geolocation; microphone; camera;
+    display-capture; encrypted-media;" sandbox="allow-modals allow-forms
+    allow-scripts allow-same-origin allow-popups
+    allow-top-navigation-by-user-activation allow-downloads" allowfullscreen=""
+    allowpaymentrequest="" frameborder="0" srcdoc='{html}'></iframe>"""
@@ -0,0 +1,299 @@
+import re
+import ast
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Callable, Generator, List, Optional, Sequence, cast
+
+from llama_index.core import Settings
+from llama_index.core.callbacks.base import CallbackManager
+from llama_index.core.llms import LLM
+from llama_index.core.prompts import BasePromptTemplate
+from llama_index.core.prompts.default_prompt_selectors import DEFAULT_TEXT_QA_PROMPT_SEL
+from llama_index.core.prompts.mixin import PromptDictType
+from llama_index.core.response_synthesizers.base import BaseSynthesizer
+from llama_index.core.schema import MetadataMode, NodeWithScore
+from llama_index.core.types import RESPONSE_TEXT_TYPE
+
+from common.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Tokens of retrieved context per prompt, unless configured per engine
+DEFAULT_CONTEXT_BUDGET = 3000
+# Share of the budget reserved for triplets before text chunks are packed; triplets left
+# out get whatever the text chunks leave over
+TRIPLET_SHARE = 0.25
+# A text chunk that does not fit is cut at a line boundary, unless fewer tokens than this are left
+MIN_CHUNK_TOKENS = 64
+
+TRIPLET_HEADER = "Knowledge graph triplets, `subject -[predicate]-> object`:"
+CHUNK_SEPARATOR = "\n\n"
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _text_key(text: str) -> str:
+    return _WHITESPACE.sub(" ", text).strip().lower()
+
+
+def format_triplet(rel_text: str) -> str:
+    """
+    `subject -[predicate]-> object` for a triplet retrieved as "('subj', 'rel', 'obj')" or
+    "['subj', 'rel', 'obj']". Other knowledge sequences are returned unchanged.
+    """
+    try:
+        triplet = ast.literal_eval(rel_text)
+    except (ValueError, SyntaxError):
+        return rel_text.strip()
+    if isinstance(triplet, (tuple, list)) and len(triplet) == 3 and all(isinstance(part, str) for part in triplet):
+        subj, rel, obj = triplet
+        return f"{subj} -[{rel}]-> {obj}"
+    return rel_text.strip()
+
+
+@dataclass
+class PackedContext:
+    """The context of one prompt and what packing it kept and left out."""
+
+    text: str = ""
+    tokens: int = 0
+    triplets: int = 0
+    chunks: int = 0
+    truncated: int = 0
+    dropped: int = 0
+    duplicates: int = 0
+    # LLM calls "refine" mode makes for the same nodes, one per node
+    refine_calls: int = 0
+    parts: List[str] = field(default_factory=list, repr=False)
+
+
+class ContextPacker:
+    """
+    Ranks, deduplicates and packs retrieved triplets and text chunks into `budget` tokens.
+
+    Triplets come from the `kg_rel_texts` of the retriever's knowledge sequence node and
+    keep the retriever's order. Text chunks are ranked by score, ties in retriever order
+    (keyword hits first). Triplets with the same subject, predicate and object, and text
+    chunks that repeat or are contained in a better ranked chunk, are packed once.
+
+    Triplets are packed first into `triplet_share` of the budget, since they are a few
+    tokens each and summarize what the chunks say, then as many whole text chunks as fit.
+    The first chunk that does not fit is cut at a line boundary if at least
+    `min_chunk_tokens` are left, and leftover tokens go to the remaining triplets. Tokens
+    are counted with `tokenizer`, llama_index's global tokenizer by default.
+    """
+
+    def __init__(self, budget: int = DEFAULT_CONTEXT_BUDGET, tokenizer: Optional[Callable[[str], List]] = None,
+                 triplet_share: float = TRIPLET_SHARE, min_chunk_tokens: int = MIN_CHUNK_TOKENS):
+        self.budget = budget
+        self._tokenizer = tokenizer
+        self.triplet_share = triplet_share
+        self.min_chunk_tokens = min_chunk_tokens
+
+    @property
+    def tokenizer(self) -> Callable[[str], List]:
+        return self._tokenizer or Settings.tokenizer
+
+    def count(self, text: str) -> int:
+        return len(self.tokenizer(text)) if text else 0
+
+    def rank(self, nodes: Sequence[NodeWithScore]) -> tuple:
+        """Deduplicated triplets and text chunks of `nodes`, best first, and how many duplicates were removed."""
+        rel_texts, chunks = [], []
+        for position, node in enumerate(nodes):
+            if "kg_rel_texts" in node.node.metadata:
+                rel_texts.extend(node.node.metadata["kg_rel_texts"])
+            else:
+                chunks.append((-(node.score or 0.0), position, node.node.get_content(metadata_mode=MetadataMode.LLM)))
+        return self.rank_texts(rel_texts, [text for _, _, text in sorted(chunks)])
+
+    def rank_texts(self, rel_texts: Sequence[str], chunks: Sequence[str]) -> tuple:
+        """`rank` for triplets and text chunks already in rank order."""
+        duplicates = 0
+        triplets, seen = [], set()
+        for rel_text in rel_texts:
+            triplet = format_triplet(rel_text)
+            key = _text_key(triplet)
+            if not key or key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            triplets.append(triplet)
+
+        kept, kept_keys = [], []
+        for chunk in chunks:
+            key = _text_key(chunk)
+            if not key or any(key in other for other in kept_keys):
+                duplicates += 1
+                continue
+            kept.append(chunk.strip())
+            kept_keys.append(key)
+        return triplets, kept, duplicates
+
+    def _truncate(self, chunk: str, budget: int) -> str:
+        """The longest run of leading lines of `chunk` within `budget` tokens."""
+        lines = chunk.splitlines()
+        low, high = 0, len(lines)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.count("\n".join(lines[:mid])) <= budget:
+                low = mid
+            else:
+                high = mid - 1
+        return "\n".join(lines[:low])
+
+    def pack(self, nodes: Sequence[NodeWithScore]) -> PackedContext:
+        """Pack the triplets and text chunks of `nodes`, as the retriever returned them."""
+        triplets, chunks, duplicates = self.rank(nodes)
+        packed = self.pack_ranked(triplets, chunks)
+        packed.duplicates = duplicates
+        packed.refine_calls = len(nodes)
+        return packed
+
+    def pack_ranked(self, triplets: Sequence[str], chunks: Sequence[str]) -> PackedContext:
+        """Pack ranked, deduplicated triplets and text chunks."""
+        packed = PackedContext()
+        separator_tokens = self.count(CHUNK_SEPARATOR)
+        remaining = self.budget
+
+        header_tokens = self.count(TRIPLET_HEADER) + 1
+        triplet_tokens = [self.count(triplet) + 1 for triplet in triplets]
+        packed_triplets = []
+        next_triplet = 0
+
+        def add_triplets(budget: int) -> int:
+            nonlocal next_triplet
+            used = 0
+            while next_triplet < len(triplets):
+                cost = triplet_tokens[next_triplet] + (header_tokens if not packed_triplets else 0)
+                if used + cost > budget:
+                    break
+                packed_triplets.append(triplets[next_triplet])
+                used += cost
+                next_triplet += 1
+            return used
+
+        if triplets:
+            remaining -= add_triplets(int(self.budget * self.triplet_share))
+
+        packed_chunks = []
+        for i, chunk in enumerate(chunks):
+            cost = self.count(chunk) + separator_tokens
+            if cost <= remaining:
+                packed_chunks.append(chunk)
+                remaining -= cost
+                continue
+            if remaining - separator_tokens >= self.min_chunk_tokens:
+                head = self._truncate(chunk, remaining - separator_tokens)
+                if head:
+                    packed_chunks.append(head)
+                    remaining -= self.count(head) + separator_tokens
+                    packed.truncated += 1
+            packed.dropped += len(chunks) - i - (1 if packed.truncated else 0)
+            break
+
+        if next_triplet < len(triplets):
+            add_triplets(remaining)
+        packed.dropped += len(triplets) - next_triplet
+
+        if packed_triplets:
+            packed.parts.append("\n".join([TRIPLET_HEADER, *packed_triplets]))
+        packed.parts.extend(packed_chunks)
+        packed.text = CHUNK_SEPARATOR.join(packed.parts)
+        packed.tokens = self.count(packed.text)
+        packed.triplets = len(packed_triplets)
+        packed.chunks = len(packed_chunks)
+        return packed
+
+
+class PackedContextSynthesizer(BaseSynthesizer):
+    """
+    Response synthesizer that answers with exactly one LLM call.
+
+    "refine" mode calls the LLM once per retrieved node, sequentially, each call
+    refining the previous answer, so a completion waits for up to
+    `num_chunks_per_query + 1` round trips. This synthesizer packs the retrieved
+    triplets and text chunks into one context of at most `context_budget` tokens
+    with a ContextPacker and fills `text_qa_template` once, streaming or not.
+
+    Every synthesis counts `synthesis.llm_calls` and the calls "refine" would have
+    made in addition (`synthesis.llm_calls_saved`), plus what was packed, on the
+    `/metrics` endpoint.
+    """
+
+    def __init__(
+        self,
+        llm: Optional[LLM] = None,
+        callback_manager: Optional[CallbackManager] = None,
+        text_qa_template: Optional[BasePromptTemplate] = None,
+        context_budget: int = DEFAULT_CONTEXT_BUDGET,
+        tokenizer: Optional[Callable[[str], List]] = None,
+        streaming: bool = False,
+    ) -> None:
+        super().__init__(llm=llm, callback_manager=callback_manager, streaming=streaming)
+        self._text_qa_template = text_qa_template or DEFAULT_TEXT_QA_PROMPT_SEL
+        self.packer = ContextPacker(budget=context_budget, tokenizer=tokenizer)
+
+    def _get_prompts(self) -> PromptDictType:
+        """Get prompts."""
+        return {"text_qa_template": self._text_qa_template}
+
+    def _update_prompts(self, prompts: PromptDictType) -> None:
+        """Update prompts."""
+        if "text_qa_template" in prompts:
+            self._text_qa_template = prompts["text_qa_template"]
+
+    def _pack(self, nodes: Sequence[NodeWithScore]) -> Optional[PackedContext]:
+        if not nodes:
+            return None
+        with metrics.timer("synthesis.pack"):
+            return self.packer.pack(nodes)
+
+    def synthesize(self, query, nodes: List[NodeWithScore], additional_source_nodes: Optional[Sequence[NodeWithScore]] = None,
+                   **response_kwargs: Any):
+        # Packing needs the nodes, the base class only passes their text to get_response
+        return super().synthesize(query, nodes, additional_source_nodes, packed_context=self._pack(nodes), **response_kwargs)
+
+    async def asynthesize(self, query, nodes: List[NodeWithScore], additional_source_nodes: Optional[Sequence[NodeWithScore]] = None,
+                          **response_kwargs: Any):
+        return await super().asynthesize(query, nodes, additional_source_nodes, packed_context=self._pack(nodes), **response_kwargs)
+
+    def _context(self, text_chunks: Sequence[str], packed_context: Optional[PackedContext]) -> PackedContext:
+        if packed_context is None:
+            # Called with plain text chunks, e.g. by a query engine that does not pass nodes
+            triplets, chunks, duplicates = self.packer.rank_texts([], text_chunks)
+            packed_context = self.packer.pack_ranked(triplets, chunks)
+            packed_context.duplicates = duplicates
+            packed_context.refine_calls = len(text_chunks)
+        metrics.incr("synthesis.requests")
+        metrics.incr("synthesis.llm_calls")
+        metrics.incr("synthesis.llm_calls_saved", max(0, packed_context.refine_calls - 1))
+        metrics.incr("synthesis.context_tokens", packed_context.tokens)
+        metrics.incr("synthesis.triplets_packed", packed_context.triplets)
+        metrics.incr("synthesis.chunks_packed", packed_context.chunks)
+        metrics.incr("synthesis.chunks_truncated", packed_context.truncated)
+        metrics.incr("synthesis.items_dropped", packed_context.dropped)
+        metrics.incr("synthesis.duplicates_removed", packed_context.duplicates)
+        logger.info(
+            f"> Packed {packed_context.triplets} triplets and {packed_context.chunks} text chunks into "
+            f"{packed_context.tokens}/{self.packer.budget} tokens ({packed_context.truncated} truncated, "
+            f"{packed_context.dropped} dropped, {packed_context.duplicates} duplicates)"
+        )
+        return packed_context
+
+    def get_response(self, query_str: str, text_chunks: Sequence[str], packed_context: Optional[PackedContext] = None,
+                     **response_kwargs: Any) -> RESPONSE_TEXT_TYPE:
+        context = self._context(text_chunks, packed_context)
+        text_qa_template = self._text_qa_template.partial_format(query_str=query_str)
+        if not self._streaming:
+            response = self._llm.predict(text_qa_template, context_str=context.text, **response_kwargs)
+            return response or "Empty Response"
+        return cast(Generator, self._llm.stream(text_qa_template, context_str=context.text, **response_kwargs))
+
+    async def aget_response(self, query_str: str, text_chunks: Sequence[str], packed_context: Optional[PackedContext] = None,
+                            **response_kwargs: Any) -> RESPONSE_TEXT_TYPE:
+        context = self._context(text_chunks, packed_context)
+        text_qa_template = self._text_qa_template.partial_format(query_str=query_str)
+        if not self._streaming:
+            response = await self._llm.apredict(text_qa_template, context_str=context.text, **response_kwargs)
+            return response or "Empty Response"
+        return cast(Generator, self._llm.stream(text_qa_template, context_str=context.text, **response_kwargs))
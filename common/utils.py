@@ -1,9 +1,19 @@
-import networkx as nx
-from pyvis.network import Network
 import wandb
 import re
 import json
 import os
+import hashlib
+
+from common.subgraph import parse_edges, subgraph_html, subgraph_iframe
+
+# Files written by llama_index when a KG index is persisted
+KG_PERSIST_FILES = [
+    "default__vector_store.json",
+    "docstore.json",
+    "graph_store.json",
+    "image__vector_store.json",
+    "index_store.json",
+]
 
 # Load static variables from config.json
 def load_config():
@@ -17,6 +27,27 @@ def load_config():
         config = json.load(file)
     return config
 
+def kg_fingerprint(persist_dir):
+    """
+    Return a short version string for the KG persisted in `persist_dir`, derived from the
+    size and modification time of its files. Re-persisting or replacing the KG changes it.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for file_name in KG_PERSIST_FILES:
+        path = os.path.join(persist_dir, file_name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(f"{file_name}:{stat.st_size}:{stat.st_mtime_ns};".encode('utf-8'))
+    return digest.hexdigest()
+
+def file_fingerprint(*file_paths):
+    """Return a short hash of the contents of `file_paths`, e.g. prompt templates."""
+    digest = hashlib.blake2b(digest_size=8)
+    for path in file_paths:
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
 def extract_code_using_regex(text):
     pattern = re.compile(r'["]?[completed_code]+["]?:\n(.*?)\n```', re.DOTALL)
     match = pattern.search(text)
@@ -38,34 +69,7 @@ def extract_code_from_response(json_response):
 
 def plot_subgraph_via_edges(input_data):
     """Plot subgraph via edges from the input data and return the HTML representation."""
-    edges = [value['kg_rel_texts'] for value in input_data.values() if 'kg_rel_texts' in value]
-    edges = [eval(edge_str) for sublist in edges for edge_str in sublist]
-
-    G = nx.DiGraph()
-    for source, action, target in edges:
-        G.add_edge(source, target, label=action)
-
-    net = Network(
-        notebook=False,
-        cdn_resources="remote",
-        height="500px",
-        width="100%",
-        select_menu=False,
-        filter_menu=False,
-    )
-    net.from_nx(G)
-    net.force_atlas_2based(central_gravity=0.015, gravity=-31)
-    
-    html = net.generate_html().replace("'", "\"")
-    wandb.log({"Substrate KG Visualization": wandb.Html(html)})
-    
-    iframe_html = f"""<iframe style="width: 100%; height: 600px;margin:0 auto" name="result" allow="midi; geolocation; microphone; camera; 
-    display-capture; encrypted-media;" sandbox="allow-modals allow-forms 
-    allow-scripts allow-same-origin allow-popups 
-    allow-top-navigation-by-user-activation allow-downloads" allowfullscreen="" 
-    allowpaymentrequest="" frameborder="0" srcdoc='{html}'></iframe>"""
-    
-    return edges, iframe_html
-
-
-
+    edges = parse_edges(input_data)
+    html = subgraph_html(edges)
+    wandb.log({"Substrate KG Visualization": wandb.Html(html.replace("'", "\""))})
+    return edges, subgraph_iframe(html)
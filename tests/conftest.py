@@ -0,0 +1,50 @@
+import time
+import hashlib
+
+import numpy as np
+import pytest
+from llama_index.core import Document, KnowledgeGraphIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import MockLLM
+
+TRIPLETS = {
+    "fn hash(x: u32) -> H256 {}": [("Substrate", "uses", "Rust"), ("Substrate", "is", "Framework")],
+    "pub struct Block<Header, Extrinsic> {}": [("Block", "has", "Header"), ("Block", "has", "Extrinsic")],
+    "impl<T: Config> Pallet<T> {}": [("Pallet", "implements", "Hooks"), ("Balances", "is", "Pallet")],
+}
+
+
+class RecordingEmbedding(MockEmbedding):
+    """Deterministic embeddings that records the texts it embeds and can be slowed down or failed."""
+
+    delay: float = 0.0
+    error: bool = False
+    texts: list = []
+
+    def _vec(self, text):
+        seed = int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
+        return np.random.default_rng(seed).standard_normal(self.embed_dim).tolist()
+
+    def _get_text_embedding(self, text):
+        time.sleep(self.delay)
+        if self.error:
+            raise RuntimeError("throttled")
+        self.texts.append(text)
+        return self._vec(text)
+
+    def _get_query_embedding(self, query):
+        return self._vec(query)
+
+
+@pytest.fixture
+def embed_model():
+    return RecordingEmbedding(embed_dim=8, texts=[])
+
+
+@pytest.fixture
+def kg_index():
+    # The triplets are embedded with a model of their own, so `embed_model` only sees queries
+    return KnowledgeGraphIndex.from_documents(
+        [Document(text=text) for text in TRIPLETS], kg_triplet_extract_fn=TRIPLETS.get,
+        include_embeddings=True, llm=MockLLM(), embed_model=RecordingEmbedding(embed_dim=8),
+    )
@@ -0,0 +1,31 @@
+import numpy as np
+
+from common.graph_store import CSRGraphStore, Interner
+
+SUBSTRATE_EDGES = [["is", "Framework"]] * 12 + [["uses", "Rust"], ["has", "Pallets"], ["builds", "Chains"]]
+DISTINCT = [
+    ["Substrate", "is", "Framework"],
+    ["Substrate", "uses", "Rust"],
+    ["Substrate", "has", "Pallets"],
+    ["Substrate", "builds", "Chains"],
+]
+
+
+def test_duplicate_edges_do_not_use_up_the_fanout():
+    store = CSRGraphStore.from_graph_dict({"Substrate": SUBSTRATE_EDGES}, fanout=(10,))
+    assert store.get_rel_map(["Substrate"], depth=1) == {"Substrate": DISTINCT}
+    assert store.get("Substrate") == [edge[1:] for edge in DISTINCT]
+
+
+def test_duplicate_edges_in_snapshot_arrays_are_skipped():
+    # Snapshots keep the JSON graph's duplicates in their CSR arrays
+    entities = Interner(["Chains", "Framework", "Pallets", "Rust", "Substrate"])
+    relations = Interner(["builds", "has", "is", "uses"])
+    rel_ids = np.asarray([relations.id(rel) for rel, _ in SUBSTRATE_EDGES], dtype=np.int32)
+    obj_ids = np.asarray([entities.id(obj) for _, obj in SUBSTRATE_EDGES], dtype=np.int32)
+    # Only "Substrate", the last entity, has out-edges
+    indptr = np.asarray([0, 0, 0, 0, 0, len(SUBSTRATE_EDGES)], dtype=np.int64)
+    store = CSRGraphStore(entities, relations, indptr, rel_ids, obj_ids, fanout=(3,))
+    assert store.get_rel_map(["Substrate"], depth=1) == {"Substrate": DISTINCT[:3]}
+    store.delete("Substrate", "uses", "Rust")
+    assert store.get_rel_map(["Substrate"], depth=1) == {"Substrate": [DISTINCT[0], DISTINCT[2], DISTINCT[3]]}
@@ -0,0 +1,54 @@
+import time
+import threading
+
+import pytest
+from llama_index.core.base.base_retriever import BaseRetriever
+
+from common import kg_registry
+from common.kg_registry import FederatedRetriever, ResidentKG
+from common.retrieval import knowledge_sequence_node
+
+
+class StaticRetriever(BaseRetriever):
+    """Returns the knowledge sequence node of `rel_map` after `delay` seconds."""
+
+    def __init__(self, rel_map, delay=0.0):
+        super().__init__()
+        self.rel_map, self.delay = rel_map, delay
+
+    def _retrieve(self, query_bundle):
+        time.sleep(self.delay)
+        rel_texts = [str(path) for paths in self.rel_map.values() for path in paths]
+        return [knowledge_sequence_node(rel_texts, self.rel_map, 1)]
+
+
+class StaticRegistry(dict):
+    def get(self, name):
+        return self[name]
+
+
+def registry(**retrievers):
+    return StaticRegistry({name: ResidentKG(name, retriever, 0) for name, retriever in retrievers.items()})
+
+
+def test_stranded_retrievals_do_not_delay_later_queries(monkeypatch):
+    monkeypatch.setattr(kg_registry, "FANOUT_SLOTS", threading.BoundedSemaphore(1))
+    kgs = registry(slow=StaticRetriever({"A": [["A", "is", "slow"]]}, delay=0.5),
+                   fast=StaticRetriever({"B": [["B", "is", "fast"]]}))
+    FederatedRetriever(kgs, ["slow"], timeout=0.05).retrieve("query")
+    # The slow retrieval still holds the only thread, so the next query runs inline
+    started_at = time.perf_counter()
+    [node] = FederatedRetriever(kgs, ["fast"], timeout=0.05).retrieve("query")
+    assert time.perf_counter() - started_at < 0.2
+    assert node.node.metadata["kg_rel_map"] == {"B": [["B", "is", "fast"]]}
+
+
+def test_paths_of_a_subject_in_several_kgs_are_merged():
+    kgs = registry(frame=StaticRetriever({"Pallet": [["Pallet", "uses", "frame"], ["Pallet", "has", "Hooks"]]}),
+                   docs=StaticRetriever({"Pallet": [["Pallet", "has", "Hooks"], ["Pallet", "is", "module"]],
+                                         "Runtime": [["Runtime", "has", "Pallet"]]}))
+    [node] = FederatedRetriever(kgs, ["frame", "docs"]).retrieve("query")
+    assert node.node.metadata["kg_rel_map"] == {
+        "Pallet": [["Pallet", "uses", "frame"], ["Pallet", "has", "Hooks"], ["Pallet", "is", "module"]],
+        "Runtime": [["Runtime", "has", "Pallet"]],
+    }
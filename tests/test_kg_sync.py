@@ -0,0 +1,125 @@
+import os
+import hashlib
+
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+
+from common.kg_sync import KGSync, STAGING_SUFFIX, PART_SUFFIX
+
+FILES = {
+    "docstore.json": 300_000,
+    "index_store.json": 250_000,
+    "graph_store.json": 120_000,
+    "default__vector_store.json": 40_000,
+}
+
+
+class FakeS3(LocalFileSystem):
+    """
+    Local stand-in for S3: listings carry the MD5 ETags S3 gives single-part uploads, and
+    reads fail with a ConnectionError after `fail_after` bytes of each opened file.
+    """
+
+    fail_after = None
+
+    def find(self, path, detail=False, **kwargs):
+        found = super().find(path, detail=detail, **kwargs)
+        if detail:
+            for name, info in found.items():
+                if info["type"] == "file":
+                    with open(name, "rb") as f:
+                        info["ETag"] = '"%s"' % hashlib.md5(f.read()).hexdigest()
+        return found
+
+    def open(self, path, mode="rb", **kwargs):
+        f = super().open(path, mode, **kwargs)
+        if self.fail_after is None:
+            return f
+        read, limit, state = f.read, self.fail_after, {"read": 0}
+
+        def failing_read(n=-1):
+            if state["read"] >= limit:
+                raise ConnectionError("connection reset")
+            data = read(min(n, limit - state["read"]) if n and n > 0 else limit - state["read"])
+            state["read"] += len(data)
+            return data
+
+        f.read = failing_read
+        return f
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    remote = tmp_path / "bucket" / "Astar"
+    remote.mkdir(parents=True)
+    for name, size in FILES.items():
+        (remote / name).write_bytes(os.urandom(size))
+    return {"Astar": (str(remote), str(tmp_path / "local" / "Astar"))}
+
+
+def assert_synced(folders):
+    for remote_dir, local_dir in folders.values():
+        assert sorted(f for f in os.listdir(local_dir) if not f.startswith(".")) == sorted(os.listdir(remote_dir))
+        for name in os.listdir(remote_dir):
+            with open(os.path.join(remote_dir, name), "rb") as a, open(os.path.join(local_dir, name), "rb") as b:
+                assert a.read() == b.read(), name
+
+
+def test_incremental_sync_downloads_only_changed_files(bucket):
+    fs = FakeS3()
+    [result] = KGSync(fs).sync(bucket)
+    assert (result.status, result.downloaded) == ("synced", len(FILES))
+    assert_synced(bucket)
+
+    [result] = KGSync(fs).sync(bucket)
+    assert result.status == "up_to_date"
+
+    remote_dir, local_dir = bucket["Astar"]
+    with open(os.path.join(remote_dir, "index_store.json"), "ab") as f:
+        f.write(b" ")
+    unchanged_inode = os.stat(os.path.join(local_dir, "docstore.json")).st_ino
+    [result] = KGSync(fs).sync(bucket)
+    assert (result.status, result.downloaded, result.reused) == ("synced", 1, len(FILES) - 1)
+    # Unchanged files are hard-linked into the new directory, not copied or downloaded
+    assert os.stat(os.path.join(local_dir, "docstore.json")).st_ino == unchanged_inode
+    assert_synced(bucket)
+
+
+def test_files_deleted_remotely_are_deleted_locally(bucket):
+    fs = FakeS3()
+    KGSync(fs).sync(bucket)
+    remote_dir, local_dir = bucket["Astar"]
+    os.remove(os.path.join(remote_dir, "default__vector_store.json"))
+    [result] = KGSync(fs).sync(bucket)
+    assert (result.status, result.downloaded, result.deleted) == ("synced", 0, 1)
+    assert not os.path.exists(os.path.join(local_dir, "default__vector_store.json"))
+    assert_synced(bucket)
+
+
+def test_interrupted_sync_resumes_partial_downloads(bucket):
+    fs = FakeS3()
+    fs.fail_after = 100_000
+    [result] = KGSync(fs, retries=0, chunk_size=30_000).sync(bucket)
+    remote_dir, local_dir = bucket["Astar"]
+    assert result.status == "failed"
+    # The KG is not replaced by a partial one; the partial files wait in the staging directory
+    assert not os.path.exists(local_dir)
+    staged = os.listdir(local_dir + STAGING_SUFFIX)
+    assert any(name.endswith(PART_SUFFIX) for name in staged)
+
+    fs.fail_after = None
+    [result] = KGSync(fs, chunk_size=30_000).sync(bucket)
+    assert result.status == "synced"
+    # Files larger than what the first run read were continued, not started again
+    assert result.resumed == sum(size > 100_000 for size in FILES.values())
+    assert result.bytes < sum(FILES.values())
+    assert not os.path.exists(local_dir + STAGING_SUFFIX)
+    assert_synced(bucket)
+
+
+def test_missing_folder_fails_without_touching_others(bucket, tmp_path):
+    folders = {**bucket, "missing": (str(tmp_path / "bucket" / "missing"), str(tmp_path / "local" / "missing"))}
+    results = {result.name: result for result in KGSync(FakeS3()).sync(folders)}
+    assert results["missing"].status == "failed"
+    assert results["Astar"].status == "synced"
+    assert_synced(bucket)
@@ -0,0 +1,38 @@
+import fakeredis
+from llama_index.core.llms import MockLLM
+
+from caching.query_cache import EmbeddingCache, normalize_query
+from common.retrieval import KGRetriever
+
+HEADER = "Complete the Rust code.\n<prefix_code>\n"
+FOOTER = "</prefix_code>\nUse the knowledge graph."
+
+
+def query(code):
+    return HEADER + code + FOOTER
+
+
+def test_different_last_lines_give_different_keys():
+    assert normalize_query(query("// compute the hash\nfn hash(x: u32) -> H256 {")) != \
+        normalize_query(query("// sort balances\nimpl<T: Config> Pallet<T> { fn on_initialize("))
+    assert normalize_query(query("use frame_support::pallet;\npub type Balances<T> = StorageMap<")) != \
+        normalize_query(query("use frame_support::pallet;\npub fn transfer(origin, dest:"))
+    assert "pub struct Block<Header,Extrinsic>{" in normalize_query(query("pub struct Block<Header, Extrinsic> {"))
+
+
+def test_only_the_identifier_being_typed_is_ignored():
+    assert normalize_query(query("fn main() {\n    let balance = tot")) == \
+        normalize_query(query("fn main()  {\n\tlet balance = total_iss"))
+    assert normalize_query(query("fn main() {\n    let balance = ")) != \
+        normalize_query(query("fn main() {\n    let balance = total "))
+
+
+def test_embedding_cache_embeds_the_full_query(kg_index, embed_model):
+    cache = EmbeddingCache("test", client=fakeredis.FakeRedis())
+    retriever = KGRetriever(kg_index, llm=MockLLM(), embed_model=embed_model, retriever_mode="embedding",
+                            embedding_cache=cache)
+    first, second = query("fn main() {\n    let balance = tot"), query("fn main() {\n    let balance = total_iss")
+    retriever.retrieve(first)
+    retriever.retrieve(second)
+    # The second query normalizes like the first and reuses its embedding
+    assert embed_model.texts == [first]
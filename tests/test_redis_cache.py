@@ -0,0 +1,38 @@
+import asyncio
+
+import fakeredis
+
+from caching.redis_cache import AsyncRedisCache, TieredCache
+from common.metrics import metrics
+
+
+async def wait_for(condition, timeout=3.0):
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+def test_malformed_invalidations_do_not_stop_the_listener():
+    async def main():
+        server = fakeredis.FakeServer()
+        worker = TieredCache(AsyncRedisCache(client=fakeredis.FakeAsyncRedis(server=server)))
+        other = TieredCache(AsyncRedisCache(client=fakeredis.FakeAsyncRedis(server=server)))
+        await worker.start()
+        # Let the listener subscribe before publishing
+        await asyncio.sleep(0.2)
+        bad = metrics.snapshot()["counters"].get("cache.local.bad_invalidations", 0)
+        for data in ("not json", "[1, 2]", '{"keys": 5}'):
+            await other.redis.client.publish(worker.channel, data)
+        worker.local.set("key", {"v": 1}, 10)
+        await other.invalidate(["key"])
+        try:
+            assert await wait_for(lambda: worker.local.get("key") is None)
+            assert not worker._listener.done()
+            assert metrics.snapshot()["counters"]["cache.local.bad_invalidations"] == bad + 3
+        finally:
+            await worker.close()
+            await other.close()
+
+    asyncio.run(main())
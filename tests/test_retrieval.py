@@ -0,0 +1,84 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from llama_index.core.llms import MockLLM
+
+from common.metrics import metrics
+from common.retrieval import KGRetriever
+
+
+def counter(name):
+    return metrics.snapshot()["counters"].get(name, 0)
+
+
+def rel_texts(nodes):
+    return set(nodes[-1].node.metadata["kg_rel_texts"])
+
+
+@pytest.fixture
+def make_retriever(kg_index, embed_model):
+    def make(**kwargs):
+        kwargs.setdefault("retriever_mode", "hybrid")
+        retriever = KGRetriever(kg_index, llm=MockLLM(), embed_model=embed_model, include_text=False,
+                                similarity_top_k=2, **kwargs)
+        retriever._get_keywords = lambda query_str: ["Block"]
+        return retriever
+    return make
+
+
+@pytest.fixture
+def both_legs(make_retriever):
+    return rel_texts(make_retriever().retrieve("Substrate"))
+
+
+def test_legs_without_a_free_thread_run_inline(make_retriever, both_legs):
+    inline = counter("retrieval.keyword_leg.inline"), counter("retrieval.embedding_leg.inline")
+    retriever = make_retriever(leg_executor=ThreadPoolExecutor(2), leg_slots=threading.BoundedSemaphore(1))
+    # The keyword leg is submitted first and keeps the only free thread while the other is submitted
+    retriever._get_keywords = lambda query_str: (time.sleep(0.1), ["Block"])[1]
+    assert rel_texts(retriever.retrieve("Substrate")) == both_legs
+    assert rel_texts(asyncio.run(retriever.aretrieve("Substrate"))) == both_legs
+    assert (counter("retrieval.keyword_leg.inline"), counter("retrieval.embedding_leg.inline")) == (inline[0], inline[1] + 2)
+
+    retriever._leg_slots.acquire()
+    assert rel_texts(retriever.retrieve("Substrate")) == both_legs
+    assert rel_texts(asyncio.run(retriever.aretrieve("Substrate"))) == both_legs
+    assert (counter("retrieval.keyword_leg.inline"), counter("retrieval.embedding_leg.inline")) == (inline[0] + 2, inline[1] + 4)
+
+
+def test_a_leg_that_times_out_is_dropped(make_retriever, embed_model, both_legs):
+    timeouts = counter("retrieval.embedding_leg.timeouts")
+    retriever = make_retriever(leg_timeouts={"embedding": 0.05})
+    keyword_only = rel_texts(make_retriever(retriever_mode="keyword").retrieve("Substrate"))
+    embed_model.delay = 0.5
+    started_at = time.perf_counter()
+    assert rel_texts(retriever.retrieve("Substrate")) == keyword_only != both_legs
+    assert rel_texts(asyncio.run(retriever.aretrieve("Substrate"))) == keyword_only
+    assert time.perf_counter() - started_at < 0.9
+    assert counter("retrieval.embedding_leg.timeouts") == timeouts + 2
+
+
+def test_a_failing_leg_degrades_to_the_other(make_retriever, embed_model):
+    errors = counter("retrieval.embedding_leg.errors")
+    keyword_only = rel_texts(make_retriever(retriever_mode="keyword").retrieve("Substrate"))
+    embed_model.error = True
+    retriever = make_retriever()
+    assert rel_texts(retriever.retrieve("Substrate")) == keyword_only
+    assert rel_texts(asyncio.run(retriever.aretrieve("Substrate"))) == keyword_only
+    assert counter("retrieval.embedding_leg.errors") == errors + 2
+
+
+def test_a_single_leg_has_no_timeout(make_retriever, embed_model):
+    retriever = make_retriever(retriever_mode="embedding", leg_timeouts={"embedding": 0.05})
+    expected = rel_texts(retriever.retrieve("Substrate"))
+    embed_model.delay = 0.2
+    assert rel_texts(retriever.retrieve("Substrate")) == expected
+    assert rel_texts(asyncio.run(retriever.aretrieve("Substrate"))) == expected
+    embed_model.error = True
+    with pytest.raises(RuntimeError):
+        retriever.retrieve("Substrate")
+    with pytest.raises(RuntimeError):
+        asyncio.run(retriever.aretrieve("Substrate"))
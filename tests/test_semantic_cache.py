@@ -0,0 +1,127 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from llama_index.core import Settings
+from llama_index.core.embeddings import MockEmbedding
+
+from caching import semantic_cache
+from caching.semantic_cache import HashingEmbedder, SemanticCache, create_embedder
+
+
+def test_bedrock_embedder_is_resolved_on_first_use(monkeypatch):
+    configured = []
+
+    def configure():
+        configured.append(True)
+        Settings.embed_model = MockEmbedding(embed_dim=8)
+
+    monkeypatch.setattr(Settings, "_embed_model", None)
+    cache = SemanticCache(create_embedder("bedrock", configure=configure), max_entries=4)
+    assert not configured and Settings._embed_model is None
+    cache.add("fn main() {", {"generated_code": "}"})
+    assert cache.lookup("fn main() {").result == {"generated_code": "}"}
+    assert configured == [True]
+    assert cache.embedder.embed_model is Settings.embed_model
+
+
+PREFIX = "impl<T: Config> Pallet<T> {\n    pub fn transfer(origin: OriginFor<T>, dest: T::AccountId) {"
+UNRELATED = "pub struct Block<Header, Extrinsic> {\n    pub header: Header,"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(semantic_cache, "time", SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+def make_cache(**kwargs):
+    kwargs.setdefault("threshold", 0.97)
+    return SemanticCache(HashingEmbedder(dim=256), **kwargs)
+
+
+def result(code):
+    return {"generated_code": code}
+
+
+def test_hashing_embedder_is_deterministic_and_normalized():
+    first, second = HashingEmbedder(dim=64).embed(PREFIX), HashingEmbedder(dim=64).embed(PREFIX)
+    assert np.array_equal(first, second)
+    assert np.linalg.norm(first) == pytest.approx(1.0)
+    assert first @ HashingEmbedder(dim=64).embed(UNRELATED) < 0.97
+
+
+def test_near_duplicates_hit_and_unrelated_prefixes_miss(clock):
+    cache = make_cache()
+    cache.add(PREFIX, result("}"))
+    hit = cache.lookup(PREFIX.replace("    ", "\t") + "  ")
+    assert hit is not None and hit.similarity == pytest.approx(1.0) and hit.result == result("}")
+    assert cache.lookup(UNRELATED) is None
+
+
+def test_threshold_decides_hits(clock):
+    similar = PREFIX.replace("dest: T::AccountId", "to: T::AccountId")
+    loose, strict = make_cache(threshold=0.5), make_cache(threshold=0.999)
+    for cache in (loose, strict):
+        cache.add(PREFIX, result("}"))
+    hit = loose.lookup(similar)
+    assert hit is not None and 0.5 <= hit.similarity < 0.999
+    assert strict.lookup(similar) is None
+
+
+def test_entries_expire_after_their_ttl(clock):
+    cache = make_cache(ttl=10)
+    cache.add(PREFIX, result("}"))
+    clock[0] += 9
+    assert cache.lookup(PREFIX) is not None
+    clock[0] += 2
+    assert cache.lookup(PREFIX) is None
+    assert cache.stats() == {"entries": 0}
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = make_cache(max_entries=2)
+    cache.add(PREFIX, result("a"))
+    clock[0] += 1
+    cache.add(UNRELATED, result("b"))
+    clock[0] += 1
+    assert cache.lookup(PREFIX) is not None
+    clock[0] += 1
+    third = "fn on_initialize(n: BlockNumberFor<T>) -> Weight {"
+    cache.add(third, result("c"))
+    assert cache.lookup(UNRELATED) is None
+    assert cache.lookup(PREFIX).result == result("a")
+    assert cache.lookup(third).result == result("c")
+
+
+def test_expired_entries_are_replaced_before_live_ones(clock):
+    cache = make_cache(max_entries=2, ttl=10)
+    cache.add(PREFIX, result("a"))
+    clock[0] += 5
+    cache.add(UNRELATED, result("b"))
+    clock[0] += 6
+    # PREFIX expired; UNRELATED is the least recently used live entry but is kept
+    cache.add("fn on_initialize(n: BlockNumberFor<T>) -> Weight {", result("c"))
+    assert cache.lookup(UNRELATED).result == result("b")
+
+
+def test_verify_evicts_false_hits(clock):
+    cache = make_cache()
+    cache.add(PREFIX, result("}"))
+    hit = cache.lookup(PREFIX)
+    assert cache.verify(hit, result("  }"))
+    assert cache.lookup(PREFIX) is not None
+    assert not cache.verify(hit, result("Ok(())\n}"))
+    assert cache.lookup(PREFIX) is None
+
+
+def test_verify_leaves_a_replaced_entry_alone(clock):
+    cache = make_cache(max_entries=1)
+    cache.add(PREFIX, result("a"))
+    stale = cache.lookup(PREFIX)
+    clock[0] += 1
+    cache.add(UNRELATED, result("b"))
+    # The slot of the stale hit now holds another entry, which a false hit must not evict
+    assert not cache.verify(stale, result("different"))
+    assert cache.lookup(UNRELATED).result == result("b")